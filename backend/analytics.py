@@ -0,0 +1,362 @@
+import datetime
+import threading
+
+import numpy as np
+from flask import current_app
+
+import archive
+import cache
+
+# Vectorized analytics over a user's full transaction history.
+#
+# A user's transactions are loaded once into compact columns (day numbers,
+# integer paise, integer codes for category/account/profile/description) and
+# kept in a bounded per-app cache keyed on the user's data version, so
+# any write invalidates it. Every report is then a handful of NumPy masks and
+# bincounts instead of one GROUP BY per period against SQLite.
+
+DEFAULT_CACHE_USERS = 32
+MAX_PERIODS = 5000
+MAX_TOP = 100
+
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+GROUP_BY = ('none', 'category', 'account', 'profile')
+TYPES = ('expense', 'income', 'net')
+METRICS = ('sum', 'count', 'avg')
+
+# Periods between a period and the same period a year earlier. Days and
+# weeks go back 52 weeks so weekdays line up.
+YOY_LAG = {'day': 364, 'week': 52, 'month': 12, 'quarter': 4, 'year': 1}
+
+# 1970-01-05, the first Monday after the epoch, is day 4
+_MONDAY_OFFSET = 4
+
+_load_lock = threading.Lock()
+
+
+class AnalyticsError(ValueError):
+    pass
+
+
+def _encode(values):
+    # Dictionary-encode a column: integer codes plus the distinct values
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values),
+                        dtype=np.int32, count=len(values))
+    return codes, list(index)
+
+
+def _day_or_nat(value):
+    try:
+        return np.datetime64(str(value)[:10], 'D')
+    except ValueError:
+        return np.datetime64('NaT')
+
+
+def epoch_days(dates):
+    # Days since the epoch of stored dates ('YYYY-MM-DD', maybe with a time)
+    # and a mask of those that parsed. Rows written before dates were
+    # validated can hold anything ('15/04/2024', NULL); callers drop them.
+    try:
+        days = np.array([value[:10] for value in dates], dtype='datetime64[D]')
+    except (TypeError, ValueError):
+        days = np.array([_day_or_nat(value) for value in dates], dtype='datetime64[D]')
+    return days.astype(np.int64), ~np.isnat(days)
+
+
+class Columns:
+
+    def __init__(self, rows, accounts, profiles):
+        days, valid = epoch_days([row['date'] for row in rows])
+        if not valid.all():
+            rows = [row for row, ok in zip(rows, valid) if ok]
+            days = days[valid]
+        count = len(rows)
+        self.count = count
+        self.day = days.astype(np.int32)
+        self.month = self.day.astype('datetime64[D]').astype('datetime64[M]').astype(np.int32)
+        self.paise = np.rint(np.fromiter((row['amount'] for row in rows), dtype=np.float64, count=count) * 100).astype(np.int64)
+        self.is_expense = np.fromiter((row['type'] == 'expense' for row in rows), dtype=bool, count=count)
+        self.category, self.categories = _encode([row['category'] or 'Uncategorized' for row in rows])
+        self.account, account_ids = _encode([row['account_id'] for row in rows])
+        self.profile, profile_ids = _encode([row['profile_id'] for row in rows])
+        self.merchant, self.merchants = _encode([(row['description'] or '').strip() for row in rows])
+        self.account_keys = [{'key': key, 'label': accounts.get(key, 'Account %s' % key)} for key in account_ids]
+        self.profile_keys = [{'key': key, 'label': profiles.get(key, 'Shared') if key is not None else 'Shared'}
+                             for key in profile_ids]
+
+    def period(self, granularity, mask):
+        # Period index of every selected row
+        if granularity == 'day':
+            return self.day[mask]
+        if granularity == 'week':
+            return (self.day[mask] - _MONDAY_OFFSET) // 7
+        if granularity == 'month':
+            return self.month[mask]
+        if granularity == 'quarter':
+            return self.month[mask] // 3
+        return self.month[mask] // 12
+
+    def groups(self, group_by):
+        if group_by == 'category':
+            return self.category, [{'key': name, 'label': name} for name in self.categories]
+        if group_by == 'account':
+            return self.account, self.account_keys
+        if group_by == 'profile':
+            return self.profile, self.profile_keys
+        return np.zeros(self.count, dtype=np.int32), [{'key': None, 'label': 'Total'}]
+
+
+def _read(conn, user_id):
+    rows = conn.execute("""
+        SELECT date, amount, type, category, account_id, profile_id, description
+        FROM {transactions}
+        WHERE user_id = ?
+        ORDER BY date, id
+    """.format(transactions=archive.source(conn)), (user_id,)).fetchall()
+    accounts = dict(conn.execute("SELECT id, name FROM accounts WHERE user_id = ?", (user_id,)).fetchall())
+    profiles = dict(conn.execute("SELECT id, name FROM profiles WHERE user_id = ?", (user_id,)).fetchall())
+    return Columns(rows, accounts, profiles)
+
+
+def load(conn, user_id):
+    # Columns for user_id, rebuilt only when the user's data version moves.
+    # The store belongs to the app, so apps in one process never share one.
+    version = cache.data_version(conn, user_id)
+    store = current_app.extensions['analytics_cache']
+    entry = store.get(user_id)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    with _load_lock:
+        entry = store.get(user_id)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        columns = _read(conn, user_id)
+        store.set(user_id, (version, columns))
+        return columns
+
+
+def _day(value):
+    return int(np.datetime64(value, 'D').astype(np.int32))
+
+
+def _period_of_day(granularity, day):
+    month = int(np.datetime64(day, 'D').astype('datetime64[M]').astype(np.int32))
+    return {
+        'day': day,
+        'week': (day - _MONDAY_OFFSET) // 7,
+        'month': month,
+        'quarter': month // 3,
+        'year': month // 12,
+    }[granularity]
+
+
+def period_label(granularity, index):
+    if granularity == 'day':
+        return str(np.datetime64(index, 'D'))
+    if granularity == 'week':
+        return str(np.datetime64(index * 7 + _MONDAY_OFFSET, 'D'))
+    if granularity == 'month':
+        return str(np.datetime64(index, 'M'))
+    if granularity == 'quarter':
+        return '%d-Q%d' % (1970 + index // 4, index % 4 + 1)
+    return str(1970 + index)
+
+
+def _year_earlier(date, granularity):
+    if granularity in ('day', 'week'):
+        return date - datetime.timedelta(weeks=52)
+    if date.month == 2 and date.day == 29:
+        return date.replace(year=date.year - 1, day=28)
+    return date.replace(year=date.year - 1)
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise AnalyticsError('%s must be a YYYY-MM-DD date' % name)
+
+
+def _choice(value, allowed, name):
+    if value not in allowed:
+        raise AnalyticsError('%s must be one of %s' % (name, ', '.join(allowed)))
+    return value
+
+
+def _signed(columns, mask, tx_type):
+    # Expenses are stored negative; per-type reports are positive magnitudes
+    paise = columns.paise[mask]
+    return -paise if tx_type == 'expense' else paise
+
+
+def _matrix(mask, codes, slots, index, weights, groups, periods):
+    # groups x periods totals in one bincount over a flattened index
+    flat = slots[codes[mask]] * periods + index
+    return np.bincount(flat, weights=weights, minlength=groups * periods).reshape(groups, periods)
+
+
+def _rolling(values, window):
+    # Trailing mean over the last `window` periods along the time axis
+    sums = np.cumsum(values, axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    counts = np.minimum(np.arange(1, values.shape[1] + 1), window)
+    return sums / counts
+
+
+def _rupees(values):
+    return np.round(values / 100.0, 2).tolist()
+
+
+def report(columns, start, end, granularity='month', group_by='category', tx_type='expense', metric='sum',
+           category=None, account_id=None, profile_id=None, rolling=0, compare=False, top=0):
+    _choice(granularity, GRANULARITIES, 'granularity')
+    _choice(group_by, GROUP_BY, 'group_by')
+    _choice(tx_type, TYPES, 'type')
+    _choice(metric, METRICS, 'metric')
+    if start > end:
+        raise AnalyticsError('start_date must not be after end_date')
+
+    first = _period_of_day(granularity, _day(start))
+    last = _period_of_day(granularity, _day(end))
+    periods = last - first + 1
+    if periods > MAX_PERIODS:
+        raise AnalyticsError('too many %s periods; use a coarser granularity' % granularity)
+
+    base = np.ones(columns.count, dtype=bool)
+    if tx_type == 'expense':
+        base &= columns.is_expense
+    elif tx_type == 'income':
+        base &= ~columns.is_expense
+    if category is not None:
+        code = columns.categories.index(category) if category in columns.categories else -1
+        base &= columns.category == code
+    if account_id is not None:
+        codes = [i for i, item in enumerate(columns.account_keys) if item['key'] == account_id]
+        base &= columns.account == (codes[0] if codes else -1)
+    if profile_id is not None:
+        codes = [i for i, item in enumerate(columns.profile_keys) if item['key'] == profile_id]
+        base &= columns.profile == (codes[0] if codes else -1)
+
+    current = base & (columns.day >= _day(start)) & (columns.day <= _day(end))
+    windows = [(current, 0)]
+    if compare:
+        lag = YOY_LAG[granularity]
+        previous = base & (columns.day >= _day(_year_earlier(start, granularity))) \
+            & (columns.day <= _day(_year_earlier(end, granularity)))
+        windows.append((previous, lag))
+
+    # Only groups that occur in either window become series
+    codes, keys = columns.groups(group_by)
+    present = np.unique(np.concatenate([codes[mask] for mask, _ in windows]))
+    slots = np.full(len(keys), -1, dtype=np.int64)
+    slots[present] = np.arange(len(present))
+    groups = len(present)
+
+    def reduce(total, count):
+        if metric == 'count':
+            return count
+        if metric == 'avg':
+            return np.divide(total, count, out=np.zeros_like(total, dtype=np.float64), where=count > 0)
+        return total
+
+    results = []
+    for mask, lag in windows:
+        index = columns.period(granularity, mask) + lag - first
+        # Rows of a partial first/last period can fall outside the grid when
+        # shifted a year; drop them rather than wrap into a neighbour
+        inside = (index >= 0) & (index < periods)
+        selected = np.zeros(columns.count, dtype=bool)
+        selected[np.flatnonzero(mask)[inside]] = True
+        index = index[inside]
+        total = _matrix(selected, codes, slots, index, _signed(columns, selected, tx_type), groups, periods)
+        count = _matrix(selected, codes, slots, index, None, groups, periods)
+        results.append((total, count, selected))
+
+    total, count, selected = results[0]
+    values = reduce(total, count)
+    scale = (lambda v: np.round(v, 2).tolist()) if metric == 'count' else _rupees
+    overall = reduce(total.sum(axis=1), count.sum(axis=1))
+    series = [dict(keys[key], values=scale(values[row]), total=scale(overall[row:row + 1])[0])
+              for row, key in enumerate(present.tolist())]
+
+    result = {
+        'start_date': start.isoformat(),
+        'end_date': end.isoformat(),
+        'granularity': granularity,
+        'group_by': group_by,
+        'type': tx_type,
+        'metric': metric,
+        'periods': [period_label(granularity, first + i) for i in range(periods)],
+        'series': series,
+    }
+
+    if rolling and rolling > 1 and groups:
+        averages = _rolling(values, rolling)
+        for item, row in zip(series, averages):
+            item['rolling'] = scale(row)
+        result['rolling_window'] = rolling
+
+    if compare:
+        previous = reduce(results[1][0], results[1][1])
+        for item, now, before in zip(series, values, previous):
+            delta = now - before
+            item['previous'] = scale(before)
+            item['yoy_delta'] = scale(delta)
+            pct = np.divide(delta * 100.0, np.abs(before), out=np.full(periods, np.nan), where=before != 0)
+            item['yoy_pct'] = [None if np.isnan(p) else round(float(p), 1) for p in pct]
+
+    if top:
+        merchant_codes = columns.merchant[selected]
+        amounts = np.bincount(merchant_codes, weights=_signed(columns, selected, tx_type), minlength=len(columns.merchants))
+        counts = np.bincount(merchant_codes, minlength=len(columns.merchants))
+        named = np.flatnonzero((counts > 0) & (np.array([bool(m) for m in columns.merchants])))
+        order = named[np.argsort(-amounts[named], kind='stable')][:top]
+        result['top_merchants'] = [
+            {'description': columns.merchants[i], 'amount': round(float(amounts[i]) / 100.0, 2), 'count': int(counts[i])}
+            for i in order.tolist()
+        ]
+
+    return result
+
+
+def parse_args(args, today=None):
+    # Query string -> report() keyword arguments
+    today = today or datetime.date.today()
+    end = _parse_date(args['end_date'], 'end_date') if args.get('end_date') else today
+    if args.get('start_date'):
+        start = _parse_date(args['start_date'], 'start_date')
+    else:
+        start = _year_earlier(end, 'month') + datetime.timedelta(days=1)
+
+    def integer(name, low, high):
+        value = args.get(name)
+        if value in (None, ''):
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            raise AnalyticsError('%s must be an integer' % name)
+        if not low <= value <= high:
+            raise AnalyticsError('%s must be between %d and %d' % (name, low, high))
+        return value
+
+    return {
+        'start': start,
+        'end': end,
+        'granularity': args.get('granularity', 'month'),
+        'group_by': args.get('group_by', 'category'),
+        'tx_type': args.get('type', 'expense'),
+        'metric': args.get('metric', 'sum'),
+        'category': args.get('category') or None,
+        'account_id': integer('account_id', 1, 2 ** 63 - 1),
+        'profile_id': integer('profile_id', 1, 2 ** 63 - 1),
+        'rolling': integer('rolling', 1, MAX_PERIODS) or 0,
+        'compare': args.get('compare') == 'yoy',
+        'top': integer('top', 1, MAX_TOP) or 0,
+    }
+
+
+def init_app(app):
+    app.config.setdefault('ANALYTICS_CACHE_USERS', DEFAULT_CACHE_USERS)
+    app.extensions['analytics_cache'] = cache.MemoryStore(app.config['ANALYTICS_CACHE_USERS'])
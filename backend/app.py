@@ -1,273 +1,175 @@
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, current_app, jsonify, request, stream_with_context
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-import sqlite3
+import io
 import os
 import datetime
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app)
-
-# Configure JWT
-app.config['JWT_SECRET_KEY'] = 'your-secret-key'  # Change this in production!
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = datetime.timedelta(days=1)
-jwt = JWTManager(app)
-
-# Database setup
-DB_PATH = os.path.join(os.path.dirname(__file__), 'fintrack.db')
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Create users table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        email TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-
-    # Create accounts table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS accounts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        name TEXT NOT NULL,
-        type TEXT NOT NULL,
-        balance REAL NOT NULL DEFAULT 0,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-
-    # Create transactions table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        account_id INTEGER NOT NULL,
-        profile_id INTEGER,
-        amount REAL NOT NULL,
-        type TEXT NOT NULL,
-        category TEXT NOT NULL,
-        description TEXT,
-        is_shared BOOLEAN DEFAULT 0,
-        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id),
-        FOREIGN KEY (account_id) REFERENCES accounts (id),
-        FOREIGN KEY (profile_id) REFERENCES profiles (id)
-    )
-    ''')
-
-    # Create budgets table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS budgets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        category TEXT NOT NULL,
-        amount REAL NOT NULL,
-        period TEXT NOT NULL,
-        start_date TIMESTAMP,
-        end_date TIMESTAMP,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-
-    # Create profiles table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS profiles (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        name TEXT NOT NULL,
-        type TEXT NOT NULL,  -- 'primary', 'spouse', 'child', etc.
-        photo_url TEXT,
-        is_active BOOLEAN DEFAULT 1,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-
-    # Insert demo user if not exists
-    cursor.execute("SELECT id FROM users WHERE username = 'demo'")
-    if not cursor.fetchone():
-        cursor.execute(
-            "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
-            ('demo', 'demo@example.com', 'password')  # In production, hash the password!
-        )
-
-        # Get the user ID
-        user_id = cursor.lastrowid
-
-        # Insert demo profiles
-        profiles = [
-            (user_id, 'Dr. Ravi', 'primary', 'profile_ravi.jpg', 1),
-            (user_id, 'Mrs. Ravi', 'spouse', 'profile_spouse.jpg', 1)
-        ]
-        cursor.executemany(
-            "INSERT INTO profiles (user_id, name, type, photo_url, is_active) VALUES (?, ?, ?, ?, ?)",
-            profiles
-        )
-
-        # Get profile IDs
-        cursor.execute("SELECT id FROM profiles WHERE user_id = ? AND type = 'primary'", (user_id,))
-        primary_profile_id = cursor.fetchone()[0]
-        cursor.execute("SELECT id FROM profiles WHERE user_id = ? AND type = 'spouse'", (user_id,))
-        spouse_profile_id = cursor.fetchone()[0]
-
-        # Insert demo accounts
-        accounts = [
-            (user_id, 'HDFC Bank', 'Checking', 25000),
-            (user_id, 'ICICI Bank', 'Savings', 75000),
-            (user_id, 'Cash', 'Cash', 5000),
-            (user_id, 'Zerodha', 'Investment', 150000),
-            (user_id, 'Spouse Salary Account', 'Checking', 35000)
-        ]
-        cursor.executemany(
-            "INSERT INTO accounts (user_id, name, type, balance) VALUES (?, ?, ?, ?)",
-            accounts
-        )
-
-        # Insert demo transactions
-        transactions = [
-            # Primary profile transactions
-            (user_id, 1, primary_profile_id, -2500, 'expense', 'Food', 'Grocery shopping', 0, '2023-04-15'),
-            (user_id, 2, primary_profile_id, 45000, 'income', 'Salary', 'Monthly salary', 0, '2023-04-01'),
-            (user_id, 3, primary_profile_id, -1850, 'expense', 'Utilities', 'Electricity bill', 1, '2023-04-10'),
-
-            # Spouse profile transactions
-            (user_id, 5, spouse_profile_id, 35000, 'income', 'Salary', 'Monthly salary', 0, '2023-04-01'),
-            (user_id, 5, spouse_profile_id, -1200, 'expense', 'Shopping', 'Clothes shopping', 0, '2023-04-05'),
-
-            # Shared transactions
-            (user_id, 1, None, -3200, 'expense', 'Food', 'Restaurant dinner', 1, '2023-04-08'),
-            (user_id, 4, None, 12500, 'income', 'Investment', 'Dividend', 1, '2023-04-05'),
-            (user_id, 1, None, -999, 'expense', 'Utilities', 'Mobile bill', 1, '2023-04-12'),
-            (user_id, 2, primary_profile_id, 15000, 'income', 'Freelance', 'Website project', 0, '2023-04-07'),
-            (user_id, 1, None, -800, 'expense', 'Entertainment', 'Movie tickets', 1, '2023-04-09'),
-            (user_id, 3, None, -1499, 'expense', 'Utilities', 'Internet bill', 1, '2023-04-11'),
-            (user_id, 1, None, -18000, 'expense', 'Housing', 'Rent payment', 1, '2023-04-03')
-        ]
-        cursor.executemany(
-            "INSERT INTO transactions (user_id, account_id, profile_id, amount, type, category, description, is_shared, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            transactions
-        )
-
-        # Insert demo budgets
-        budgets = [
-            (user_id, 'Food', 10000, 'monthly', '2023-04-01', '2023-04-30'),
-            (user_id, 'Utilities', 5000, 'monthly', '2023-04-01', '2023-04-30'),
-            (user_id, 'Housing', 20000, 'monthly', '2023-04-01', '2023-04-30'),
-            (user_id, 'Entertainment', 3000, 'monthly', '2023-04-01', '2023-04-30'),
-            (user_id, 'Transportation', 4000, 'monthly', '2023-04-01', '2023-04-30')
-        ]
-        cursor.executemany(
-            "INSERT INTO budgets (user_id, category, amount, period, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?)",
-            budgets
-        )
-
-    conn.commit()
-    conn.close()
-
-# Initialize database
-init_db()
+import analytics
+import archive
+import balances
+import batch
+import budgeting
+import cache
+import db
+import encoding
+import export
+import forecast
+import importers
+import instrumentation
+import migrations
+import pagination
+import refdata
+import rollups
+import scheduler
+import search
+import seed
+import shards
+import sync
+import upi
+import writer
+from db import get_db
+
+api = Blueprint('api', __name__)
+jwt = JWTManager()
+
+DEFAULT_DATABASE = os.path.join(os.path.dirname(__file__), 'fintrack.db')
+
+
+def create_app(config=None):
+    # Building the app does no I/O. The schema is created and upgraded by
+    # `flask db upgrade`, the demo user by `flask db seed`; each worker only
+    # checks the schema version on its first request.
+    app = Flask(__name__)
+    app.config['DATABASE'] = DEFAULT_DATABASE
+    app.config['JWT_SECRET_KEY'] = 'your-secret-key'  # Change this in production!
+    app.config['JWT_ACCESS_TOKEN_EXPIRES'] = datetime.timedelta(days=1)
+
+    # Any setting can come from the environment with a FINTRACK_ prefix, e.g.
+    # FINTRACK_DATABASE=/srv/fintrack.db FINTRACK_JWT_SECRET_KEY=...
+    # FINTRACK_JWT_ACCESS_TOKEN_EXPIRES=3600 FINTRACK_SQLITE_PRAGMAS='{"cache_size": -64000}'
+    # FINTRACK_SHARDS=8 (one file per user_id % 8, see db.py)
+    app.config.from_prefixed_env('FINTRACK')
+    if config:
+        app.config.update(config)
+
+    CORS(app)
+    jwt.init_app(app)
+    db.init_app(app)
+    migrations.init_app(app)
+    cache.init_app(app)
+    writer.init_app(app)
+    instrumentation.init_app(app)
+    analytics.init_app(app)
+    archive.init_app(app)
+    refdata.init_app(app)
+    scheduler.init_app(app)
+    upi.init_app(app)
+    app.register_blueprint(api)
+
+    migrations.cli.add_command(seed.seed_command)
+    app.cli.add_command(migrations.cli)
+    app.cli.add_command(archive.cli)
+    app.cli.add_command(balances.cli)
+    app.cli.add_command(export.export_command)
+    app.cli.add_command(forecast.cli)
+    app.cli.add_command(scheduler.cli)
+    app.cli.add_command(rollups.cli)
+    app.cli.add_command(search.cli)
+    app.cli.add_command(shards.cli)
+    app.cli.add_command(sync.cli)
+    return app
 
 # Routes
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
     username = data.get('username', '')
     password = data.get('password', '')
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.get_catalog()
     cursor = conn.cursor()
     cursor.execute("SELECT id, username FROM users WHERE username = ? AND password = ?", (username, password))
     user = cursor.fetchone()
-    conn.close()
 
     if user:
-        access_token = create_access_token(identity=user[0])
+        access_token = create_access_token(identity=str(user[0]))  # JWT "sub" must be a string
         return jsonify(access_token=access_token, username=user[1]), 200
     else:
         return jsonify({"msg": "Invalid credentials"}), 401
 
-@app.route('/api/dashboard', methods=['GET'])
+@api.route('/api/batch', methods=['POST'])
 @jwt_required()
+def batch_requests():
+    try:
+        paths = batch.parse(request.get_json(silent=True))
+    except batch.BatchError as exc:
+        return jsonify({"msg": str(exc)}), 400
+
+    return batch.run(paths)
+
+@api.route('/api/dashboard', methods=['GET'])
+@jwt_required()
+@cache.cached
 def get_dashboard():
     user_id = get_jwt_identity()
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
 
-    # Get account balances
-    cursor.execute("SELECT SUM(balance) as total_balance FROM accounts WHERE user_id = ?", (user_id,))
-    total_balance = cursor.fetchone()['total_balance']
-
-    # Get monthly income
-    cursor.execute("""
-        SELECT SUM(amount) as monthly_income
-        FROM transactions
-        WHERE user_id = ? AND type = 'income' AND date >= date('now', 'start of month')
-    """, (user_id,))
-    monthly_income = cursor.fetchone()['monthly_income'] or 0
-
-    # Get monthly expenses
+    # Get account balances and investment value
     cursor.execute("""
-        SELECT SUM(ABS(amount)) as monthly_expenses
-        FROM transactions
-        WHERE user_id = ? AND type = 'expense' AND date >= date('now', 'start of month')
+        SELECT SUM(balance) as total_balance,
+               SUM(CASE WHEN type = 'Investment' THEN balance ELSE 0 END) as investment_value
+        FROM accounts
+        WHERE user_id = ?
     """, (user_id,))
-    monthly_expenses = cursor.fetchone()['monthly_expenses'] or 0
+    totals = cursor.fetchone()
+    total_balance = totals['total_balance']
+    investment_value = totals['investment_value'] or 0
 
-    # Get investment value
+    # Current month totals and expense breakdown from the monthly rollups
     cursor.execute("""
-        SELECT SUM(balance) as investment_value
-        FROM accounts
-        WHERE user_id = ? AND type = 'Investment'
+        SELECT type, category, SUM(amount) as amount, SUM(abs_amount) as abs_amount
+        FROM monthly_rollups
+        WHERE user_id = ? AND month >= strftime('%Y-%m', 'now') AND tx_count > 0
+        GROUP BY type, category
     """, (user_id,))
-    investment_value = cursor.fetchone()['investment_value'] or 0
+    monthly_income = 0
+    monthly_expenses = 0
+    expense_breakdown = []
+    for row in cursor.fetchall():
+        if row['type'] == 'income':
+            monthly_income += row['amount']
+        elif row['type'] == 'expense':
+            monthly_expenses += row['abs_amount']
+            expense_breakdown.append({'category': row['category'], 'amount': row['abs_amount']})
 
     # Get recent transactions
-    cursor.execute("""
-        SELECT t.id, t.amount, t.type, t.category, t.description, t.date, a.name as account_name
-        FROM transactions t
-        JOIN accounts a ON t.account_id = a.id
+    reference = refdata.load(conn, user_id)
+    query, params = archive.union(conn, """
+        SELECT t.id, t.amount, t.type, t.category, t.description, t.date, t.account_id as account_name
+        FROM {transactions} t
         WHERE t.user_id = ?
-        ORDER BY t.date DESC
-        LIMIT 5
-    """, (user_id,))
-    recent_transactions = [dict(tx) for tx in cursor.fetchall()]
-
-    # Get expense breakdown
-    cursor.execute("""
-        SELECT category, SUM(ABS(amount)) as amount
-        FROM transactions
-        WHERE user_id = ? AND type = 'expense' AND date >= date('now', 'start of month')
-        GROUP BY category
-    """, (user_id,))
-    expense_breakdown = [dict(item) for item in cursor.fetchall()]
+    """, [user_id])
+    cursor.execute(query + " ORDER BY t.date DESC LIMIT 5", params)
+    recent_transactions = [dict(tx, account_name=reference.account_name(tx['account_name']))
+                           for tx in cursor.fetchall()]
 
     # Get monthly data for chart
     cursor.execute("""
         SELECT
-            strftime('%m', date) as month,
+            substr(month, 6, 2) as month,
             SUM(CASE WHEN type = 'income' THEN amount ELSE 0 END) as income,
-            SUM(CASE WHEN type = 'expense' THEN ABS(amount) ELSE 0 END) as expenses
-        FROM transactions
-        WHERE user_id = ? AND date >= date('now', '-6 months')
-        GROUP BY strftime('%m-%Y', date)
-        ORDER BY date
+            SUM(CASE WHEN type = 'expense' THEN abs_amount ELSE 0 END) as expenses
+        FROM monthly_rollups
+        WHERE user_id = ? AND month >= strftime('%Y-%m', 'now', '-6 months')
+        GROUP BY monthly_rollups.month
+        HAVING SUM(tx_count) > 0
+        ORDER BY monthly_rollups.month
     """, (user_id,))
     monthly_data = [dict(item) for item in cursor.fetchall()]
 
-    conn.close()
-
     return jsonify({
         'stats': {
             'total_balance': total_balance,
@@ -280,23 +182,85 @@ def get_dashboard():
         'monthly_data': monthly_data
     })
 
-@app.route('/api/transactions', methods=['GET'])
+@api.route('/api/analytics', methods=['GET'])
 @jwt_required()
+@cache.cached
+def get_analytics():
+    user_id = get_jwt_identity()
+
+    try:
+        options = analytics.parse_args(request.args)
+        columns = analytics.load(get_db(), user_id)
+        report = analytics.report(columns, **options)
+    except analytics.AnalyticsError as exc:
+        return jsonify({"msg": str(exc)}), 400
+
+    return encoding.json_response(report)
+
+@api.route('/api/forecast', methods=['GET'])
+@jwt_required()
+def get_forecast():
+    # Read from the series the scheduler precomputes (forecast.py); not
+    # response-cached, as those change without a data version bump
+    user_id = get_jwt_identity()
+
+    try:
+        options = forecast.parse_args(request.args)
+        result = forecast.forecast(get_db(), user_id, **options)
+    except forecast.ForecastError as exc:
+        return jsonify({"msg": str(exc)}), 400
+
+    return encoding.json_response(result)
+
+@api.route('/api/networth', methods=['GET'])
+@jwt_required()
+@cache.cached
+def get_net_worth():
+    user_id = get_jwt_identity()
+
+    try:
+        options = balances.parse_args(request.args)
+        history = balances.history(get_db(), user_id, **options)
+    except balances.BalanceError as exc:
+        return jsonify({"msg": str(exc)}), 400
+
+    return encoding.json_response(history)
+
+@api.route('/api/sync', methods=['GET'])
+@jwt_required()
+def get_changes():
+    user_id = get_jwt_identity()
+
+    # Rows changed since the token from the previous sync; see sync.py
+    try:
+        since = sync.parse_token(request.args.get('since'))
+    except sync.SyncError as exc:
+        return jsonify({"msg": str(exc)}), 400
+    limit = pagination.parse_limit(request.args.get('limit'), default=sync.MAX_CHANGES, maximum=sync.MAX_CHANGES)
+
+    return encoding.json_response(sync.changes_since(get_db(), user_id, since, limit))
+
+@api.route('/api/transactions', methods=['GET'])
+@jwt_required()
+@cache.cached
 def get_transactions():
     user_id = get_jwt_identity()
     profile_id = request.args.get('profile_id', None)
     show_shared = request.args.get('show_shared', 'true').lower() == 'true'
+    category = request.args.get('category')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    stream = request.args.get('stream')  # 'ndjson' or 'json'
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    conn = get_db()
+    cursor = db.tuple_cursor(conn)
+    reference = refdata.load(conn, user_id)
 
+    # Account and profile ids; the names are filled in from refdata
     query = """
         SELECT t.id, t.amount, t.type, t.category, t.description, t.date, t.is_shared,
-               a.name as account_name, p.name as profile_name, p.photo_url as profile_photo
-        FROM transactions t
-        JOIN accounts a ON t.account_id = a.id
-        LEFT JOIN profiles p ON t.profile_id = p.id
+               t.account_id as account_name, t.profile_id as profile_name, t.profile_id as profile_photo
+        FROM {transactions} t
         WHERE t.user_id = ?
     """
 
@@ -308,16 +272,142 @@ def get_transactions():
     elif not show_shared:
         query += " AND t.is_shared = 0"
 
-    query += " ORDER BY t.date DESC"
+    if category:
+        query += " AND t.category = ?"
+        params.append(category)
+    if start_date:
+        query += " AND t.date >= ?"
+        params.append(start_date)
+    if end_date:
+        # Inclusive of the whole end day even when dates carry a time part
+        query += " AND t.date < date(?, '+1 day')"
+        params.append(end_date)
+
+    # Keyset pagination: resume strictly after the last (date, id) returned
+    cursor_token = request.args.get('cursor')
+    if cursor_token:
+        try:
+            after_date, after_id = pagination.decode_cursor(cursor_token)
+        except pagination.InvalidCursor:
+            return jsonify({"msg": "Invalid cursor"}), 400
+        query += " AND (t.date, t.id) < (?, ?)"
+        params.extend([after_date, after_id])
+
+    # Old pages come from the archive database as well, when there is one
+    query, params = archive.union(conn, query, params, start_date)
+    query += " ORDER BY t.date DESC, t.id DESC"
+
+    if stream in ('ndjson', 'json'):
+        # Streams the whole matching history unless a limit is given
+        if request.args.get('limit') is not None:
+            query += " LIMIT ?"
+            params.append(pagination.parse_limit(request.args.get('limit')))
+        cursor.execute(query, params)
+        fill = refdata.filler(reference, encoding.columns(cursor))
+        if stream == 'ndjson':
+            return pagination.stream_ndjson(cursor, fill)
+        return pagination.stream_json_array(cursor, fill)
+
+    # Paging is opt-in: without ?limit= or ?cursor= the whole list is
+    # returned, as it always was
+    if request.args.get('limit') is None and not cursor_token:
+        cursor.execute(query, params)
+        columns = encoding.columns(cursor)
+        return encoding.rows_response(columns, refdata.filler(reference, columns)(cursor.fetchall()))
+
+    # Fetch one extra row to learn whether another page exists
+    limit = pagination.parse_limit(request.args.get('limit'))
+    query += " LIMIT ?"
+    params.append(limit + 1)
 
     cursor.execute(query, params)
 
-    transactions = [dict(tx) for tx in cursor.fetchall()]
-    conn.close()
+    columns = encoding.columns(cursor)
+    transactions = refdata.filler(reference, columns)(cursor.fetchall())
+
+    response = encoding.rows_response(columns, transactions[:limit])
+    if len(transactions) > limit:
+        last = dict(zip(columns, transactions[limit - 1]))
+        response.headers['X-Next-Cursor'] = pagination.encode_cursor(last['date'], last['id'])
+    return response
+
+@api.route('/api/transactions/export', methods=['GET'])
+@jwt_required()
+def export_transactions():
+    # Full history as a download, streamed in chunks; not response-cached
+    user_id = get_jwt_identity()
+    fmt = request.args.get('format', 'csv')
+    compress = request.args.get('compress') == 'gzip'
+    try:
+        export.check_format(fmt, compress)
+    except export.ExportError as exc:
+        return jsonify({"msg": str(exc)}), 400
+
+    profile_id = request.args.get('profile_id')
+    filters = {
+        'start_date': request.args.get('start_date'),
+        'end_date': request.args.get('end_date'),
+        'profile_id': None if profile_id in (None, '', 'all') else profile_id,
+        'show_shared': request.args.get('show_shared', 'true').lower() == 'true',
+        'category': request.args.get('category') or None,
+        'account_id': request.args.get('account_id') or None,
+    }
+
+    body = export.generate(get_db(), user_id, fmt, filters, compress)
+    response = Response(stream_with_context(body),
+                        mimetype='application/gzip' if compress else export.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename="%s"' % export.filename(fmt, compress)
+    return response
+
+@api.route('/api/transactions/search', methods=['GET'])
+@jwt_required()
+@cache.cached
+def search_transactions():
+    user_id = get_jwt_identity()
+    sort = request.args.get('sort', 'rank')
+    if sort not in ('rank', 'date'):
+        return jsonify({"msg": "sort must be rank or date"}), 400
+
+    match = search.match_expression(user_id, request.args.get('q'))
+    if match is None:
+        return jsonify({"msg": "Search text is required"}), 400
+
+    filters = {
+        'start_date': request.args.get('start_date'),
+        'end_date': request.args.get('end_date'),
+        'min_amount': request.args.get('min_amount', type=float),
+        'max_amount': request.args.get('max_amount', type=float),
+        'account_id': request.args.get('account_id', type=int),
+        'profile_id': request.args.get('profile_id', type=int),
+        'category': request.args.get('category'),
+        'type': request.args.get('type'),
+    }
+
+    after = None
+    cursor_token = request.args.get('cursor')
+    if cursor_token:
+        try:
+            after = pagination.decode_cursor(cursor_token, str if sort == 'date' else float)
+        except pagination.InvalidCursor:
+            return jsonify({"msg": "Invalid cursor"}), 400
+
+    limit = pagination.parse_limit(request.args.get('limit'), default=50)
+    conn = get_db()
+    query, params = search.build_query(conn, user_id, match, filters, sort, after, limit + 1)
+
+    cursor = db.tuple_cursor(conn)
+    cursor.execute(query, params)
+    columns = encoding.columns(cursor)
+    transactions = refdata.filler(refdata.load(conn, user_id), columns)(cursor.fetchall())
 
-    return jsonify(transactions)
+    response = encoding.rows_response(columns, transactions[:limit])
+    if len(transactions) > limit:
+        last = dict(zip(columns, transactions[limit - 1]))
+        key = last['date'] if sort == 'date' else last['relevance']
+        response.headers['X-Next-Cursor'] = pagination.encode_cursor(key, last['id'])
+    return response
 
-@app.route('/api/transactions', methods=['POST'])
+@api.route('/api/transactions', methods=['POST'])
 @jwt_required()
 def add_transaction():
     user_id = get_jwt_identity()
@@ -332,96 +422,231 @@ def add_transaction():
     is_shared = data.get('is_shared', False)
     date = data.get('date', datetime.datetime.now().strftime('%Y-%m-%d'))
 
+    # Analytics, rollups and budgets all read dates as ISO strings
+    if not importers.is_iso_date(date):
+        return jsonify({"msg": "date must be YYYY-MM-DD"}), 400
+
     # Adjust amount based on transaction type
     if transaction_type == 'expense':
         amount = -abs(amount)
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    def write(cursor):
+        # Insert transaction
+        cursor.execute(
+            "INSERT INTO transactions (user_id, account_id, profile_id, amount, type, category, description, is_shared, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, account_id, profile_id, amount, transaction_type, category, description, is_shared, date)
+        )
 
-    # Insert transaction
-    cursor.execute(
-        "INSERT INTO transactions (user_id, account_id, profile_id, amount, type, category, description, is_shared, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        (user_id, account_id, profile_id, amount, transaction_type, category, description, is_shared, date)
-    )
+        transaction_id = cursor.lastrowid
 
-    transaction_id = cursor.lastrowid
+        # Update account balance
+        cursor.execute(
+            "UPDATE accounts SET balance = balance + ? WHERE id = ? AND user_id = ?",
+            (amount, account_id, user_id)
+        )
 
-    # Update account balance
-    cursor.execute(
-        "UPDATE accounts SET balance = balance + ? WHERE id = ? AND user_id = ?",
-        (amount, account_id, user_id)
-    )
+        # Keep dashboard rollups and the search index in the same transaction
+        rollups.record(cursor, user_id, [(date, transaction_type, category, amount)])
+        balances.record(cursor, user_id, [(account_id, date, amount)])
+        search.index_after(cursor, transaction_id - 1)
+        budgeting.record_spending(cursor, user_id, [(date, transaction_type, category, amount)])
 
-    conn.commit()
+        cache.bump_version(cursor, user_id)
+        sync.record_ledger(cursor, user_id, transaction_id - 1)
+        return transaction_id
 
-    # Get the created transaction with profile info
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    transaction_id = writer.run(write)
+
+    # Get the created transaction with account and profile info
+    conn = get_db()
+    cursor = db.tuple_cursor(conn)
     cursor.execute("""
         SELECT t.id, t.amount, t.type, t.category, t.description, t.date, t.is_shared,
-               a.name as account_name, p.name as profile_name, p.photo_url as profile_photo
+               t.account_id as account_name, t.profile_id as profile_name, t.profile_id as profile_photo
         FROM transactions t
-        JOIN accounts a ON t.account_id = a.id
-        LEFT JOIN profiles p ON t.profile_id = p.id
         WHERE t.id = ?
     """, (transaction_id,))
 
-    transaction = dict(cursor.fetchone())
-    conn.close()
+    columns = encoding.columns(cursor)
+    transaction = dict(zip(columns, refdata.filler(refdata.load(conn, user_id), columns)(cursor.fetchall())[0]))
 
     return jsonify({"msg": "Transaction added successfully", "transaction": transaction}), 201
 
-@app.route('/api/accounts', methods=['GET'])
+@api.route('/api/transactions/import', methods=['POST'])
 @jwt_required()
-def get_accounts():
+def import_transactions():
     user_id = get_jwt_identity()
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    account_id = request.args.get('account_id', type=int)
+    profile_id = request.args.get('profile_id', type=int)
+    is_shared = request.args.get('is_shared', 'false').lower() == 'true'
+
+    # Accept a multipart upload ('file') or the statement as the raw body
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename, mimetype = upload.stream, upload.filename, upload.mimetype
+    else:
+        stream, filename, mimetype = request.stream, None, request.mimetype
+
+    statement_format = request.args.get('format') or importers.detect_format(filename, mimetype)
+    parser = importers.PARSERS.get(statement_format)
+    if parser is None:
+        return jsonify({"msg": "Unsupported statement format; use csv, ofx or json"}), 400
+
+    # Read and parse the upload here, on the request thread: the writer only
+    # gets the finished rows, so a slow client never holds the write lock
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    try:
+        rows = list(parser(text))
+    except importers.StatementError as exc:
+        return jsonify({"msg": "Could not read statement: %s" % exc}), 400
+
+    def write(cursor):
+        # Check if account exists and belongs to user
+        cursor.execute("SELECT id FROM accounts WHERE id = ? AND user_id = ?", (account_id, user_id))
+        if not cursor.fetchone():
+            return None
+        return importers.import_rows(cursor, user_id, account_id, rows, profile_id, is_shared)
+
+    result = writer.run(write)
+    if result is None:
+        return jsonify({"msg": "Account not found or not authorized"}), 404
+
+    return jsonify(dict(result, msg="Statement imported successfully")), 201
+
+@api.route('/api/upi-webhook', methods=['POST'])
+def upi_webhook():
+    # Called by Zapier with an API key instead of a JWT; see upi.py
+    data = request.get_json(silent=True) or {}
+    api_key = data.get('apiKey') or request.headers.get('X-API-Key')
+    user_id = upi.key_user(api_key)
+    if user_id is None:
+        return jsonify({"msg": "Invalid API key"}), 401
+
+    path = db.user_database(current_app.config, user_id)
+    conn = db.thread_connection(path)
     cursor = conn.cursor()
+    cursor.execute("SELECT account_id FROM api_keys WHERE key_hash = ? AND user_id = ?",
+                   (upi.hash_key(api_key), user_id))
+    key = cursor.fetchone()
+    if not key:
+        return jsonify({"msg": "Invalid API key"}), 401
+
+    try:
+        row = upi.parse(data.get('transaction'))
+    except upi.UpiError as exc:
+        return jsonify({"msg": str(exc)}), 400
+    if row is None:
+        return jsonify({"msg": "Failed transaction not recorded"}), 200
+
+    try:
+        status = upi.ingest(conn, path, user_id, key['account_id'], row)
+    except upi.QueueFull:
+        return jsonify({"msg": "Too many transactions queued, retry later"}), 503, {'Retry-After': '5'}
+    except upi.NotRecorded as exc:
+        return jsonify({"msg": "%s, retry later" % exc}), 503, {'Retry-After': '5'}
+
+    if status == 'duplicate':
+        return jsonify({"msg": "Transaction already recorded", "reference": row['reference']}), 200
+    return jsonify({"msg": "Transaction recorded", "reference": row['reference']}), 201
+
+@api.route('/api/api-keys', methods=['GET'])
+@jwt_required()
+def get_api_keys():
+    user_id = get_jwt_identity()
 
-    cursor.execute("SELECT id, name, type, balance FROM accounts WHERE user_id = ?", (user_id,))
-    accounts = [dict(account) for account in cursor.fetchall()]
-    conn.close()
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT k.id, k.name, k.account_id, a.name as account_name, k.created_at
+        FROM api_keys k
+        JOIN accounts a ON k.account_id = a.id
+        WHERE k.user_id = ?
+        ORDER BY k.id
+    """, (user_id,))
 
-    return jsonify(accounts)
+    return jsonify([dict(row) for row in cursor.fetchall()])
 
-@app.route('/api/profiles', methods=['GET'])
+@api.route('/api/api-keys', methods=['POST'])
 @jwt_required()
-def get_profiles():
+def add_api_key():
     user_id = get_jwt_identity()
+    data = request.get_json(silent=True) or {}
+
+    name = (data.get('name') or '').strip()
+    account_id = data.get('account_id')
+    if not name:
+        return jsonify({"msg": "name is required"}), 400
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
 
-    cursor.execute("SELECT id, name, type, photo_url, is_active FROM profiles WHERE user_id = ?", (user_id,))
-    profiles = [dict(profile) for profile in cursor.fetchall()]
-    conn.close()
+    # Check if account exists and belongs to user
+    cursor.execute("SELECT id FROM accounts WHERE id = ? AND user_id = ?", (account_id, user_id))
+    if not cursor.fetchone():
+        return jsonify({"msg": "Account not found or not authorized"}), 404
+
+    # Shown once; only its hash is kept
+    api_key = upi.new_key(user_id)
+
+    def write(cursor):
+        cursor.execute("INSERT INTO api_keys (user_id, account_id, name, key_hash) VALUES (?, ?, ?, ?)",
+                       (user_id, account_id, name, upi.hash_key(api_key)))
+        return cursor.lastrowid
 
-    return jsonify(profiles)
+    key_id = writer.run(write)
 
-@app.route('/api/profiles/<int:profile_id>', methods=['GET'])
+    return jsonify({"msg": "API key created", "id": key_id, "name": name, "account_id": account_id,
+                    "api_key": api_key}), 201
+
+@api.route('/api/api-keys/<int:key_id>', methods=['DELETE'])
 @jwt_required()
-def get_profile(profile_id):
+def delete_api_key(key_id):
     user_id = get_jwt_identity()
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    def write(cursor):
+        cursor.execute("DELETE FROM api_keys WHERE id = ? AND user_id = ?", (key_id, user_id))
+        return cursor.rowcount
 
-    cursor.execute("SELECT id, name, type, photo_url, is_active FROM profiles WHERE id = ? AND user_id = ?", (profile_id, user_id))
-    profile = cursor.fetchone()
+    if not writer.run(write):
+        return jsonify({"msg": "API key not found or not authorized"}), 404
+
+    return jsonify({"msg": "API key revoked"}), 200
+
+@api.route('/api/accounts', methods=['GET'])
+@jwt_required()
+@cache.cached
+def get_accounts():
+    user_id = get_jwt_identity()
+
+    reference = refdata.load(get_db(), user_id)
+
+    return encoding.rows_response(refdata.ACCOUNT_COLUMNS, list(reference.accounts.values()))
+
+@api.route('/api/profiles', methods=['GET'])
+@jwt_required()
+@cache.cached
+def get_profiles():
+    user_id = get_jwt_identity()
+
+    reference = refdata.load(get_db(), user_id)
+
+    return encoding.rows_response(refdata.PROFILE_COLUMNS, list(reference.profiles.values()))
+
+@api.route('/api/profiles/<int:profile_id>', methods=['GET'])
+@jwt_required()
+@cache.cached
+def get_profile(profile_id):
+    user_id = get_jwt_identity()
+
+    profile = refdata.load(get_db(), user_id).profiles.get(profile_id)
 
     if not profile:
-        conn.close()
         return jsonify({"msg": "Profile not found"}), 404
 
-    conn.close()
-    return jsonify(dict(profile))
+    return jsonify(dict(zip(refdata.PROFILE_COLUMNS, profile)))
 
-@app.route('/api/profiles', methods=['POST'])
+@api.route('/api/profiles', methods=['POST'])
 @jwt_required()
 def add_profile():
     user_id = get_jwt_identity()
@@ -431,26 +656,26 @@ def add_profile():
     profile_type = data.get('type')
     photo_url = data.get('photo_url')
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "INSERT INTO profiles (user_id, name, type, photo_url, is_active) VALUES (?, ?, ?, ?, ?)",
-        (user_id, name, profile_type, photo_url, 1)
-    )
+    def write(cursor):
+        cursor.execute(
+            "INSERT INTO profiles (user_id, name, type, photo_url, is_active) VALUES (?, ?, ?, ?, ?)",
+            (user_id, name, profile_type, photo_url, 1)
+        )
+        profile_id = cursor.lastrowid
+        cache.bump_version(cursor, user_id)
+        sync.record(cursor, user_id, 'profiles', [profile_id])
+        return profile_id
 
-    profile_id = cursor.lastrowid
-    conn.commit()
+    profile_id = writer.run(write)
 
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id, name, type, photo_url, is_active FROM profiles WHERE id = ?", (profile_id,))
     profile = cursor.fetchone()
 
-    conn.close()
     return jsonify({"msg": "Profile added successfully", "profile": dict(profile)}), 201
 
-@app.route('/api/profiles/<int:profile_id>', methods=['PUT'])
+@api.route('/api/profiles/<int:profile_id>', methods=['PUT'])
 @jwt_required()
 def update_profile(profile_id):
     user_id = get_jwt_identity()
@@ -461,58 +686,68 @@ def update_profile(profile_id):
     photo_url = data.get('photo_url')
     is_active = data.get('is_active')
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    def write(cursor):
+        # Check if profile exists and belongs to user
+        cursor.execute("SELECT id FROM profiles WHERE id = ? AND user_id = ?", (profile_id, user_id))
+        if not cursor.fetchone():
+            return False
 
-    # Check if profile exists and belongs to user
-    cursor.execute("SELECT id FROM profiles WHERE id = ? AND user_id = ?", (profile_id, user_id))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({"msg": "Profile not found or not authorized"}), 404
-
-    # Update profile
-    cursor.execute(
-        "UPDATE profiles SET name = ?, type = ?, photo_url = ?, is_active = ? WHERE id = ? AND user_id = ?",
-        (name, profile_type, photo_url, is_active, profile_id, user_id)
-    )
+        # Update profile
+        cursor.execute(
+            "UPDATE profiles SET name = ?, type = ?, photo_url = ?, is_active = ? WHERE id = ? AND user_id = ?",
+            (name, profile_type, photo_url, is_active, profile_id, user_id)
+        )
+        cache.bump_version(cursor, user_id)
+        sync.record(cursor, user_id, 'profiles', [profile_id])
+        return True
 
-    conn.commit()
+    if not writer.run(write):
+        return jsonify({"msg": "Profile not found or not authorized"}), 404
 
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id, name, type, photo_url, is_active FROM profiles WHERE id = ?", (profile_id,))
     profile = cursor.fetchone()
 
-    conn.close()
     return jsonify({"msg": "Profile updated successfully", "profile": dict(profile)})
 
-@app.route('/api/budgets', methods=['GET'])
+@api.route('/api/jobs', methods=['GET'])
 @jwt_required()
+def get_jobs():
+    # Background job state of the signed-in user's database, without the
+    # details of runs that covered other users; see scheduler.py
+    return jsonify([{field: job[field] for field in scheduler.PUBLIC_FIELDS} for job in scheduler.status(get_db())])
+
+@api.route('/api/budgets', methods=['GET'])
+@jwt_required()
+@cache.cached
 def get_budgets():
     user_id = get_jwt_identity()
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    conn = get_db()
+    cursor = db.tuple_cursor(conn)
 
     # Get all budgets for the user
-    cursor.execute("""
-        SELECT b.id, b.category, b.amount, b.period, b.start_date, b.end_date,
-               COALESCE(SUM(CASE WHEN t.type = 'expense' THEN ABS(t.amount) ELSE 0 END), 0) as spent
-        FROM budgets b
-        LEFT JOIN transactions t ON b.user_id = t.user_id AND b.category = t.category
-            AND t.date BETWEEN b.start_date AND b.end_date
-        WHERE b.user_id = ?
-        GROUP BY b.id
-        ORDER BY b.category
-    """, (user_id,))
+    query = """
+        SELECT id, category, amount, period, start_date, end_date, spent, recurring
+        FROM budgets
+        WHERE user_id = ?
+    """
+    params = [user_id]
 
-    budgets = [dict(budget) for budget in cursor.fetchall()]
-    conn.close()
+    # Only the budgets whose window contains this date (e.g. the current ones)
+    on_date = request.args.get('date')
+    if on_date:
+        query += " AND end_date >= ? AND start_date <= ?"
+        params.extend([on_date, on_date])
 
-    return jsonify(budgets)
+    query += " ORDER BY category"
 
-@app.route('/api/budgets', methods=['POST'])
+    cursor.execute(query, params)
+
+    return encoding.rows_response(encoding.columns(cursor), cursor.fetchall())
+
+@api.route('/api/budgets', methods=['POST'])
 @jwt_required()
 def add_budget():
     user_id = get_jwt_identity()
@@ -521,91 +756,63 @@ def add_budget():
     category = data.get('category')
     amount = data.get('amount')
     period = data.get('period', 'monthly')
+    # Recurring budgets roll into the next period when this one ends (scheduler.py)
+    recurring = bool(data.get('recurring', True))
 
     # Calculate start and end dates based on period
-    today = datetime.datetime.now()
-    start_date = today.replace(day=1).strftime('%Y-%m-%d')  # First day of current month
+    start_date, end_date = budgeting.period_window(period, datetime.date.today())
 
-    if period == 'monthly':
-        # Last day of current month
-        if today.month == 12:
-            end_date = today.replace(year=today.year + 1, month=1, day=1) - datetime.timedelta(days=1)
-        else:
-            end_date = today.replace(month=today.month + 1, day=1) - datetime.timedelta(days=1)
-    elif period == 'weekly':
-        # Start from Monday of current week
-        start_date = (today - datetime.timedelta(days=today.weekday())).strftime('%Y-%m-%d')
-        # End on Sunday of current week
-        end_date = (today + datetime.timedelta(days=6-today.weekday()))
-    elif period == 'yearly':
-        # Start from January 1st of current year
-        start_date = today.replace(month=1, day=1).strftime('%Y-%m-%d')
-        # End on December 31st of current year
-        end_date = today.replace(month=12, day=31)
-    else:  # Default to monthly
-        if today.month == 12:
-            end_date = today.replace(year=today.year + 1, month=1, day=1) - datetime.timedelta(days=1)
+    def write(cursor):
+        # Check if budget for this category and period already exists
+        cursor.execute("""
+            SELECT id FROM budgets
+            WHERE user_id = ? AND category = ? AND period = ?
+            AND start_date = ? AND end_date = ?
+        """, (user_id, category, period, start_date, end_date))
+
+        existing_budget = cursor.fetchone()
+
+        if existing_budget:
+            # Update existing budget
+            cursor.execute("""
+                UPDATE budgets SET amount = ?, recurring = ?
+                WHERE id = ?
+            """, (amount, recurring, existing_budget[0]))
+            budget_id = existing_budget[0]
+            message = "Budget updated successfully"
         else:
-            end_date = today.replace(month=today.month + 1, day=1) - datetime.timedelta(days=1)
+            # Insert new budget
+            cursor.execute("""
+                INSERT INTO budgets (user_id, category, amount, period, start_date, end_date, recurring)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, category, amount, period, start_date, end_date, recurring))
+            budget_id = cursor.lastrowid
+            message = "Budget created successfully"
 
-    end_date = end_date.strftime('%Y-%m-%d')
+            # Seed the spent counter from transactions already in the window
+            budgeting.recompute(cursor, budget_id)
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Check if budget for this category and period already exists
-    cursor.execute("""
-        SELECT id FROM budgets
-        WHERE user_id = ? AND category = ? AND period = ?
-        AND start_date = ? AND end_date = ?
-    """, (user_id, category, period, start_date, end_date))
+        cache.bump_version(cursor, user_id)
+        sync.record(cursor, user_id, 'budgets', [budget_id])
+        return budget_id, message
 
-    existing_budget = cursor.fetchone()
-
-    if existing_budget:
-        # Update existing budget
-        cursor.execute("""
-            UPDATE budgets SET amount = ?
-            WHERE id = ?
-        """, (amount, existing_budget[0]))
-        budget_id = existing_budget[0]
-        message = "Budget updated successfully"
-    else:
-        # Insert new budget
-        cursor.execute("""
-            INSERT INTO budgets (user_id, category, amount, period, start_date, end_date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, category, amount, period, start_date, end_date))
-        budget_id = cursor.lastrowid
-        message = "Budget created successfully"
+    budget_id, message = writer.run(write)
 
-    conn.commit()
+    conn = get_db()
+    cursor = conn.cursor()
 
     # Get the created/updated budget with spent amount
     cursor.execute("""
-        SELECT b.id, b.category, b.amount, b.period, b.start_date, b.end_date,
-               COALESCE(SUM(CASE WHEN t.type = 'expense' THEN ABS(t.amount) ELSE 0 END), 0) as spent
-        FROM budgets b
-        LEFT JOIN transactions t ON b.user_id = t.user_id AND b.category = t.category
-            AND t.date BETWEEN b.start_date AND b.end_date
-        WHERE b.id = ?
-        GROUP BY b.id
-    """, (budget_id,))
-
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT b.id, b.category, b.amount, b.period, b.start_date, b.end_date
-        FROM budgets b
-        WHERE b.id = ?
+        SELECT id, category, amount, period, start_date, end_date, spent, recurring
+        FROM budgets
+        WHERE id = ?
     """, (budget_id,))
 
     budget = dict(cursor.fetchone())
-    conn.close()
 
     return jsonify({"msg": message, "budget": budget}), 201
 
-@app.route('/api/budgets/<int:budget_id>', methods=['PUT'])
+@api.route('/api/budgets/<int:budget_id>', methods=['PUT'])
 @jwt_required()
 def update_budget(budget_id):
     user_id = get_jwt_identity()
@@ -614,66 +821,82 @@ def update_budget(budget_id):
     category = data.get('category')
     amount = data.get('amount')
     period = data.get('period')
+    recurring = data.get('recurring')
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    def write(cursor):
+        # Check if budget exists and belongs to user
+        cursor.execute("SELECT id, category, period, start_date, end_date, recurring FROM budgets WHERE id = ? AND user_id = ?", (budget_id, user_id))
+        existing_budget = cursor.fetchone()
+        if not existing_budget:
+            return False
 
-    # Check if budget exists and belongs to user
-    cursor.execute("SELECT id FROM budgets WHERE id = ? AND user_id = ?", (budget_id, user_id))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({"msg": "Budget not found or not authorized"}), 404
+        # A new period moves the window to the one containing the old start date
+        start_date, end_date = existing_budget['start_date'], existing_budget['end_date']
+        if period != existing_budget['period'] and start_date:
+            start_date, end_date = budgeting.period_window(period, datetime.date.fromisoformat(start_date[:10]))
 
-    # Update budget
-    cursor.execute("""
-        UPDATE budgets
-        SET category = ?, amount = ?, period = ?
-        WHERE id = ? AND user_id = ?
-    """, (category, amount, period, budget_id, user_id))
+        # Update budget
+        cursor.execute("""
+            UPDATE budgets
+            SET category = ?, amount = ?, period = ?, start_date = ?, end_date = ?, recurring = ?
+            WHERE id = ? AND user_id = ?
+        """, (category, amount, period, start_date, end_date,
+              existing_budget['recurring'] if recurring is None else bool(recurring), budget_id, user_id))
+
+        # The spent counter only needs rebuilding when what it counts changed
+        if category != existing_budget['category'] or (start_date, end_date) != (existing_budget['start_date'], existing_budget['end_date']):
+            budgeting.recompute(cursor, budget_id)
 
-    conn.commit()
+        cache.bump_version(cursor, user_id)
+        sync.record(cursor, user_id, 'budgets', [budget_id])
+        return True
+
+    if not writer.run(write):
+        return jsonify({"msg": "Budget not found or not authorized"}), 404
 
     # Get updated budget
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("""
-        SELECT b.id, b.category, b.amount, b.period, b.start_date, b.end_date,
-               COALESCE(SUM(CASE WHEN t.type = 'expense' THEN ABS(t.amount) ELSE 0 END), 0) as spent
-        FROM budgets b
-        LEFT JOIN transactions t ON b.user_id = t.user_id AND b.category = t.category
-            AND t.date BETWEEN b.start_date AND b.end_date
-        WHERE b.id = ?
-        GROUP BY b.id
+        SELECT id, category, amount, period, start_date, end_date, spent, recurring
+        FROM budgets
+        WHERE id = ?
     """, (budget_id,))
 
-    budget = dict(cursor.fetchone()) if cursor.fetchone() else None
-    conn.close()
+    row = cursor.fetchone()
+    budget = dict(row) if row else None
 
     if budget:
         return jsonify({"msg": "Budget updated successfully", "budget": budget})
     else:
         return jsonify({"msg": "Budget updated but could not retrieve details"}), 200
 
-@app.route('/api/budgets/<int:budget_id>', methods=['DELETE'])
+@api.route('/api/budgets/<int:budget_id>', methods=['DELETE'])
 @jwt_required()
 def delete_budget(budget_id):
     user_id = get_jwt_identity()
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    def write(cursor):
+        # Check if budget exists and belongs to user
+        cursor.execute("SELECT id FROM budgets WHERE id = ? AND user_id = ?", (budget_id, user_id))
+        if not cursor.fetchone():
+            return False
 
-    # Check if budget exists and belongs to user
-    cursor.execute("SELECT id FROM budgets WHERE id = ? AND user_id = ?", (budget_id, user_id))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({"msg": "Budget not found or not authorized"}), 404
+        # Delete budget
+        cursor.execute("DELETE FROM budgets WHERE id = ? AND user_id = ?", (budget_id, user_id))
+        cache.bump_version(cursor, user_id)
+        sync.record(cursor, user_id, 'budgets', [budget_id], deleted=True)
+        return True
 
-    # Delete budget
-    cursor.execute("DELETE FROM budgets WHERE id = ? AND user_id = ?", (budget_id, user_id))
-    conn.commit()
-    conn.close()
+    if not writer.run(write):
+        return jsonify({"msg": "Budget not found or not authorized"}), 404
 
     return jsonify({"msg": "Budget deleted successfully"}), 200
 
+app = create_app()
+
 if __name__ == '__main__':
+    # Development server: bring the schema up to date and seed the demo user
+    migrations.upgrade_all(app.config)
+    seed.seed(app.config)
     app.run(debug=True, port=5000)
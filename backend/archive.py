@@ -0,0 +1,213 @@
+import datetime
+import os
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import db
+
+# Hot/cold split of the ledger.
+#
+# `flask archive run` moves transactions dated before the horizon (ARCHIVE_MONTHS
+# back, 24 by default) out of each database into <name>-archive.db next to it,
+# a batch of rows per write transaction so the app's writer is never blocked
+# for long. The hot file keeps the recent months that nearly every request
+# reads and stays small enough for the page cache; rollups, balance history and
+# budgets are aggregates and do not change when rows move.
+#
+# Reads stay transparent. db.py attaches the archive as schema "archive" once
+# it exists, and:
+# - union() turns a listing query into hot UNION ALL archive. The caller's
+#   ORDER BY t.date, t.id then merges two index-ordered streams, and the
+#   archive is skipped when start_date is on or after the archive's cutoff.
+# - source() is a table expression over both, for aggregates and lookups
+#   (rebuilds, reconcile, analytics, import dedupe); SQLite pushes their
+#   WHERE clauses down into each half.
+#
+# Writes always go to the hot table, backdated ones included; the next run
+# moves them. WAL makes a commit atomic per file, not across the two, so a run
+# interrupted between the archive and hot commits can leave rows in both
+# until it is re-run (copies are INSERT OR IGNORE, ids are kept).
+
+DEFAULT_MONTHS = 24
+BATCH_SIZE = 5000
+
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_archive_user_date ON transactions (user_id, date)",
+    "CREATE INDEX IF NOT EXISTS idx_archive_user_category_date ON transactions (user_id, category, date, type, amount)",
+    "CREATE INDEX IF NOT EXISTS idx_archive_user_import_hash ON transactions (user_id, import_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_archive_account ON transactions (account_id)",
+)
+
+
+def _connection(conn):
+    # Accept a connection or a cursor (write paths only have the cursor)
+    return getattr(conn, 'connection', conn)
+
+
+def attached(conn):
+    return bool(getattr(_connection(conn), 'archive_columns', None))
+
+
+def cutoff(conn):
+    # Every archived row is dated before this; '' when nothing was archived
+    if not attached(conn):
+        return ''
+    return conn.execute("SELECT cutoff FROM archive.archive_meta").fetchone()[0]
+
+
+def source(conn):
+    if not attached(conn):
+        return 'transactions'
+    columns = ', '.join(_connection(conn).archive_columns)
+    return '(SELECT {0} FROM main.transactions UNION ALL SELECT {0} FROM archive.transactions)'.format(columns)
+
+
+def union(conn, query, params, start_date=None):
+    # query: a SELECT over "{transactions} t" without ORDER BY or LIMIT
+    if not attached(conn) or (start_date and start_date >= cutoff(conn)):
+        return query.format(transactions='transactions'), list(params)
+    return (query.format(transactions='main.transactions') + " UNION ALL " +
+            query.format(transactions='archive.transactions'), list(params) * 2)
+
+
+def horizon(months, today=None):
+    # First day of the month `months` before today's
+    today = today or datetime.date.today()
+    month = today.year * 12 + today.month - 1 - months
+    return datetime.date(month // 12, month % 12 + 1, 1).isoformat()
+
+
+def _create(conn, path):
+    # Build the file under a temporary name so the app never attaches a
+    # half-created archive, then attach it here
+    target = db.archive_path(path)
+    building = target + '.new'
+    if os.path.exists(building):
+        os.remove(building)
+    columns = conn.execute("PRAGMA main.table_info(transactions)").fetchall()
+    new = db.connect(building)
+    new.execute("CREATE TABLE transactions (%s)" % ', '.join(
+        '%s INTEGER PRIMARY KEY' % column['name'] if column['pk'] else '%s %s' % (column['name'], column['type'])
+        for column in columns))
+    for statement in INDEXES:
+        new.execute(statement)
+    new.execute("""
+        CREATE TABLE archive_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            cutoff TEXT NOT NULL,
+            archived_at TIMESTAMP
+        )
+    """)
+    new.execute("INSERT INTO archive_meta (id, cutoff) VALUES (1, '')")
+    new.commit()
+    new.close()
+    os.replace(building, target)
+    db.attach_archive(conn, path)
+
+
+def _add_columns(conn):
+    # Columns a migration added to the hot table since the archive was made
+    have = set(conn.archive_columns)
+    for column in conn.execute("PRAGMA main.table_info(transactions)").fetchall():
+        if column['name'] not in have:
+            conn.execute("ALTER TABLE archive.transactions ADD COLUMN %s %s" % (column['name'], column['type']))
+            conn.archive_columns.append(column['name'])
+
+
+def move(conn, path, before, batch_size=BATCH_SIZE):
+    # Move every transaction dated before `before` into the archive; returns
+    # the number of rows moved. `conn` must be a connection to `path`.
+    if not attached(conn):
+        _create(conn, path)
+    _add_columns(conn)
+    # Raise the cutoff first: until the rows have moved, union() only reads
+    # the archive more often than needed, never less
+    conn.execute("UPDATE archive.archive_meta SET cutoff = MAX(cutoff, ?), archived_at = CURRENT_TIMESTAMP",
+                 (before,))
+    conn.commit()
+
+    columns = ', '.join(conn.archive_columns)
+    moved = 0
+    for (user_id,) in conn.execute("SELECT DISTINCT user_id FROM accounts").fetchall():
+        while True:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [row[0] for row in cursor.execute(
+                    "SELECT id FROM main.transactions WHERE user_id = ? AND date < ? LIMIT ?",
+                    (user_id, before, batch_size))]
+                if ids:
+                    placeholders = ','.join('?' * len(ids))
+                    cursor.execute("INSERT OR IGNORE INTO archive.transactions ({0}) SELECT {0} FROM main.transactions "
+                                   "WHERE id IN ({1})".format(columns, placeholders), ids)
+                    cursor.execute("DELETE FROM main.transactions WHERE id IN (%s)" % placeholders, ids)
+                    # The delete trigger took them out of the search index;
+                    # archived rows stay searchable
+                    cursor.execute("""
+                        INSERT INTO transactions_fts (rowid, owner, description, category)
+                        SELECT id, 'u' || user_id, COALESCE(description, ''), COALESCE(category, '')
+                        FROM archive.transactions WHERE id IN (%s)
+                    """ % placeholders, ids)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            moved += len(ids)
+            if len(ids) < batch_size:
+                break
+    return moved
+
+
+def status(conn):
+    hot = conn.execute("SELECT COUNT(*), MIN(date) FROM main.transactions").fetchone()
+    if not attached(conn):
+        return {'hot_rows': hot[0], 'oldest_hot': hot[1], 'archived_rows': 0, 'cutoff': None}
+    archived = conn.execute("SELECT COUNT(*) FROM archive.transactions").fetchone()[0]
+    return {'hot_rows': hot[0], 'oldest_hot': hot[1], 'archived_rows': archived, 'cutoff': cutoff(conn)}
+
+
+cli = AppGroup('archive', help='Move old transactions into the archive database.')
+
+
+def _label(path):
+    return '%s: ' % os.path.basename(path) if current_app.config['SHARDS'] else ''
+
+
+@cli.command('run')
+@click.option('--months', type=int, default=None, help='Keep this many months hot (default ARCHIVE_MONTHS).')
+@click.option('--vacuum', is_flag=True, help='VACUUM the hot database afterwards to return the freed space.')
+def run_command(months, vacuum):
+    months = current_app.config['ARCHIVE_MONTHS'] if months is None else months
+    before = horizon(months)
+    for path in db.database_paths(current_app.config):
+        if not os.path.exists(path):
+            continue
+        conn = db.connect(path)
+        moved = move(conn, path, before)
+        if vacuum:
+            conn.execute("VACUUM main")
+        conn.close()
+        click.echo('%smoved %d transactions dated before %s' % (_label(path), moved, before))
+
+
+@cli.command('status')
+def status_command():
+    for path in db.database_paths(current_app.config):
+        if not os.path.exists(path):
+            continue
+        conn = db.connect(path)
+        info = status(conn)
+        conn.close()
+        size = os.path.getsize(path)
+        click.echo('%shot: %d rows (oldest %s), %.1f MB' % (
+            _label(path), info['hot_rows'], info['oldest_hot'], size / 1e6))
+        if info['cutoff'] is not None:
+            click.echo('%sarchive: %d rows before %s, %.1f MB' % (
+                _label(path), info['archived_rows'], info['cutoff'],
+                os.path.getsize(db.archive_path(path)) / 1e6))
+
+
+def init_app(app):
+    app.config.setdefault('ARCHIVE_MONTHS', DEFAULT_MONTHS)
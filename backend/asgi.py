@@ -0,0 +1,235 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import tempfile
+import threading
+
+import app
+
+# ASGI serving mode:
+#
+#     uvicorn asgi:application --workers 4 --timeout-keep-alive 75
+#
+# Phones on flaky networks spend far longer sending requests and reading
+# responses than the app spends on them. Under a sync server every such
+# socket holds a worker thread; here the event loop owns the sockets, so idle
+# keep-alive connections and slow uploads or downloads cost no thread. A
+# thread from a bounded pool (ASGI_THREADS, sized to what SQLite can serve in
+# parallel: WAL readers, one writer per file behind writer.py) is taken only
+# once the request body has arrived, and given back as soon as the view has
+# produced its body. The Flask views stay as they are, and so does the WSGI
+# entry point for `flask run` and gunicorn.
+#
+# - Past ASGI_MAX_PENDING requests in flight (uploading their body, running
+#   or waiting for a thread) new ones are answered 503 with Retry-After,
+#   before their body is read, instead of queueing without bound.
+# - Query time per request is capped by QUERY_TIMEOUT / ROUTE_TIMEOUTS (see
+#   db.set_deadline); those work in both modes.
+# - Streamed bodies (exports, ?stream=) are produced by the same thread that
+#   ran the view, SQLite connections being bound to their thread, and handed
+#   over a few chunks at a time; a slow reader holds that one thread.
+#
+# Bodies up to SPOOL_SIZE are buffered in memory, larger uploads (statement
+# imports) in a temporary file.
+
+SPOOL_SIZE = 1024 * 1024
+STREAM_BUFFER = 8  # chunks of a streamed body buffered ahead of the client
+
+
+def default_threads():
+    return min(32, (os.cpu_count() or 1) * 4)
+
+
+class _Disconnected(Exception):
+    pass
+
+
+class AsgiApp:
+
+    def __init__(self, flask_app, threads=None, max_pending=None):
+        self.app = flask_app
+        self.threads = threads or flask_app.config.get('ASGI_THREADS') or default_threads()
+        self.max_pending = max_pending or flask_app.config.get('ASGI_MAX_PENDING') or self.threads * 16
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix='asgi')
+        self.in_flight = 0  # only touched on the event loop
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('unsupported ASGI scope %r' % scope['type'])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Write out what the UPI ingestor and the writers still hold
+                await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        for name in ('scheduler', 'upi', 'writer'):
+            extension = self.app.extensions.get(name)
+            if extension is not None:
+                extension.stop()
+
+    async def _http(self, scope, receive, send):
+        # Checked before the body is read, and a request counts as in flight
+        # while it uploads, so slow uploads cannot pile up past the limit
+        if self.in_flight >= self.max_pending:
+            await _send_simple(send, 503, b'{"msg":"Server busy, retry shortly"}', [(b'retry-after', b'1')])
+            return
+
+        self.in_flight += 1
+        body = watcher = None
+        try:
+            body = await self._read_body(receive)
+            if body is None:
+                return
+            loop = asyncio.get_running_loop()
+            messages = asyncio.Queue(STREAM_BUFFER)
+            gone = threading.Event()
+            watcher = loop.create_task(_watch_disconnect(receive, gone))
+            worker = loop.run_in_executor(self.executor, self._run, _environ(scope, body), loop, messages, gone)
+            started = False
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                if gone.is_set():
+                    continue  # keep draining so the thread can finish
+                try:
+                    await send(message)
+                except Exception:
+                    gone.set()  # the client went away mid-response
+                    continue
+                started = True
+            try:
+                await worker
+            except Exception:
+                if not started and not gone.is_set():
+                    await _send_simple(send, 500, b'{"msg":"Internal server error"}')
+                raise
+        finally:
+            self.in_flight -= 1
+            if watcher is not None:
+                watcher.cancel()
+            if body is not None:
+                body.close()
+
+    async def _read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            more = message.get('more_body', False)
+        body.seek(0)
+        return body
+
+    def _run(self, environ, loop, messages, gone):
+        # Runs on a pool thread: the WSGI app, then its body, pushed to the
+        # event loop as ASGI messages. None marks the end.
+        def put(message):
+            future = asyncio.run_coroutine_threadsafe(messages.put(message), loop)
+            while True:
+                try:
+                    return future.result(1)
+                except concurrent.futures.TimeoutError:
+                    if gone.is_set():
+                        future.cancel()
+                        raise _Disconnected()
+
+        def start_response(status, headers, exc_info=None):
+            put({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            })
+
+        try:
+            iterable = self.app(environ, start_response)
+            try:
+                for chunk in iterable:
+                    if chunk:
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                put({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            finally:
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+        except _Disconnected:
+            pass
+        finally:
+            asyncio.run_coroutine_threadsafe(messages.put(None), loop)
+
+
+async def _watch_disconnect(receive, gone):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            gone.set()
+            return
+
+
+async def _send_simple(send, status, body, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _environ(scope, body):
+    # PEP 3333 environ for an ASGI HTTP scope
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,  # the whole body is already there, chunked or not
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            # Repeated headers fold into one, comma-separated; cookies are
+            # joined with '; ' (RFC 6265 section 5.4)
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+def create_asgi_app(flask_app):
+    flask_app.config.setdefault('ASGI_THREADS', default_threads())
+    flask_app.config.setdefault('ASGI_MAX_PENDING', None)
+    return AsgiApp(flask_app)
+
+
+application = create_asgi_app(app.app)
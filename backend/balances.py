@@ -0,0 +1,297 @@
+import bisect
+import datetime
+import sys
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import archive
+import db
+
+# Balance history and point-in-time net worth (migration 9).
+#
+# accounts.balance is only today's number. History comes from two pieces:
+#
+# - balance_months: the net change per account and month, maintained by every
+#   write path through record() (a backdated transaction touches one row).
+#   The balance at the end of month M is opening_balance plus a window-function
+#   running sum over these rows, so a multi-year monthly chart reads
+#   O(accounts x months) rows instead of the ledger.
+# - For dates that are not a month end (daily and weekly charts, or an
+#   end_date mid-month) the balance is the previous month end's plus a running
+#   sum over that month's transactions, read from the first of the month to
+#   the last date needed in it, again with a window function.
+#
+# balance_checkpoints is separate: it records the ledger balance of each
+# account through a transaction id, so `flask balances reconcile` only sums
+# rows added since the previous run.
+
+MAX_PERIODS = 5000
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+
+
+class BalanceError(ValueError):
+    pass
+
+
+def month_of(date):
+    return str(date)[:7]
+
+
+def record(cursor, user_id, changes):
+    # changes: iterable of (account_id, date, amount)
+    totals = defaultdict(lambda: [0.0, 0])
+    for account_id, date, amount in changes:
+        bucket = totals[(account_id, month_of(date))]
+        bucket[0] += amount
+        bucket[1] += 1
+
+    cursor.executemany("""
+        INSERT INTO balance_months (account_id, month, user_id, amount, tx_count)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (account_id, month) DO UPDATE SET
+            amount = amount + excluded.amount,
+            tx_count = tx_count + excluded.tx_count
+    """, [
+        (account_id, month, user_id, amount, count)
+        for (account_id, month), (amount, count) in totals.items()
+    ])
+
+
+def rebuild(conn, user_id=None):
+    # Recompute balance_months from the ledger and drop the checkpoints, so
+    # the next reconcile is a full one
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM balance_months " + where, params)
+    cursor.execute("DELETE FROM balance_checkpoints " + where, params)
+    cursor.execute("""
+        INSERT INTO balance_months (account_id, month, user_id, amount, tx_count)
+        SELECT account_id, substr(date, 1, 7), user_id, SUM(amount), COUNT(*)
+        FROM {transactions}
+        {where}
+        GROUP BY account_id, substr(date, 1, 7)
+    """.format(transactions=archive.source(conn), where=where), params)
+    conn.commit()
+
+
+def reconcile(conn, user_id=None, full=False):
+    # Compare accounts.balance with opening_balance plus the ledger and move
+    # every checkpoint forward. Only transactions newer than an account's
+    # checkpoint are summed unless full=True. Returns (user_id, account_id,
+    # name, stored, ledger) for every account that disagrees.
+    where, params = ("WHERE a.user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    accounts = conn.execute("""
+        SELECT a.id, a.user_id, a.name, a.balance, a.opening_balance, c.last_id, c.balance AS checkpoint
+        FROM accounts a
+        LEFT JOIN balance_checkpoints c ON c.account_id = a.id
+        {where}
+    """.format(where=where), params).fetchall()
+    # AUTOINCREMENT's counter: the highest id ever used, hot or archived
+    last_id = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'transactions'").fetchone()[0]
+    transactions = archive.source(conn)
+
+    mismatches = []
+    checkpoints = []
+    for account in accounts:
+        if full or account['last_id'] is None:
+            since, ledger = 0, account['opening_balance']
+        else:
+            since, ledger = account['last_id'], account['checkpoint']
+        ledger += conn.execute("""
+            SELECT COALESCE(SUM(amount), 0) FROM {transactions} WHERE account_id = ? AND id > ? AND id <= ?
+        """.format(transactions=transactions), (account['id'], since, last_id)).fetchone()[0]
+        if abs(ledger - account['balance']) > 0.005:
+            mismatches.append((account['user_id'], account['id'], account['name'],
+                               account['balance'], round(ledger, 2)))
+        checkpoints.append((account['id'], account['user_id'], last_id, ledger))
+
+    conn.executemany("""
+        INSERT INTO balance_checkpoints (account_id, user_id, last_id, balance, checked_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (account_id) DO UPDATE SET
+            last_id = excluded.last_id, balance = excluded.balance, checked_at = excluded.checked_at
+    """, checkpoints)
+    conn.commit()
+    return mismatches
+
+
+def _month_end(date):
+    return (date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+
+
+def period_ends(start, end, granularity):
+    # [(label, last day)] for every period overlapping [start, end]. Labels
+    # match /api/analytics; the last period is cut off at `end`.
+    periods = []
+    day = start
+    while day <= end:
+        if granularity == 'day':
+            last, label = day, day.isoformat()
+        elif granularity == 'week':
+            last = day + datetime.timedelta(days=6 - day.weekday())
+            label = (last - datetime.timedelta(days=6)).isoformat()
+        elif granularity == 'month':
+            last, label = _month_end(day), day.strftime('%Y-%m')
+        elif granularity == 'quarter':
+            quarter = (day.month - 1) // 3
+            last = _month_end(day.replace(month=quarter * 3 + 3))
+            label = '%d-Q%d' % (day.year, quarter + 1)
+        else:
+            last, label = datetime.date(day.year, 12, 31), str(day.year)
+        periods.append((label, min(last, end)))
+        if len(periods) > MAX_PERIODS:
+            raise BalanceError('too many %s periods; use a coarser granularity' % granularity)
+        day = last + datetime.timedelta(days=1)
+    return periods
+
+
+def history(conn, user_id, start, end, granularity='month', account_id=None):
+    if granularity not in GRANULARITIES:
+        raise BalanceError('granularity must be one of %s' % ', '.join(GRANULARITIES))
+    if start > end:
+        raise BalanceError('start_date must not be after end_date')
+    periods = period_ends(start, end, granularity)
+    dates = [last for _, last in periods]
+
+    query = "SELECT id, name, type, opening_balance FROM accounts WHERE user_id = ?"
+    params = [user_id]
+    if account_id is not None:
+        query += " AND id = ?"
+        params.append(account_id)
+    accounts = conn.execute(query + " ORDER BY id", params).fetchall()
+    selected = {account['id'] for account in accounts}
+
+    # Month-end balances: running sum of the monthly net changes
+    months = defaultdict(lambda: ([], []))
+    for row in conn.execute("""
+        SELECT account_id, month, SUM(amount) OVER (PARTITION BY account_id ORDER BY month) AS running
+        FROM balance_months
+        WHERE user_id = ? AND month <= ?
+        ORDER BY account_id, month
+    """, (user_id, month_of(end))):
+        if row['account_id'] in selected:
+            months[row['account_id']][0].append(row['month'])
+            months[row['account_id']][1].append(row['running'])
+
+    # A date that is not a month end starts from the month-end balance before
+    # it and adds just its own month's transactions, up to the last such date
+    # in that month
+    inside = defaultdict(list)
+    for date in dates:
+        if date != _month_end(date):
+            inside[month_of(date)].append(date)
+    days = defaultdict(lambda: ([], []))
+    for month, month_dates in sorted(inside.items()):
+        for row in conn.execute("""
+            SELECT account_id, substr(date, 1, 10) AS day,
+                   SUM(SUM(amount)) OVER (PARTITION BY account_id ORDER BY substr(date, 1, 10)) AS running
+            FROM {transactions}
+            WHERE user_id = ? AND date >= ? AND date < date(?, '+1 day')
+            GROUP BY account_id, day
+            ORDER BY account_id, day
+        """.format(transactions=archive.source(conn)), (user_id, month + '-01', month_dates[-1].isoformat())):
+            if row['account_id'] in selected:
+                days[row['account_id']][0].append(row['day'])
+                days[row['account_id']][1].append(row['running'])
+
+    def through_month(account_id, month):
+        # Net change of all months up to and including `month`
+        keys, running = months[account_id]
+        index = bisect.bisect_right(keys, month)
+        return running[index - 1] if index else 0.0
+
+    def within_month(account_id, date):
+        keys, running = days[account_id]
+        index = bisect.bisect_right(keys, date.isoformat())
+        if index and keys[index - 1][:7] == month_of(date):
+            return running[index - 1]
+        return 0.0
+
+    series = []
+    for account in accounts:
+        balances = []
+        for date in dates:
+            month = month_of(date)
+            if date == _month_end(date):
+                change = through_month(account['id'], month)
+            else:
+                previous = month_of(date.replace(day=1) - datetime.timedelta(days=1))
+                change = through_month(account['id'], previous) + within_month(account['id'], date)
+            balances.append(round(account['opening_balance'] + change, 2))
+        series.append({'id': account['id'], 'name': account['name'], 'type': account['type'],
+                       'balances': balances})
+
+    return {
+        'granularity': granularity,
+        'periods': [label for label, _ in periods],
+        'dates': [date.isoformat() for date in dates],
+        'net_worth': [round(sum(values), 2) for values in zip(*(s['balances'] for s in series))]
+                     if series else [0.0] * len(dates),
+        'accounts': series,
+    }
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise BalanceError('%s must be a YYYY-MM-DD date' % name)
+
+
+def parse_args(args, today=None):
+    # Query string -> history() keyword arguments. A single date is
+    # start_date=end_date=<date> with granularity=day.
+    today = today or datetime.date.today()
+    end = _parse_date(args['end_date'], 'end_date') if args.get('end_date') else today
+    if args.get('start_date'):
+        start = _parse_date(args['start_date'], 'start_date')
+    else:
+        start = datetime.date(end.year - 1, end.month, 1)
+    account_id = args.get('account_id')
+    if account_id not in (None, ''):
+        try:
+            account_id = int(account_id)
+        except ValueError:
+            raise BalanceError('account_id must be an integer')
+    else:
+        account_id = None
+    return {'start': start, 'end': end, 'granularity': args.get('granularity', 'month'),
+            'account_id': account_id}
+
+
+cli = AppGroup('balances', help='Check account balances against the ledger.')
+
+
+def _paths(user_id):
+    if user_id is not None:
+        return [db.user_database(current_app.config, user_id)]
+    return db.database_paths(current_app.config)
+
+
+@cli.command('reconcile')
+@click.option('--user-id', type=int, default=None, help='Only reconcile this user.')
+@click.option('--full', is_flag=True, help='Ignore checkpoints and sum the whole ledger.')
+def reconcile_command(user_id, full):
+    mismatches = []
+    for path in _paths(user_id):
+        conn = db.connect(path)
+        mismatches.extend(reconcile(conn, user_id, full))
+        conn.close()
+    for mismatch in mismatches:
+        click.echo('user %s account %s (%s): balance %r, ledger %r' % mismatch, err=True)
+    if mismatches:
+        sys.exit(1)
+    click.echo('account balances match the ledger')
+
+
+@cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_command(user_id):
+    for path in _paths(user_id):
+        conn = db.connect(path)
+        rebuild(conn, user_id)
+        conn.close()
+    click.echo('balance history rebuilt')
@@ -0,0 +1,109 @@
+import io
+
+from flask import Response, current_app, request
+from werkzeug.exceptions import HTTPException
+
+import db
+import encoding
+from db import get_db
+
+# Composite reads: POST /api/batch runs several GET routes in one round trip.
+#
+#     {"requests": ["/api/dashboard", "/api/accounts", {"path": "/api/transactions?limit=20"}]}
+#
+# Every sub-request is dispatched in-process to the normal view function with
+# the caller's headers (Authorization, Accept, ...), on the request's one
+# connection and inside one read transaction, so all results come from the
+# same snapshot. Sub-request bodies are already JSON; they are spliced into
+# the reply as bytes rather than decoded and encoded again:
+#
+#     {"responses": [{"status": 200, "headers": {...}, "body": ...}, ...]}
+
+MAX_REQUESTS = 20
+
+# Response headers passed back per sub-request
+HEADERS = ('ETag', 'X-Next-Cursor')
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse(data):
+    # Request body -> list of paths with query strings
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise BatchError('requests must be a non-empty list')
+    if len(items) > MAX_REQUESTS:
+        raise BatchError('at most %d requests per batch' % MAX_REQUESTS)
+    paths = []
+    for item in items:
+        if isinstance(item, dict):
+            if item.get('method', 'GET').upper() != 'GET':
+                raise BatchError('only GET requests can be batched')
+            item = item.get('path')
+        if not isinstance(item, str) or not item.startswith('/api/'):
+            raise BatchError('each request must be a path starting with /api/')
+        paths.append(item)
+    return paths
+
+
+def _environ(path):
+    path, _, query = path.partition('?')
+    environ = dict(request.environ)
+    environ.update({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': '0',
+        'wsgi.input': io.BytesIO(),
+    })
+    environ.pop('CONTENT_TYPE', None)
+    return environ
+
+
+def _dispatch(app, path):
+    # Routing, the view and its error handlers, but not the before/after
+    # request hooks: those already ran once for the batch itself. The query
+    # deadline is the one exception; each sub-request gets its own route's.
+    with app.request_context(_environ(path)):
+        try:
+            if request.routing_exception is not None:
+                raise request.routing_exception
+            db.set_deadline(db.route_timeout(request.url_rule.endpoint))
+            rv = app.view_functions[request.url_rule.endpoint](**request.view_args)
+        except HTTPException as exc:  # no handlers registered: 404, 405, abort()
+            rv = ({"msg": exc.name}, exc.code)
+        except Exception as exc:
+            try:
+                rv = app.handle_user_exception(exc)
+            except Exception:
+                app.logger.exception('batched request %s failed', path)
+                rv = ({"msg": "Internal server error"}, 500)
+        response = app.make_response(rv)
+        if response.is_streamed:
+            response.close()
+            response = app.make_response(({"msg": "Streamed responses cannot be batched"}, 400))
+        return response
+
+
+def run(paths):
+    app = current_app._get_current_object()
+    conn = get_db()
+    parts = []
+    # A deferred BEGIN: the first read fixes the snapshot every later
+    # sub-request sees, even while the writer commits in between
+    conn.execute("BEGIN")
+    try:
+        for path in paths:
+            response = _dispatch(app, path)
+            body = response.get_data()
+            if not body:
+                body = b'null'
+            elif not response.is_json and response.mimetype != encoding.COLUMNAR_MIMETYPE:
+                body = encoding.dumps(response.get_data(as_text=True))
+            headers = {name: response.headers[name] for name in HEADERS if name in response.headers}
+            parts.append(b'{"status":%d,"headers":%s,"body":%s}' % (response.status_code, encoding.dumps(headers), body))
+    finally:
+        conn.rollback()
+    return Response(b'{"responses":[' + b','.join(parts) + b']}', mimetype=encoding.JSON_MIMETYPE)
@@ -0,0 +1,2 @@
+# Synthetic data generation and per-endpoint load benchmarks for app.py.
+# Run from the backend directory: python -m bench --help
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from bench import datagen, load
+
+
+def _in_process_client(db_path, response_cache):
+    # A fresh Flask app pointed at the benchmark database instead of fintrack.db
+    import app as app_module
+
+    app = app_module.create_app({
+        'DATABASE': db_path,
+        'RESPONSE_CACHE_BACKEND': 'memory' if response_cache else None,
+    })
+    return load.InProcessClient(app)
+
+
+def generate_command(args):
+    started = time.time()
+    counts = datagen.generate(args.db, users=args.users, years=args.years,
+                              per_month=args.per_month, seed=args.seed)
+    print('generated %(users)d users, %(transactions)d transactions' % counts,
+          'in %.1fs' % (time.time() - started))
+
+
+def run_command(args):
+    if args.url:
+        client = load.HttpClient(args.url)
+    else:
+        client = _in_process_client(args.db, not args.no_cache)
+
+    usernames = ['user%d' % n for n in range(args.users)]
+    scenarios = args.scenario or list(load.SCENARIOS)
+    results = load.run(client, usernames, scenarios, args.concurrency, args.requests, args.seed)
+
+    print('%-26s %8s %7s %9s %9s %9s %9s' % ('endpoint', 'rps', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, stats in results.items():
+        print('%-26s %8.1f %7d %9s %9s %9s %9s' % (
+            name, stats['throughput_rps'], stats['errors'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms']))
+
+    report = {
+        'meta': {
+            'target': args.url or 'in-process',
+            'db': None if args.url else os.path.abspath(args.db),
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'users': args.users,
+            'response_cache': not args.no_cache,
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'endpoints': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['endpoints']
+        regressions = load.compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Synthetic data and load benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='Append synthetic users and transactions to a database.')
+    gen.add_argument('--db', default='bench.db')
+    gen.add_argument('--users', type=int, default=10)
+    gen.add_argument('--years', type=int, default=3)
+    gen.add_argument('--per-month', type=int, default=120, help='Discretionary transactions per user per month.')
+    gen.add_argument('--seed', type=int, default=42)
+    gen.set_defaults(func=generate_command)
+
+    bench = commands.add_parser('run', help='Load every endpoint and report latency percentiles.')
+    bench.add_argument('--db', default='bench.db', help='Database for in-process runs.')
+    bench.add_argument('--url', help='Benchmark a running server instead, e.g. http://localhost:5000')
+    bench.add_argument('--users', type=int, default=10, help='Log in as user0..user<N-1>.')
+    bench.add_argument('--concurrency', type=int, default=8)
+    bench.add_argument('--requests', type=int, default=400, help='Requests per endpoint.')
+    bench.add_argument('--scenario', action='append', choices=sorted(load.SCENARIOS), help='Only these endpoints.')
+    bench.add_argument('--no-cache', action='store_true', help='Disable the response cache (in-process only).')
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--output', help='Write results as JSON, e.g. a new baseline.')
+    bench.add_argument('--baseline', help='Compare against a previous --output file; exit 1 on regression.')
+    bench.add_argument('--tolerance', type=float, default=0.2)
+    bench.set_defaults(func=run_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
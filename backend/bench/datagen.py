@@ -0,0 +1,162 @@
+import datetime
+import math
+import random
+
+import balances
+import budgeting
+import db
+import migrations
+import rollups
+import search
+
+# Synthetic household data at realistic scale. Each user gets two profiles,
+# a handful of accounts, a monthly salary, rent and bills on fixed days, and
+# day-to-day spending drawn from weighted categories with log-normal amounts.
+# Generation is deterministic for a given seed.
+
+ACCOUNTS = [
+    ('HDFC Bank', 'Checking', 25000),
+    ('ICICI Bank', 'Savings', 75000),
+    ('Cash', 'Cash', 5000),
+    ('Zerodha', 'Investment', 150000),
+    ('Spouse Salary Account', 'Checking', 35000),
+]
+
+# (category, weight, median amount in rupees, descriptions)
+SPENDING = [
+    ('Food', 30, 450, ('Swiggy order', 'Zomato order', 'BigBasket groceries', 'Restaurant dinner', 'Grocery shopping')),
+    ('Transportation', 14, 250, ('Uber ride', 'Ola ride', 'Petrol', 'Metro recharge')),
+    ('Shopping', 12, 1500, ('Amazon order', 'Flipkart order', 'Clothes shopping', 'Myntra order')),
+    ('Entertainment', 8, 600, ('Movie tickets', 'Netflix', 'Concert', 'BookMyShow')),
+    ('Health', 6, 900, ('Pharmacy', 'Doctor consultation', 'Lab tests')),
+    ('Utilities', 5, 700, ('Gas cylinder', 'Water bill', 'DTH recharge')),
+    ('Education', 3, 2500, ('Books', 'Online course', 'School fees')),
+    ('Travel', 2, 6000, ('Flight tickets', 'Hotel booking', 'Train tickets')),
+]
+
+# (day of month, category, description, amount, account index)
+MONTHLY = [
+    (1, 'Salary', 'Monthly salary', 95000, 1),
+    (1, 'Salary', 'Monthly salary', 60000, 4),
+    (3, 'Housing', 'Rent payment', -18000, 0),
+    (10, 'Utilities', 'Electricity bill', -1850, 2),
+    (11, 'Utilities', 'Internet bill', -1499, 2),
+    (12, 'Utilities', 'Mobile bill', -999, 0),
+    (5, 'Investment', 'SIP', -10000, 3),
+]
+
+BUDGET_CATEGORIES = [('Food', 12000), ('Transportation', 5000), ('Shopping', 8000),
+                     ('Entertainment', 3000), ('Utilities', 5000), ('Housing', 20000)]
+
+BATCH_SIZE = 50000
+
+
+def _month_starts(start, end):
+    day = start.replace(day=1)
+    while day <= end:
+        yield day
+        day = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def _transactions(rng, user_id, account_ids, profile_ids, start, end, per_month):
+    categories = [item[0] for item in SPENDING]
+    weights = [item[1] for item in SPENDING]
+    by_category = {item[0]: item for item in SPENDING}
+    days = (end - start).days + 1
+    spending_accounts = account_ids[:3] + account_ids[4:]  # not the investment account
+
+    for month in _month_starts(start, end):
+        for day, category, description, amount, account in MONTHLY:
+            date = month.replace(day=day)
+            if start <= date <= end:
+                tx_type = 'income' if amount > 0 else 'expense'
+                profile = profile_ids[1] if account == 4 else profile_ids[0]
+                yield (user_id, account_ids[account], profile, float(amount), tx_type, category,
+                       description, 0 if tx_type == 'income' else 1, date.isoformat())
+
+    count = int(per_month * days / 30.4)
+    for _ in range(count):
+        category = rng.choices(categories, weights)[0]
+        _, _, median, descriptions = by_category[category]
+        amount = -round(math.exp(rng.gauss(math.log(median), 0.6)), 2)
+        date = start + datetime.timedelta(days=rng.randrange(days))
+        shared = rng.random() < 0.3
+        profile = None if shared else rng.choice(profile_ids)
+        yield (user_id, rng.choice(spending_accounts), profile, amount, 'expense', category,
+               rng.choice(descriptions), int(shared), date.isoformat())
+
+
+def generate(path, users=10, years=3, per_month=120, seed=42, end=None):
+    # Appends `users` synthetic users (user<N>/password) to the database at
+    # `path`, creating the schema first if needed. Returns row counts.
+    rng = random.Random(seed)
+    end = end or datetime.date.today()
+    start = end.replace(year=end.year - years)
+
+    conn = db.connect(path)
+    migrations.upgrade(conn)
+    cursor = conn.cursor()
+    offset = cursor.execute("SELECT COUNT(*) FROM users WHERE username LIKE 'user%'").fetchone()[0]
+    first_id = search.last_id(cursor)
+
+    total = 0
+    batch = []
+    new_users = []
+    for n in range(offset, offset + users):
+        cursor.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                       ('user%d' % n, 'user%d@example.com' % n, 'password'))
+        user_id = cursor.lastrowid
+        new_users.append(user_id)
+
+        profile_ids = []
+        for name, kind in (('Primary %d' % n, 'primary'), ('Spouse %d' % n, 'spouse')):
+            cursor.execute("INSERT INTO profiles (user_id, name, type, is_active) VALUES (?, ?, ?, 1)",
+                           (user_id, name, kind))
+            profile_ids.append(cursor.lastrowid)
+
+        account_ids = []
+        for name, kind, balance in ACCOUNTS:
+            cursor.execute("INSERT INTO accounts (user_id, name, type, balance, opening_balance) VALUES (?, ?, ?, ?, ?)",
+                           (user_id, name, kind, balance, balance))
+            account_ids.append(cursor.lastrowid)
+
+        for month in _month_starts(start, end):
+            month_start, month_end = budgeting.period_window('monthly', month)
+            cursor.executemany(
+                "INSERT INTO budgets (user_id, category, amount, period, start_date, end_date) VALUES (?, ?, ?, 'monthly', ?, ?)",
+                [(user_id, category, amount, month_start, month_end) for category, amount in BUDGET_CATEGORIES]
+            )
+
+        for row in _transactions(rng, user_id, account_ids, profile_ids, start, end, per_month):
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                _flush(cursor, batch)
+                total += len(batch)
+                batch = []
+    if batch:
+        _flush(cursor, batch)
+        total += len(batch)
+    search.index_after(cursor, first_id)
+    conn.commit()
+
+    # Derived state for the new users is rebuilt in bulk rather than
+    # maintained row by row
+    for user_id in new_users:
+        totals = cursor.execute(
+            "SELECT SUM(amount), account_id FROM transactions WHERE user_id = ? GROUP BY account_id", (user_id,)
+        ).fetchall()
+        cursor.executemany("UPDATE accounts SET balance = balance + ? WHERE id = ?", [tuple(row) for row in totals])
+        budgeting.recompute_user(cursor, user_id)
+        conn.commit()
+        rollups.rebuild(conn, user_id)
+        balances.rebuild(conn, user_id)
+    conn.execute("ANALYZE")
+    conn.close()
+    return {'users': users, 'transactions': total}
+
+
+def _flush(cursor, rows):
+    cursor.executemany(
+        "INSERT INTO transactions (user_id, account_id, profile_id, amount, type, category, description, is_shared, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
@@ -0,0 +1,219 @@
+import datetime
+import http.client
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Per-endpoint load harness. Every scenario is run on its own at a fixed
+# concurrency so the numbers attribute latency to one route, either
+# in-process through Flask's test client or over HTTP against a running
+# server. Results are plain dicts that serialize to the baseline file.
+
+PERCENTILES = (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99))
+
+
+class InProcessClient:
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers or {})
+        data = response.get_data()
+        return response.status_code, data
+
+
+class HttpClient:
+    # One keep-alive connection per thread
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.connection_class(self.host, self.port, timeout=60)
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, path, payload, headers)
+            response = conn.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+class Session:
+    # A logged-in synthetic user and the ids scenarios need
+
+    def __init__(self, client, username, password='password'):
+        status, data = client.request('POST', '/api/login', {'username': username, 'password': password})
+        if status != 200:
+            raise RuntimeError('login failed for %s: %s' % (username, status))
+        self.username = username
+        self.headers = {'Authorization': 'Bearer ' + json.loads(data)['access_token']}
+        _, data = client.request('GET', '/api/profiles', headers=self.headers)
+        self.profile_ids = [profile['id'] for profile in json.loads(data)]
+        _, data = client.request('GET', '/api/accounts', headers=self.headers)
+        self.account_ids = [account['id'] for account in json.loads(data)]
+        _, data = client.request('GET', '/api/budgets', headers=self.headers)
+        self.budgets = json.loads(data)
+        self.spare_budget_ids = []  # made by _add_spare_budget for delete_budget
+
+
+def _today():
+    return datetime.date.today().isoformat()
+
+
+def _quarter_ago():
+    return (datetime.date.today() - datetime.timedelta(days=90)).isoformat()
+
+
+def _statement(session, rng, rows=50):
+    # A JSON statement of new rows; references keep them clear of dedupe
+    return [{'date': _today(), 'amount': -round(rng.uniform(10, 2000), 2), 'description': 'bench import',
+             'reference': 'B%016x' % rng.getrandbits(64), 'category': rng.choice(['Food', 'Shopping'])}
+            for _ in range(rows)]
+
+
+def _add_spare_budget(client, session, rng):
+    # A budget of its own for each delete_budget request; a new category, as
+    # add_budget updates an existing budget for the same category and period
+    _, data = client.request('POST', '/api/budgets', {'category': 'Bench %d' % rng.getrandbits(48), 'amount': 1000},
+                             session.headers)
+    session.spare_budget_ids.append(json.loads(data)['budget']['id'])
+
+
+# name -> (method, path(session, rng), body(session, rng) or None)
+SCENARIOS = {
+    'login': ('POST', lambda s, r: '/api/login',
+              lambda s, r: {'username': s.username, 'password': 'password'}),
+    'dashboard': ('GET', lambda s, r: '/api/dashboard', None),
+    'transactions': ('GET', lambda s, r: '/api/transactions', None),
+    'transactions.category': ('GET', lambda s, r: '/api/transactions?category=Food', None),
+    'transactions.date_range': ('GET', lambda s, r: '/api/transactions?start_date=%s&end_date=%s' % (_quarter_ago(), _today()), None),
+    'transactions.profile': ('GET', lambda s, r: '/api/transactions?profile_id=%d&show_shared=false' % r.choice(s.profile_ids), None),
+    'accounts': ('GET', lambda s, r: '/api/accounts', None),
+    'profiles': ('GET', lambda s, r: '/api/profiles', None),
+    'profile': ('GET', lambda s, r: '/api/profiles/%d' % r.choice(s.profile_ids), None),
+    'budgets': ('GET', lambda s, r: '/api/budgets', None),
+    'budgets.current': ('GET', lambda s, r: '/api/budgets?date=%s' % _today(), None),
+    'add_transaction': ('POST', lambda s, r: '/api/transactions',
+                        lambda s, r: {'account_id': r.choice(s.account_ids), 'amount': round(r.uniform(10, 2000), 2),
+                                      'type': 'expense', 'category': r.choice(['Food', 'Shopping', 'Transportation']),
+                                      'description': 'bench', 'date': _today()}),
+    'add_budget': ('POST', lambda s, r: '/api/budgets',
+                   lambda s, r: {'category': r.choice(['Food', 'Health', 'Travel']), 'amount': r.randrange(1000, 20000)}),
+    'update_profile': ('PUT', lambda s, r: '/api/profiles/%d' % s.profile_ids[0],
+                       lambda s, r: {'name': 'Primary', 'type': 'primary', 'is_active': 1}),
+    'add_profile': ('POST', lambda s, r: '/api/profiles',
+                    lambda s, r: {'name': 'Bench', 'type': 'secondary'}),
+    'update_budget': ('PUT', lambda s, r: '/api/budgets/%d' % s.budgets[0]['id'],
+                      lambda s, r: {'category': s.budgets[0]['category'], 'period': s.budgets[0]['period'],
+                                    'amount': r.randrange(1000, 20000)}),
+    'delete_budget': ('DELETE', lambda s, r: '/api/budgets/%d' % s.spare_budget_ids.pop(), None),
+    'import_transactions': ('POST', lambda s, r: '/api/transactions/import?format=json&account_id=%d'
+                            % r.choice(s.account_ids), _statement),
+}
+
+# name -> setup(client, session, rng) run before each request, outside its latency
+SETUP = {
+    'delete_budget': _add_spare_budget,
+}
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    result = {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+    for key, q in PERCENTILES:
+        result[key] = round(_percentile(ordered, q) * 1000, 3) if ordered else None
+    result['max_ms'] = round(ordered[-1] * 1000, 3) if ordered else None
+    return result
+
+
+def run_scenario(client, sessions, name, concurrency=8, requests=400, seed=0):
+    method, path_for, body_for = SCENARIOS[name]
+    per_thread = max(1, requests // concurrency)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        mine = []
+        failed = 0
+        for _ in range(per_thread):
+            session = rng.choice(sessions)
+            if name in SETUP:
+                SETUP[name](client, session, rng)
+            path = path_for(session, rng)
+            body = body_for(session, rng) if body_for else None
+            headers = session.headers if name != 'login' else None
+            started = time.perf_counter()
+            try:
+                status, _ = client.request(method, path, body, headers)
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - started
+            if status is not None and status < 400:
+                mine.append(elapsed)
+            else:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def run(client, usernames, scenarios=None, concurrency=8, requests=400, seed=0):
+    sessions = [Session(client, username) for username in usernames]
+    results = {}
+    for name in scenarios or SCENARIOS:
+        results[name] = run_scenario(client, sessions, name, concurrency, requests, seed)
+    return results
+
+
+def compare(baseline, current, tolerance=0.2):
+    # Regressions: p95 latency up, or throughput down, by more than tolerance
+    regressions = []
+    for name, base in baseline.items():
+        now = current.get(name)
+        if now is None or base.get('p95_ms') is None or now.get('p95_ms') is None:
+            continue
+        if now['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append('%s: p95 %.2fms -> %.2fms' % (name, base['p95_ms'], now['p95_ms']))
+        if now['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append('%s: throughput %.1f -> %.1f rps' % (name, base['throughput_rps'], now['throughput_rps']))
+        if now['errors'] > base['errors']:
+            regressions.append('%s: errors %d -> %d' % (name, base['errors'], now['errors']))
+    return regressions
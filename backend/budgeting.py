@@ -0,0 +1,67 @@
+import datetime
+from collections import defaultdict
+
+import archive
+
+# budgets.spent is maintained incrementally: every write path that adds
+# expense transactions calls record_spending() in the same SQL transaction,
+# and a budget is recomputed from the ledger only when its category or date
+# window changes. Reading budgets never touches transactions.
+
+
+def period_window(period, day):
+    # (start_date, end_date) of the weekly/monthly/yearly window containing
+    # `day`; anything unrecognized is treated as monthly.
+    if period == 'weekly':
+        start = day - datetime.timedelta(days=day.weekday())
+        end = day + datetime.timedelta(days=6 - day.weekday())
+    elif period == 'yearly':
+        start = day.replace(month=1, day=1)
+        end = day.replace(month=12, day=31)
+    else:
+        start = day.replace(day=1)
+        if day.month == 12:
+            end = day.replace(year=day.year + 1, month=1, day=1) - datetime.timedelta(days=1)
+        else:
+            end = day.replace(month=day.month + 1, day=1) - datetime.timedelta(days=1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+def record_spending(cursor, user_id, transactions, sign=1):
+    # transactions: iterable of (date, type, category, amount). Rows are
+    # summed per (category, date) first so a bulk import issues one UPDATE per
+    # distinct day and category rather than one per row.
+    totals = defaultdict(float)
+    for date, tx_type, category, amount in transactions:
+        if tx_type == 'expense':
+            totals[(category, date)] += sign * abs(amount)
+
+    cursor.executemany("""
+        UPDATE budgets SET spent = spent + ?
+        WHERE user_id = ? AND category = ? AND ? BETWEEN start_date AND end_date
+    """, [(spent, user_id, category, date) for (category, date), spent in totals.items()])
+
+
+_SPENT = """
+    SELECT COALESCE(SUM(ABS(t.amount)), 0)
+    FROM {transactions} t
+    WHERE t.user_id = budgets.user_id AND t.category = budgets.category
+        AND t.type = 'expense' AND t.date BETWEEN budgets.start_date AND budgets.end_date
+"""
+
+
+def _recompute_sql(cursor):
+    # With an archive attached each table is summed on its own: correlated
+    # through archive.source(), the subquery would scan both tables
+    if not archive.attached(cursor):
+        return "UPDATE budgets SET spent = (%s)" % _SPENT.format(transactions='transactions')
+    return "UPDATE budgets SET spent = (%s) + (%s)" % (_SPENT.format(transactions='main.transactions'),
+                                                      _SPENT.format(transactions='archive.transactions'))
+
+
+def recompute(cursor, budget_id):
+    cursor.execute(_recompute_sql(cursor) + " WHERE id = ?", (budget_id,))
+
+
+def recompute_user(cursor, user_id):
+    cursor.execute(_recompute_sql(cursor) + " WHERE user_id = ?", (user_id,))
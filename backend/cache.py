@@ -0,0 +1,209 @@
+import datetime
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from flask import Response, current_app, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+import db
+import encoding
+from db import get_db
+
+# Per-user response cache for read endpoints.
+#
+# Every write route bumps the user's row in user_versions inside its own SQL
+# transaction. The version is part of each cache key and ETag, so a write
+# invalidates everything cached for that user in every worker at once, and a
+# read costs one primary-key lookup plus a dictionary hit.
+
+# Headers worth replaying from a cached response (pagination cursors etc.)
+_SKIP_HEADERS = {'Content-Length', 'Content-Type', 'ETag'}
+
+
+def bump_version(cursor, user_id):
+    cursor.execute("""
+        INSERT INTO user_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1
+    """, (user_id,))
+
+
+def data_version(conn, user_id):
+    row = conn.execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+class MemoryStore:
+    # Bounded LRU local to one worker process. With max_bytes the response
+    # bodies (entry[0]) are also bounded by total size, and a body over
+    # max_body is not kept at all, so one large listing cannot push out
+    # everything else.
+
+    def __init__(self, max_entries=1024, max_bytes=None, max_body=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_body = max_body
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _size(self, entry):
+        return len(entry[0]) if self.max_bytes is not None or self.max_body is not None else 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        size = self._size(entry)
+        if self.max_body is not None and size > self.max_body:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= self._size(old)
+            self._entries[key] = entry
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and
+                                                            self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self._size(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class SqliteStore:
+    # Shared between workers on one host through a separate cache file.
+    # Entries for stale versions are never read again and age out by LRU.
+    # A hit only writes used_at back once it is touch_after seconds old, so a
+    # hot entry costs a write a minute rather than one per request.
+
+    def __init__(self, path, max_entries=10000, touch_after=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_after = touch_after
+        self._created = False
+
+    def _conn(self):
+        conn = db.thread_connection(self.path)
+        if not self._created:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                key TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                mimetype TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_used ON response_cache (used_at)")
+            conn.commit()
+            self._created = True
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("""
+            SELECT body, mimetype, headers, used_at < julianday('now') - ? / 86400.0 AS stale
+            FROM response_cache WHERE key = ?
+        """, (self.touch_after, key)).fetchone()
+        if row is None:
+            return None
+        if row['stale']:
+            conn.execute("UPDATE response_cache SET used_at = julianday('now') WHERE key = ?", (key,))
+            conn.commit()
+        return row['body'], row['mimetype'], _decode_headers(row['headers'])
+
+    def set(self, key, entry):
+        body, mimetype, headers = entry
+        conn = self._conn()
+        conn.execute("""
+            INSERT OR REPLACE INTO response_cache (key, body, mimetype, headers, used_at)
+            VALUES (?, ?, ?, ?, julianday('now'))
+        """, (key, body, mimetype, _encode_headers(headers)))
+        conn.execute("""
+            DELETE FROM response_cache WHERE key IN (
+                SELECT key FROM response_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+        conn.commit()
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM response_cache")
+        conn.commit()
+
+
+def _encode_headers(headers):
+    return '\n'.join('%s: %s' % item for item in headers)
+
+
+def _decode_headers(text):
+    return [tuple(line.split(': ', 1)) for line in text.splitlines()]
+
+
+def _request_key(user_id, version):
+    # Canonical query string so ?a=1&b=2 and ?b=2&a=1 share an entry. The date
+    # is included because the dashboard's "this month" window moves with it,
+    # the response format because it can be negotiated through Accept.
+    args = urlencode(sorted(request.args.items(multi=True)))
+    return '%s|%s|%s|%s|%s?%s' % (user_id, version, datetime.date.today().isoformat(),
+                                  encoding.response_format(), request.path, args)
+
+
+def cached(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        store = current_app.extensions.get('response_cache')
+        if store is None or request.args.get('stream'):
+            return view(*args, **kwargs)
+
+        user_id = get_jwt_identity()
+        key = _request_key(user_id, data_version(get_db(), user_id))
+        etag = hashlib.sha1(key.encode()).hexdigest()
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        entry = store.get(key)
+        if entry is not None:
+            body, mimetype, headers = entry
+            response = Response(body, mimetype=mimetype, headers=headers)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            headers = [item for item in response.headers.items() if item[0] not in _SKIP_HEADERS]
+            store.set(key, (response.get_data(), response.mimetype, headers))
+
+        response.set_etag(etag)
+        return response
+    return wrapper
+
+
+def init_app(app):
+    app.config.setdefault('RESPONSE_CACHE_BACKEND', 'memory')  # 'memory', 'sqlite' or None
+    app.config.setdefault('RESPONSE_CACHE_SIZE', 1024)
+    app.config.setdefault('RESPONSE_CACHE_BYTES', 64 * 1024 * 1024)  # memory backend, all bodies
+    app.config.setdefault('RESPONSE_CACHE_MAX_BODY', 1024 * 1024)     # memory backend, one body
+    app.config.setdefault('RESPONSE_CACHE_PATH', None)
+
+    backend = app.config['RESPONSE_CACHE_BACKEND']
+    if backend == 'memory':
+        app.extensions['response_cache'] = MemoryStore(app.config['RESPONSE_CACHE_SIZE'],
+                                                       app.config['RESPONSE_CACHE_BYTES'],
+                                                       app.config['RESPONSE_CACHE_MAX_BODY'])
+    elif backend == 'sqlite':
+        path = app.config['RESPONSE_CACHE_PATH'] or os.path.splitext(app.config['DATABASE'])[0] + '-cache.db'
+        app.extensions['response_cache'] = SqliteStore(path, app.config['RESPONSE_CACHE_SIZE'])
@@ -0,0 +1,205 @@
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, has_app_context, jsonify, request
+from flask_jwt_extended import get_jwt_identity
+
+import instrumentation
+
+# Connection tuning applied once per connection, not per request.
+# WAL lets readers (dashboard, listings) run while add_transaction writes.
+# SQLITE_PRAGMAS in the app config overrides individual entries. The
+# defaults here are never modified, so apps in one process keep their own.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',   # safe with WAL, fsync only at checkpoints
+    'cache_size': -20000,      # ~20MB page cache per connection
+    'mmap_size': 268435456,    # 256MB memory-mapped reads
+    'temp_store': 'MEMORY',
+}
+
+BUSY_TIMEOUT = 5.0
+STATEMENT_CACHE_SIZE = 256
+QUERY_TIMEOUT = 15           # seconds of SQL a request may run; see set_deadline()
+DEADLINE_CHECK_STEPS = 10000  # SQLite VM instructions between deadline checks
+
+_local = threading.local()
+
+
+def connect(path, config=None):
+    # Settings come from `config`, else the current app's config; threads
+    # outside an app context (writer, scheduler) pass their app's config.
+    if config is None:
+        config = current_app.config if has_app_context() else {}
+    conn = sqlite3.connect(path, timeout=config.get('SQLITE_BUSY_TIMEOUT', BUSY_TIMEOUT),
+                           cached_statements=STATEMENT_CACHE_SIZE, factory=instrumentation.InstrumentedConnection)
+    conn.row_factory = sqlite3.Row
+    instrumentation.configure(conn, config)
+    for name, value in dict(PRAGMAS, **(config.get('SQLITE_PRAGMAS') or {})).items():
+        conn.execute("PRAGMA %s = %s" % (name, value))
+    conn.set_progress_handler(_past_deadline, DEADLINE_CHECK_STEPS)
+    attach_archive(conn, path)
+    return conn
+
+
+# Per-route query timeouts. A request sets a deadline for its thread; every
+# connection's progress handler checks it, and a statement still running past
+# it is aborted with OperationalError('interrupted'), which the app answers
+# with a 503. Threads without a deadline (the writer, the scheduler) are never
+# interrupted. The deadline covers the view, not a streamed body after it.
+
+def _past_deadline():
+    deadline = getattr(_local, 'deadline', None)
+    return deadline is not None and time.monotonic() > deadline
+
+
+def set_deadline(seconds):
+    _local.deadline = time.monotonic() + seconds if seconds else None
+
+
+def route_timeout(endpoint):
+    config = current_app.config
+    return config['ROUTE_TIMEOUTS'].get(endpoint, config['QUERY_TIMEOUT'])
+
+
+def _start_deadline():
+    set_deadline(route_timeout(request.endpoint))
+
+
+def _end_deadline(response):
+    set_deadline(None)
+    return response
+
+
+def _interrupted(exc):
+    if str(exc) != 'interrupted':
+        raise exc
+    current_app.logger.warning('%s %s interrupted after its query timeout', request.method, request.path)
+    return jsonify({"msg": "The request took too long, try a smaller date range"}), 503
+
+
+def thread_connection(path):
+    # One long-lived connection per (thread, process, database). The pid check
+    # means a connection inherited across a fork (gunicorn preload) is never
+    # reused by the child; SQLite handles must not cross process boundaries.
+    connections = getattr(_local, 'connections', None)
+    pid = os.getpid()
+    if connections is None or getattr(_local, 'pid', None) != pid:
+        connections = _local.connections = {}
+        _local.pid = pid
+
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = connect(path)
+    else:
+        attach_archive(conn, path)  # `flask archive run` may have created it since
+    return conn
+
+
+# Transactions older than the archive horizon live in a second file next to
+# each database, attached to every connection as schema "archive" once it
+# exists (see archive.py). ATTACH is not allowed inside a transaction, so it
+# happens when a connection is opened or handed out between requests.
+
+def archive_path(path):
+    root, ext = os.path.splitext(path)
+    return root + '-archive' + ext
+
+
+def attach_archive(conn, path):
+    if getattr(conn, 'archive_columns', None) or conn.in_transaction:
+        return
+    if os.path.exists(archive_path(path)):
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(path),))
+        conn.archive_columns = [row[1] for row in conn.execute("PRAGMA archive.table_info(transactions)")]
+
+
+# Optional sharding. With SHARDS = N > 0, DATABASE is only the catalog
+# (users and login) and each user's rows live in shard user_id % N, a file of
+# its own under SHARD_DIR. Every file carries the full schema, so a shard is
+# just a smaller fintrack.db and writes to different shards never share a lock.
+# N is fixed once data has been split (`flask shards split`).
+
+def shard_path(config, index):
+    directory = config.get('SHARD_DIR') or os.path.join(os.path.dirname(config['DATABASE']), 'shards')
+    return os.path.join(directory, 'shard-%02d.db' % index)
+
+
+def shard_of(user_id, count):
+    return int(user_id) % count
+
+
+def user_database(config, user_id):
+    if not config.get('SHARDS'):
+        return config['DATABASE']
+    return shard_path(config, shard_of(user_id, config['SHARDS']))
+
+
+def database_paths(config):
+    # The catalog first, then every shard
+    return [config['DATABASE']] + [shard_path(config, index) for index in range(config.get('SHARDS') or 0)]
+
+
+def request_database():
+    # The signed-in user's database; the catalog for routes without a JWT
+    config = current_app.config
+    if config['SHARDS']:
+        try:
+            user_id = get_jwt_identity()
+        except RuntimeError:  # not a @jwt_required route
+            user_id = None
+        if user_id is not None:
+            return user_database(config, user_id)
+    return config['DATABASE']
+
+
+def get_db():
+    if 'db' not in g:
+        g.db = thread_connection(request_database())
+    return g.db
+
+
+def get_catalog():
+    if 'catalog' not in g:
+        g.catalog = thread_connection(current_app.config['DATABASE'])
+    return g.catalog
+
+
+def tuple_cursor(conn):
+    # Rows come back as plain tuples instead of sqlite3.Row, for routes that
+    # hand them straight to the encoder (see encoding.rows_response)
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor
+
+
+def close_thread_connections():
+    connections = getattr(_local, 'connections', None) or {}
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+
+def _release_db(exc):
+    # The connections go back to the thread cache; never leave a request's
+    # half-finished transaction (or its locks) behind for the next one.
+    set_deadline(None)
+    for name in ('db', 'catalog'):
+        conn = g.pop(name, None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+
+def init_app(app):
+    app.config.setdefault('SQLITE_PRAGMAS', {})
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', BUSY_TIMEOUT)
+    app.config.setdefault('SHARDS', 0)
+    app.config.setdefault('SHARD_DIR', None)
+    app.config.setdefault('QUERY_TIMEOUT', QUERY_TIMEOUT)  # None or 0: no limit
+    app.config.setdefault('ROUTE_TIMEOUTS', {})  # endpoint -> seconds, e.g. {'api.get_analytics': 30}
+    app.before_request(_start_deadline)
+    app.after_request(_end_deadline)
+    app.register_error_handler(sqlite3.OperationalError, _interrupted)
+    app.teardown_appcontext(_release_db)
@@ -0,0 +1,54 @@
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib encoder is the fallback
+    orjson = None
+
+# Response encoding for list endpoints.
+#
+# Routes fetch plain tuples (db.tuple_cursor) and pass the column names once,
+# so rows are never wrapped in sqlite3.Row and, in the columnar layout, never
+# copied into per-row dicts. Clients choose the layout with ?format=columnar
+# or by accepting COLUMNAR_MIMETYPE:
+#
+#     {"columns": ["id", "amount", ...], "rows": [[1, -250.0, ...], ...]}
+
+JSON_MIMETYPE = 'application/json'
+COLUMNAR_MIMETYPE = 'application/vnd.fintrack.columnar+json'
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def columns(cursor):
+    return [column[0] for column in cursor.description]
+
+
+def response_format():
+    # 'columnar' or 'records' (a list of objects, the default)
+    fmt = request.args.get('format')
+    if fmt in ('columnar', 'records'):
+        return fmt
+    best = request.accept_mimetypes.best_match([JSON_MIMETYPE, COLUMNAR_MIMETYPE])
+    return 'columnar' if best == COLUMNAR_MIMETYPE else 'records'
+
+
+def json_response(obj, status=200):
+    return Response(dumps(obj), status=status, mimetype=JSON_MIMETYPE)
+
+
+def rows_response(names, rows):
+    if response_format() == 'columnar':
+        response = Response(dumps({'columns': names, 'rows': rows}), mimetype=COLUMNAR_MIMETYPE)
+    else:
+        response = Response(dumps([dict(zip(names, row)) for row in rows]), mimetype=JSON_MIMETYPE)
+    response.vary.add('Accept')
+    return response
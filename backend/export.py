@@ -0,0 +1,232 @@
+import csv
+import datetime
+import io
+import sys
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import archive
+import db
+import encoding
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional; only Parquet exports need it
+    pyarrow = None
+
+# Full-history transaction export in constant memory.
+#
+# Rows are read in keyset chunks ordered by (date, id), each chunk its own
+# short query, so an export never holds a read snapshot open for its whole
+# duration (which would stop WAL checkpoints) and never has more than one
+# chunk in memory. Each chunk is encoded and, for CSV and JSON Lines,
+# gzip-compressed as it goes out. Parquet is written one row group at a time
+# and carries its own compression.
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+CHUNK_SIZE = 5000
+PARQUET_ROW_GROUP = 50000
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+COLUMNS = ('id', 'date', 'amount', 'type', 'category', 'description', 'account_name', 'profile_name', 'is_shared')
+
+
+class ExportError(ValueError):
+    pass
+
+
+def _chunks(conn, user_id, filters, chunk_size=CHUNK_SIZE):
+    # filters: dict of optional start_date, end_date, profile_id, category,
+    # account_id; show_shared as in the transaction listing
+    query = """
+        SELECT t.id, t.date, t.amount, t.type, t.category, t.description,
+               a.name as account_name, p.name as profile_name, t.is_shared
+        FROM {transactions} t
+        JOIN accounts a ON t.account_id = a.id
+        LEFT JOIN profiles p ON t.profile_id = p.id
+        WHERE t.user_id = ?
+    """
+    params = [user_id]
+
+    profile_id = filters.get('profile_id')
+    show_shared = filters.get('show_shared', True)
+    if profile_id is not None:
+        query += " AND (t.profile_id = ? OR (t.is_shared = 1 AND ?))"
+        params.extend([profile_id, show_shared])
+    elif not show_shared:
+        query += " AND t.is_shared = 0"
+    for column in ('category', 'account_id'):
+        if filters.get(column) is not None:
+            query += " AND t.%s = ?" % column
+            params.append(filters[column])
+    if filters.get('start_date'):
+        query += " AND t.date >= ?"
+        params.append(filters['start_date'])
+    if filters.get('end_date'):
+        query += " AND t.date < date(?, '+1 day')"
+        params.append(filters['end_date'])
+
+    def chunk(sql, values):
+        # Archived years first, merged with the hot table by (date, id)
+        sql, values = archive.union(conn, sql, values, filters.get('start_date'))
+        return cursor.execute(sql + " ORDER BY t.date, t.id LIMIT ?", values + [chunk_size]).fetchall()
+
+    cursor = db.tuple_cursor(conn)
+    rows = chunk(query, params)
+    while rows:
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
+        rows = chunk(query + " AND (t.date, t.id) > (?, ?)", params + [last[1], last[0]])
+
+
+def _csv(chunks):
+    buffer = io.StringIO()
+    out = csv.writer(buffer)
+    out.writerow(COLUMNS)
+    for rows in chunks:
+        out.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # header of an empty export
+        yield buffer.getvalue().encode()
+
+
+def _jsonl(chunks):
+    for rows in chunks:
+        yield b''.join(encoding.dumps(dict(zip(COLUMNS, row))) + b'\n' for row in rows)
+
+
+class _Sink:
+    # Write-only file object for ParquetWriter; bytes are taken out after
+    # every row group instead of accumulating in one buffer
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _parquet_schema():
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('date', pyarrow.string()),
+        ('amount', pyarrow.float64()),
+        ('type', pyarrow.string()),
+        ('category', pyarrow.string()),
+        ('description', pyarrow.string()),
+        ('account_name', pyarrow.string()),
+        ('profile_name', pyarrow.string()),
+        ('is_shared', pyarrow.bool_()),
+    ])
+
+
+def _parquet(chunks):
+    schema = _parquet_schema()
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+
+    def row_group(rows):
+        columns = [list(column) for column in zip(*rows)]
+        columns[-1] = [bool(value) for value in columns[-1]]
+        writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+        return sink.take()
+
+    pending = []
+    for rows in chunks:
+        pending.extend(rows)
+        if len(pending) >= PARQUET_ROW_GROUP:
+            yield row_group(pending)
+            pending = []
+    if pending:
+        yield row_group(pending)
+    writer.close()
+    yield sink.take()
+
+
+def _gzip(parts):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for part in parts:
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def check_format(fmt, compress=False):
+    if fmt not in FORMATS:
+        raise ExportError('format must be one of %s' % ', '.join(FORMATS))
+    if fmt == 'parquet' and pyarrow is None:
+        raise ExportError('Parquet export needs pyarrow installed on the server')
+    if fmt == 'parquet' and compress:
+        raise ExportError('Parquet files are already compressed; drop gzip')
+
+
+def generate(conn, user_id, fmt, filters, compress=False):
+    # Iterator of bytes; call check_format() first
+    encoder = {'csv': _csv, 'jsonl': _jsonl, 'parquet': _parquet}[fmt]
+    parts = encoder(_chunks(conn, user_id, filters))
+    return _gzip(parts) if compress else parts
+
+
+def filename(fmt, compress=False):
+    return 'transactions-%s.%s%s' % (datetime.date.today().strftime('%Y%m%d'), fmt, '.gz' if compress else '')
+
+
+@click.command('export')
+@click.option('--user-id', type=int, required=True)
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), default=None,
+              help='File to write; standard output by default.')
+@click.option('--gzip', 'compress', is_flag=True, help='gzip-compress CSV or JSON Lines output.')
+@click.option('--start-date', default=None)
+@click.option('--end-date', default=None)
+@click.option('--profile-id', type=int, default=None)
+@click.option('--account-id', type=int, default=None)
+@with_appcontext
+def export_command(user_id, fmt, output, compress, start_date, end_date, profile_id, account_id):
+    try:
+        check_format(fmt, compress)
+    except ExportError as exc:
+        raise click.ClickException(str(exc))
+    filters = {'start_date': start_date, 'end_date': end_date, 'profile_id': profile_id, 'account_id': account_id}
+    conn = db.connect(db.user_database(current_app.config, user_id), current_app.config)
+    out = open(output, 'wb') if output else sys.stdout.buffer
+    try:
+        for part in generate(conn, user_id, fmt, filters, compress):
+            out.write(part)
+    finally:
+        if output:
+            out.close()
+        conn.close()
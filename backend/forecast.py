@@ -0,0 +1,416 @@
+import calendar
+import datetime
+import logging
+import math
+import re
+import time
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+
+import analytics
+import archive
+import budgeting
+import db
+import refdata
+
+# Recurring transactions and the cash-flow forecast (migration 13).
+#
+# Detection runs in batch, never on a request: refresh() loads the last
+# LOOKBACK_DAYS of transactions for a batch of users in one query and finds
+# the recurring series of all of them with NumPy, then stores the series and
+# their projected occurrences (forecast_flows) for the next HORIZON_DAYS.
+# GET /api/forecast only reads those rows and today's balances.
+#
+# A series is a run of transactions with the same user, account, direction
+# and pattern: the description lower-cased with digits, punctuation and month
+# names removed ("NEFT-12345-RENT APR" and "NEFT-12377-RENT MAY" are both
+# "neft rent"), or for rows without a description the category plus an amount
+# band. It is recurring when the median gap between occurrences matches a
+# cadence, most gaps agree with it, the amounts stay close to their median
+# and it has not lapsed.
+#
+# forecast_state records the data version each user was computed at. The
+# scheduler recomputes users whose version has moved every few minutes
+# (forecast.refresh) and everybody nightly (forecast.rebuild), since
+# projections also move with the calendar.
+
+logger = logging.getLogger('fintrack.forecast')
+
+LOOKBACK_DAYS = 1100
+HORIZON_DAYS = 92
+DEFAULT_DAYS = 30
+USERS_PER_BATCH = 200
+MIN_OCCURRENCES = 3
+MIN_REGULARITY = 0.6   # share of gaps that match the cadence
+MAX_DISPERSION = 0.5   # median absolute deviation of amounts / median amount
+RECENT = 3             # projected amount: median of the last few occurrences
+
+# (name, days, tolerance in days, calendar months per step)
+CADENCES = (
+    ('weekly', 7, 1, 0),
+    ('biweekly', 14, 2, 0),
+    ('monthly', 30.44, 4, 1),
+    ('quarterly', 91.31, 10, 3),
+    ('yearly', 365.25, 20, 12),
+)
+_CADENCE_DAYS = np.array([cadence[1] for cadence in CADENCES])
+_CADENCE_TOLERANCE = np.array([cadence[2] for cadence in CADENCES])
+
+_MONTH_WORDS = {'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+                'january', 'february', 'march', 'april', 'june', 'july', 'august', 'september', 'october',
+                'november', 'december'}
+_NON_LETTERS = re.compile(r'[^a-z]+')
+
+
+class ForecastError(ValueError):
+    pass
+
+
+def pattern(description, category, amount):
+    words = [word for word in _NON_LETTERS.split((description or '').lower())
+             if word and word not in _MONTH_WORDS]
+    if words:
+        return ' '.join(words)
+    # No usable description: bills of one category told apart by size
+    return '#%s|%d' % (category or '', round(math.log(max(abs(amount), 1.0)) / math.log(1.3)))
+
+
+def _group_median(groups, values, counts):
+    # Median of `values` per group id in `groups` (0..len(counts)-1); NaN for
+    # empty groups
+    order = np.lexsort((values, groups))
+    ordered = values[order].astype(np.float64)
+    offsets = np.cumsum(counts) - counts
+    medians = np.full(len(counts), np.nan)
+    present = counts > 0
+    low = offsets[present] + (counts[present] - 1) // 2
+    high = offsets[present] + counts[present] // 2
+    medians[present] = (ordered[low] + ordered[high]) / 2
+    return medians
+
+
+def detect(user, account, expense, key, day, paise, today):
+    # Parallel arrays, one entry per transaction (day: days since the epoch,
+    # paise: signed integer amount). Returns a dict of arrays with one entry
+    # per recurring series found, `row` being the index of its last
+    # transaction in the input.
+    row = np.lexsort((day, key, expense, account, user))
+    user, account, expense, key, day, paise = (column[row] for column in (user, account, expense, key, day, paise))
+
+    starts = np.ones(len(row), dtype=bool)
+    starts[1:] = ((user[1:] != user[:-1]) | (account[1:] != account[:-1]) |
+                  (expense[1:] != expense[:-1]) | (key[1:] != key[:-1]))
+    # Several on one day count as one occurrence
+    keep = starts.copy()
+    keep[1:] |= day[1:] != day[:-1]
+    row, user, account, expense, key, day, paise, starts = (
+        column[keep] for column in (row, user, account, expense, key, day, paise, starts))
+    if not len(row):
+        return None
+
+    group = np.cumsum(starts) - 1
+    counts = np.bincount(group)
+    last = np.cumsum(counts) - 1
+
+    same = group[1:] == group[:-1]
+    gaps = (day[1:] - day[:-1])[same]
+    gap_group = group[1:][same]
+    gap_counts = counts - 1
+    median_gap = _group_median(gap_group, gaps, gap_counts)
+
+    distance = np.abs(median_gap[:, None] - _CADENCE_DAYS[None, :])
+    matches = distance <= _CADENCE_TOLERANCE[None, :]
+    cadence = np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+
+    expected = _CADENCE_DAYS[cadence[gap_group]]
+    on_time = (cadence[gap_group] >= 0) & (np.abs(gaps - expected) <= _CADENCE_TOLERANCE[cadence[gap_group]])
+    regularity = np.bincount(gap_group, weights=on_time, minlength=len(counts)) / np.maximum(gap_counts, 1)
+
+    median_amount = _group_median(group, paise, counts)
+    deviation = _group_median(group, np.abs(paise - median_amount[group]), counts)
+    dispersion = deviation / np.maximum(np.abs(median_amount), 1)
+
+    rank = np.arange(len(row)) - (last - counts + 1)[group]
+    recent = rank > counts[group] - 1 - RECENT
+    amount = _group_median(group[recent], paise[recent], np.bincount(group[recent], minlength=len(counts)))
+
+    lapses = day[last] + _CADENCE_DAYS[cadence] * 2 + _CADENCE_TOLERANCE[cadence]
+    found = ((counts >= MIN_OCCURRENCES) & (cadence >= 0) & (regularity >= MIN_REGULARITY) &
+             (dispersion <= MAX_DISPERSION) & (lapses >= today))
+    return {
+        'row': row[last][found],
+        'cadence': cadence[found],
+        'count': counts[found],
+        'first_day': day[last - counts + 1][found],
+        'last_day': day[last][found],
+        'interval': median_gap[found],
+        'amount': amount[found] / 100.0,
+        'confidence': np.clip(regularity * (1 - dispersion), 0, 1)[found],
+    }
+
+
+def _add_months(day, months):
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    return datetime.date(year, month + 1, min(day.day, calendar.monthrange(year, month + 1)[1]))
+
+
+def occurrences(last_date, cadence, today, until):
+    # Projected dates after last_date up to until. One that is a little
+    # overdue (within the cadence's tolerance) is still expected, today.
+    name, days, tolerance, months = CADENCES[cadence]
+    dates = []
+    step = 1
+    while True:
+        if months:
+            date = _add_months(last_date, months * step)
+        else:
+            date = last_date + datetime.timedelta(days=int(days) * step)
+        if date > until:
+            return dates
+        if date >= today - datetime.timedelta(days=tolerance):
+            dates.append(max(date, today))
+        step += 1
+
+
+def _epoch_day(date):
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+def _compute(conn, user_ids, today):
+    # Series and flows for a batch of users; nothing is written here
+    since = (today - datetime.timedelta(days=LOOKBACK_DAYS)).isoformat()
+    placeholders = ','.join('?' * len(user_ids))
+    cursor = db.tuple_cursor(conn)
+    cursor.execute("""
+        SELECT user_id, account_id, type, date, amount, category, description
+        FROM {transactions}
+        WHERE user_id IN ({placeholders}) AND date >= ?
+    """.format(transactions=archive.source(conn), placeholders=placeholders), list(user_ids) + [since])
+    rows = cursor.fetchall()
+    days, valid = analytics.epoch_days([row[3] for row in rows])
+    if not valid.all():
+        rows = [row for row, ok in zip(rows, valid) if ok]
+        days = days[valid]
+    if not rows:
+        return [], []
+
+    patterns = {}
+    keys = {}
+    key = np.empty(len(rows), dtype=np.int64)
+    for index, (_, _, _, _, amount, category, description) in enumerate(rows):
+        text = patterns.get((description, category)) if description else None
+        if text is None:
+            text = pattern(description, category, amount)
+            if description:
+                patterns[(description, category)] = text
+        key[index] = keys.setdefault(text, len(keys))
+    names = list(keys)
+
+    count = len(rows)
+    found = detect(
+        np.fromiter((row[0] for row in rows), dtype=np.int64, count=count),
+        np.fromiter((row[1] for row in rows), dtype=np.int64, count=count),
+        np.fromiter((row[2] == 'expense' for row in rows), dtype=bool, count=count),
+        key,
+        days,
+        np.rint(np.fromiter((row[4] for row in rows), dtype=np.float64, count=count) * 100).astype(np.int64),
+        _epoch_day(today),
+    )
+    if found is None:
+        return [], []
+
+    epoch = datetime.date(1970, 1, 1)
+    until = today + datetime.timedelta(days=HORIZON_DAYS)
+    series = []
+    flows = []
+    for index in range(len(found['row'])):
+        user_id, account_id, tx_type, _, _, category, description = rows[found['row'][index]]
+        cadence = int(found['cadence'][index])
+        last_date = epoch + datetime.timedelta(days=int(found['last_day'][index]))
+        dates = occurrences(last_date, cadence, today, until)
+        amount = round(float(found['amount'][index]), 2)
+        series.append({
+            'user_id': user_id, 'account_id': account_id, 'type': tx_type, 'category': category,
+            'description': description, 'pattern': names[key[found['row'][index]]],
+            'cadence': CADENCES[cadence][0], 'interval_days': float(found['interval'][index]),
+            'amount': amount, 'occurrences': int(found['count'][index]),
+            'first_date': (epoch + datetime.timedelta(days=int(found['first_day'][index]))).isoformat(),
+            'last_date': last_date.isoformat(), 'next_date': dates[0].isoformat() if dates else None,
+            'confidence': round(float(found['confidence'][index]), 2),
+        })
+        flows.append([(user_id, date.isoformat(), account_id, amount) for date in dates])
+    return series, flows
+
+
+def _compute_each(conn, user_ids, today):
+    # _compute() a user at a time; users that fail are logged and left out,
+    # so they stay stale and are retried by the next refresh
+    done, series, flows = [], [], []
+    for user_id in user_ids:
+        try:
+            found, projected = _compute(conn, [user_id], today)
+        except Exception:
+            logger.exception('forecast for user %s failed', user_id)
+            continue
+        done.append(user_id)
+        series.extend(found)
+        flows.extend(projected)
+    return done, series, flows
+
+
+def _store(conn, user_ids, versions, series, flows):
+    placeholders = ','.join('?' * len(user_ids))
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute("DELETE FROM forecast_flows WHERE user_id IN (%s)" % placeholders, list(user_ids))
+        cursor.execute("DELETE FROM recurring_series WHERE user_id IN (%s)" % placeholders, list(user_ids))
+        first = cursor.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM recurring_series").fetchone()[0]
+        cursor.executemany("""
+            INSERT INTO recurring_series (id, user_id, account_id, type, category, description, pattern, cadence,
+                interval_days, amount, occurrences, first_date, last_date, next_date, confidence)
+            VALUES (:id, :user_id, :account_id, :type, :category, :description, :pattern, :cadence,
+                :interval_days, :amount, :occurrences, :first_date, :last_date, :next_date, :confidence)
+        """, [dict(item, id=first + index) for index, item in enumerate(series)])
+        cursor.executemany("""
+            INSERT OR IGNORE INTO forecast_flows (user_id, date, series_id, account_id, amount)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(user_id, date, first + index, account_id, amount)
+              for index, dates in enumerate(flows) for user_id, date, account_id, amount in dates])
+        cursor.executemany("""
+            INSERT INTO forecast_state (user_id, version, series, computed_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET
+                version = excluded.version, series = excluded.series, computed_at = excluded.computed_at
+        """, [(user_id, versions.get(user_id, 0), sum(1 for item in series if item['user_id'] == user_id))
+              for user_id in user_ids])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def stale_users(conn):
+    # Users whose data changed since their forecast was computed
+    return [row[0] for row in conn.execute("""
+        SELECT DISTINCT a.user_id FROM accounts a
+        LEFT JOIN user_versions v ON v.user_id = a.user_id
+        LEFT JOIN forecast_state f ON f.user_id = a.user_id
+        WHERE f.user_id IS NULL OR f.version < COALESCE(v.version, 0)
+    """)]
+
+
+def refresh(conn, user_ids=None, today=None, batch_size=USERS_PER_BATCH):
+    # Recompute the given users (default: everybody) a batch at a time.
+    # Returns (users, series).
+    today = today or datetime.date.today()
+    if user_ids is None:
+        user_ids = [row[0] for row in conn.execute("SELECT DISTINCT user_id FROM accounts")]
+    found = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        # Versions first: a write landing during the batch leaves its user
+        # stale, to be picked up by the next refresh
+        placeholders = ','.join('?' * len(batch))
+        versions = dict(conn.execute("SELECT user_id, version FROM user_versions WHERE user_id IN (%s)"
+                                     % placeholders, batch).fetchall())
+        try:
+            series, flows = _compute(conn, batch, today)
+        except Exception:
+            # One user's data must not hold back the rest of the batch
+            batch, series, flows = _compute_each(conn, batch, today)
+            if not batch:
+                raise
+        _store(conn, batch, versions, series, flows)
+        found += len(series)
+    return len(user_ids), found
+
+
+def parse_args(args):
+    try:
+        days = int(args.get('days', DEFAULT_DAYS))
+    except ValueError:
+        raise ForecastError('days must be a number')
+    if not 1 <= days <= HORIZON_DAYS:
+        raise ForecastError('days must be between 1 and %d' % HORIZON_DAYS)
+    return {'days': days}
+
+
+def forecast(conn, user_id, days=DEFAULT_DAYS, today=None):
+    # Upcoming recurring flows and projected balances, from the stored series
+    today = today or datetime.date.today()
+    until = today + datetime.timedelta(days=days)
+    month_end = datetime.date.fromisoformat(budgeting.period_window('monthly', today)[1])
+
+    state = conn.execute("SELECT version, computed_at FROM forecast_state WHERE user_id = ?", (user_id,)).fetchone()
+    reference = refdata.load(conn, user_id)
+    flows = conn.execute("""
+        SELECT f.date, f.amount, f.account_id, s.id AS series_id, s.type, s.category, s.description,
+               s.cadence, s.confidence
+        FROM forecast_flows f
+        JOIN recurring_series s ON s.id = f.series_id
+        WHERE f.user_id = ? AND f.date >= ? AND f.date <= ?
+        ORDER BY f.date, s.id
+    """, (user_id, today.isoformat(), max(until, month_end).isoformat())).fetchall()
+
+    balances = {account_id: round(account[3], 2) for account_id, account in reference.accounts.items()}
+    balance = round(sum(balances.values()), 2)
+    upcoming = []
+    projected = dict(balances)
+    month_end_balance = balance
+    for flow in flows:
+        if flow['date'] <= month_end.isoformat():
+            month_end_balance += flow['amount']
+        if flow['date'] <= until.isoformat():
+            projected[flow['account_id']] = projected.get(flow['account_id'], 0) + flow['amount']
+            upcoming.append(dict(flow, account_name=reference.account_name(flow['account_id'])))
+
+    series = [dict(row, account_name=reference.account_name(row['account_id'])) for row in conn.execute("""
+        SELECT id, account_id, type, category, description, cadence, interval_days, amount, occurrences,
+               first_date, last_date, next_date, confidence
+        FROM recurring_series
+        WHERE user_id = ?
+        ORDER BY next_date IS NULL, next_date, id
+    """, (user_id,))]
+
+    return {
+        'as_of': today.isoformat(),
+        'until': until.isoformat(),
+        'computed_at': state['computed_at'] if state else None,
+        'stale': state is None or state['version'] < reference.version,
+        'balance': balance,
+        'projected_balance': round(sum(projected.values()), 2),
+        'month_end': {'date': month_end.isoformat(), 'balance': round(month_end_balance, 2)},
+        'accounts': [{'id': account_id, 'name': reference.account_name(account_id), 'balance': balances[account_id],
+                      'projected_balance': round(projected[account_id], 2)} for account_id in balances],
+        'upcoming': upcoming,
+        'series': series,
+    }
+
+
+cli = AppGroup('forecast', help='Detect recurring transactions and project cash flow.')
+
+
+@cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only recompute this user.')
+@click.option('--stale', is_flag=True, help='Only users whose data changed since the last run.')
+def rebuild_command(user_id, stale):
+    if user_id is not None:
+        paths = [db.user_database(current_app.config, user_id)]
+    else:
+        paths = db.database_paths(current_app.config)
+    started = time.perf_counter()
+    users = found = 0
+    for path in paths:
+        conn = db.connect(path)
+        if user_id is not None:
+            selected = [user_id]
+        else:
+            selected = stale_users(conn) if stale else None
+        counts = refresh(conn, selected)
+        conn.close()
+        users += counts[0]
+        found += counts[1]
+    click.echo('%d recurring series for %d users in %.1fs' % (found, users, time.perf_counter() - started))
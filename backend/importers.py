@@ -0,0 +1,373 @@
+import csv
+import datetime
+import functools
+import hashlib
+import json
+import re
+from collections import defaultdict
+
+import balances
+import budgeting
+import archive
+import cache
+import rollups
+import search
+import sync
+
+# Bank statement import: parsers turn an uploaded file into a stream of
+# normalized rows, and import_rows() writes them in batches inside a single
+# transaction. The import route reads the whole upload into parsed rows
+# before handing them to the writer, so reading from the client never
+# happens under the write lock.
+
+BATCH_SIZE = 1000
+DEFAULT_CATEGORY = 'Uncategorized'
+MAX_REPORTED_ERRORS = 20
+
+
+class StatementError(ValueError):
+    pass
+
+
+# Header aliases seen in statement exports of common Indian banks (HDFC,
+# ICICI, SBI, Axis, Kotak) plus a generic date/description/amount layout.
+# Headers are compared lower-cased with everything but letters stripped.
+HEADER_ALIASES = {
+    'date': ('date', 'txndate', 'transactiondate', 'trandate', 'valuedate', 'valuedt', 'postingdate'),
+    'description': ('narration', 'description', 'particulars', 'transactionremarks',
+                    'descriptiontransactionremarks', 'remarks', 'details'),
+    'debit': ('withdrawalamt', 'withdrawalamount', 'withdrawalamountinr', 'debit', 'debitamount', 'dr', 'withdrawal'),
+    'credit': ('depositamt', 'depositamount', 'depositamountinr', 'credit', 'creditamount', 'cr', 'deposit'),
+    'amount': ('amount', 'transactionamount', 'amountinr'),
+    'reference': ('chqrefno', 'refnochequeno', 'chequenumber', 'chqno', 'referenceno', 'refno', 'utr', 'reference'),
+    'type': ('type', 'drcr', 'transactiontype'),
+    'category': ('category',),
+}
+
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d/%m/%y', '%d-%m-%Y', '%d-%m-%y', '%d-%b-%Y', '%d-%b-%y',
+                '%d %b %Y', '%d %b %y', '%d.%m.%Y', '%Y%m%d')
+
+
+def _header_key(name):
+    return re.sub(r'[^a-z]', '', (name or '').lower())
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(value):
+    # A year of statement lines only has ~365 distinct dates, so the cache
+    # turns strptime from the dominant import cost into a dict lookup.
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        try:
+            return datetime.date.fromisoformat(value).isoformat()
+        except ValueError:
+            pass
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    raise StatementError('unrecognized date %r' % value)
+
+
+def parse_date(value):
+    return _parse_date((value or '').strip())
+
+
+def is_iso_date(value):
+    # The stored form: YYYY-MM-DD, optionally followed by a time
+    if not isinstance(value, str) or len(value) < 10 or value[4] != '-' or value[7] != '-':
+        return False
+    try:
+        datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+
+def parse_amount(value):
+    # Handles Indian digit grouping (1,23,456.78), currency marks, trailing
+    # Dr/Cr and accounting-style parentheses. Returns None for blank cells.
+    text = (value or '').strip().replace(',', '').replace('₹', '').replace('INR', '').strip()
+    if not text:
+        return None
+    sign = 1
+    if text.startswith('(') and text.endswith(')'):
+        sign, text = -1, text[1:-1]
+    suffix = text[-2:].lower()
+    if suffix in ('dr', 'cr'):
+        sign = -1 if suffix == 'dr' else sign
+        text = text[:-2].strip()
+    try:
+        return sign * float(text)
+    except ValueError:
+        raise StatementError('unrecognized amount %r' % value)
+
+
+def _row(date, description, amount, reference=None, tx_type=None, category=None):
+    if tx_type not in ('income', 'expense'):
+        tx_type = 'expense' if amount < 0 else 'income'
+    # Same sign convention as add_transaction: expenses are stored negative
+    amount = -abs(amount) if tx_type == 'expense' else abs(amount)
+    return {
+        'date': date,
+        'description': (description or '').strip() or None,
+        'amount': amount,
+        'type': tx_type,
+        'category': category or DEFAULT_CATEGORY,
+        'reference': (reference or '').strip() or None,
+    }
+
+
+def parse_csv(stream):
+    reader = csv.reader(stream)
+    columns = None
+    for line_no, record in enumerate(reader, 1):
+        if columns is None:
+            # Statements usually start with account details; the header is the
+            # first row that names a date column and some amount column.
+            keys = [_header_key(cell) for cell in record]
+            found = {}
+            for field, aliases in HEADER_ALIASES.items():
+                for index, key in enumerate(keys):
+                    if key in aliases and field not in found:
+                        found[field] = index
+            if 'date' in found and ('amount' in found or 'debit' in found or 'credit' in found):
+                columns = found
+            continue
+
+        if not any(cell.strip() for cell in record):
+            continue
+
+        def cell(field):
+            index = columns.get(field)
+            return record[index] if index is not None and index < len(record) else None
+
+        try:
+            date = parse_date(cell('date'))
+            if 'amount' in columns:
+                amount = parse_amount(cell('amount'))
+                if amount is None:
+                    raise StatementError('missing amount')
+                kind = (cell('type') or '').strip().lower()
+                if kind in ('dr', 'debit', 'd'):
+                    amount = -abs(amount)
+                elif kind in ('cr', 'credit', 'c'):
+                    amount = abs(amount)
+            else:
+                debit = parse_amount(cell('debit'))
+                credit = parse_amount(cell('credit'))
+                if debit is None and credit is None:
+                    raise StatementError('missing amount')
+                amount = (credit or 0) - abs(debit or 0)
+        except StatementError as exc:
+            # Footer lines ("Closing balance", "** End of statement **") land here too
+            yield StatementError('line %d: %s' % (line_no, exc))
+            continue
+
+        tx_type = (cell('type') or '').strip().lower()
+        yield _row(date, cell('description'), amount, cell('reference'),
+                   tx_type if tx_type in ('income', 'expense') else None, cell('category'))
+
+    if columns is None:
+        raise StatementError('no transaction header row found')
+
+
+_OFX_TAG = re.compile(r'<(/?)([A-Z0-9.]+)>([^<\r\n]*)')
+
+
+def parse_ofx(stream):
+    # Tolerates both SGML OFX 1.x (no closing tags) and XML OFX 2.x
+    current = None
+    for line in stream:
+        for closing, tag, value in _OFX_TAG.findall(line):
+            if tag == 'STMTTRN':
+                if closing and current is not None:
+                    yield _ofx_row(current)
+                    current = None
+                elif not closing:
+                    if current:
+                        yield _ofx_row(current)
+                    current = {}
+            elif current is not None and not closing:
+                current[tag] = value.strip()
+    if current:
+        yield _ofx_row(current)
+
+
+def _ofx_row(fields):
+    try:
+        date = parse_date(fields.get('DTPOSTED', '')[:8])
+        amount = parse_amount(fields.get('TRNAMT'))
+        if amount is None:
+            raise StatementError('missing TRNAMT')
+    except StatementError as exc:
+        return StatementError('transaction %s: %s' % (fields.get('FITID', '?'), exc))
+    description = fields.get('NAME') or fields.get('MEMO')
+    return _row(date, description, amount, fields.get('FITID'))
+
+
+def parse_json(stream, chunk_size=65536):
+    # Incremental reader for a top-level JSON array of objects
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    exhausted = False
+    index = 0
+    while True:
+        if not exhausted and len(buffer) - index < chunk_size:
+            chunk = stream.read(chunk_size)
+            exhausted = not chunk
+            buffer = buffer[index:] + chunk
+            index = 0
+
+        while index < len(buffer) and buffer[index] in ' \t\r\n,':
+            index += 1
+        if not started:
+            if index >= len(buffer):
+                if exhausted:
+                    raise StatementError('expected a JSON array')
+                continue
+            if buffer[index] != '[':
+                raise StatementError('expected a JSON array')
+            started = True
+            index += 1
+            continue
+        if index < len(buffer) and buffer[index] == ']':
+            return
+        if index >= len(buffer):
+            if exhausted:
+                raise StatementError('unterminated JSON array')
+            continue
+
+        try:
+            item, end = decoder.raw_decode(buffer, index)
+        except ValueError:
+            if exhausted:
+                raise StatementError('invalid JSON near offset %d' % index)
+            # Object straddles the chunk boundary; read more and retry
+            chunk = stream.read(chunk_size)
+            exhausted = not chunk
+            buffer = buffer[index:] + chunk
+            index = 0
+            continue
+        index = end
+
+        try:
+            date = parse_date(str(item.get('date', '')))
+            amount = float(item['amount'])
+        except (StatementError, KeyError, TypeError, ValueError, AttributeError) as exc:
+            yield StatementError('item %r: %s' % (item, exc))
+            continue
+        yield _row(date, item.get('description'), amount, item.get('reference'),
+                   item.get('type'), item.get('category'))
+
+
+PARSERS = {
+    'csv': parse_csv,
+    'ofx': parse_ofx,
+    'json': parse_json,
+}
+
+
+def detect_format(filename, mimetype):
+    name = (filename or '').lower()
+    for ext, fmt in (('.csv', 'csv'), ('.ofx', 'ofx'), ('.qfx', 'ofx'), ('.json', 'json')):
+        if name.endswith(ext):
+            return fmt
+    if mimetype:
+        if 'json' in mimetype:
+            return 'json'
+        if 'ofx' in mimetype:
+            return 'ofx'
+        if 'csv' in mimetype or mimetype.startswith('text/'):
+            return 'csv'
+    return None
+
+
+def import_hash(account_id, row, occurrence):
+    # Identical rows inside one statement (two Rs 20 teas on the same day)
+    # are distinguished by their occurrence number, so re-importing the same
+    # file is a no-op while genuine repeats are kept.
+    if row['reference']:
+        key = '%s|ref|%s' % (account_id, row['reference'])
+    else:
+        key = '%s|%s|%.2f|%s|%d' % (account_id, row['date'], row['amount'], row['description'] or '', occurrence)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_rows(cursor, user_id, account_id, rows, profile_id=None, is_shared=False):
+    # Writes parsed rows inside the caller's transaction: deduplicated
+    # executemany inserts per batch, a single balance update for the account,
+    # rollups, the search index, the user's data version and the change log.
+    # Returns counts and the first few parse errors.
+    imported = duplicates = 0
+    first = search.last_id(cursor)
+    balance_delta = 0.0
+    errors = []
+    error_count = 0
+    occurrences = defaultdict(int)
+
+    def valid_rows():
+        nonlocal error_count
+        for row in rows:
+            if isinstance(row, StatementError):
+                error_count += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(str(row))
+                continue
+            yield row
+
+    for batch in _batches(valid_rows(), BATCH_SIZE):
+        for row in batch:
+            key = (row['date'], row['amount'], row['description'])
+            # Sources with their own idempotency key (upi.reference_hash) set it
+            row['import_hash'] = row.get('import_hash') or import_hash(account_id, row, occurrences[key])
+            occurrences[key] += 1
+
+        placeholders = ','.join('?' * len(batch))
+        existing = {r[0] for r in cursor.execute(
+            "SELECT import_hash FROM %s WHERE user_id = ? AND import_hash IN (%s)" % (archive.source(cursor), placeholders),
+            [user_id] + [row['import_hash'] for row in batch])}
+        seen = set()
+        fresh = []
+        for row in batch:
+            if row['import_hash'] in existing or row['import_hash'] in seen:
+                duplicates += 1
+                continue
+            seen.add(row['import_hash'])
+            fresh.append(row)
+
+        before = search.last_id(cursor)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO transactions (user_id, account_id, profile_id, amount, type, category, description, is_shared, date, import_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(user_id, account_id, profile_id, row['amount'], row['type'], row['category'],
+              row['description'], is_shared, row['date'], row['import_hash']) for row in fresh]
+        )
+        search.index_after(cursor, before)
+        changes = [(row['date'], row['type'], row['category'], row['amount']) for row in fresh]
+        rollups.record(cursor, user_id, changes)
+        balances.record(cursor, user_id, [(account_id, row['date'], row['amount']) for row in fresh])
+        budgeting.record_spending(cursor, user_id, changes)
+        balance_delta += sum(row['amount'] for row in fresh)
+        imported += len(fresh)
+
+    if imported:
+        cursor.execute(
+            "UPDATE accounts SET balance = balance + ? WHERE id = ? AND user_id = ?",
+            (balance_delta, account_id, user_id)
+        )
+        cache.bump_version(cursor, user_id)
+        sync.record_ledger(cursor, user_id, first)
+
+    return {'imported': imported, 'duplicates': duplicates, 'errors': error_count, 'error_details': errors}
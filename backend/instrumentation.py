@@ -0,0 +1,314 @@
+import hmac
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from flask import Response, current_app, g, has_request_context, jsonify, request
+
+# Query and request instrumentation.
+#
+# db.connect() builds every connection with InstrumentedConnection, so each
+# statement is timed and its fetched rows counted without touching the
+# routes. Within a request the numbers are summed into a Server-Timing
+# header; across requests they feed per-endpoint and per-statement histograms
+# served in Prometheus text format at /metrics. Metrics are per process.
+# /metrics answers only with METRICS_TOKEN as a bearer token; without one
+# configured it is not served at all.
+
+logger = logging.getLogger('fintrack.sql')
+
+# Seconds; Prometheus convention
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SLOW_QUERY_SECONDS = 0.1
+MAX_STATEMENT_LABEL = 160
+
+_SPACES = re.compile(r'\s+')
+_IN_LIST = re.compile(r'\(\s*\?(\s*,\s*\?)+\s*\)')
+
+
+def normalize(sql):
+    # One label per statement shape: whitespace collapsed and "IN (?, ?, ...)"
+    # folded, so batched lookups of different sizes share a series.
+    text = _IN_LIST.sub('(?...)', _SPACES.sub(' ', sql).strip())
+    return text if len(text) <= MAX_STATEMENT_LABEL else text[:MAX_STATEMENT_LABEL - 3] + '...'
+
+
+def _param_shape(params):
+    # Types only; parameter values can be personal financial data
+    if isinstance(params, dict):
+        return '{%s}' % ', '.join('%s: %s' % (k, type(v).__name__) for k, v in params.items())
+    return '(%s)' % ', '.join(type(v).__name__ for v in params or ())
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(BUCKETS), 0.0, 0]
+            counts = series[0]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            items = sorted(self._series.items())
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in items]
+        for label_values, (counts, total, count) in items:
+            labels = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, labels, count))
+            lines.append('%s_sum{%s} %.6f' % (self.name, labels, total))
+            lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help_text), '# TYPE %s counter' % self.name]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            labels = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.labels, label_values))
+            lines.append('%s{%s} %d' % (self.name, labels, value))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_DURATION = Histogram('fintrack_http_request_duration_seconds',
+                             'Request latency by endpoint.', ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = Histogram('fintrack_http_request_db_seconds',
+                            'Time spent in SQLite per request by endpoint.', ('endpoint',))
+QUERY_DURATION = Histogram('fintrack_db_query_duration_seconds',
+                           'SQLite statement latency (execute plus fetch).', ('statement',))
+QUERY_ROWS = Counter('fintrack_db_rows_total', 'Rows fetched per statement.', ('statement',))
+SLOW_QUERIES = Counter('fintrack_db_slow_queries_total', 'Statements slower than the slow query threshold.', ('statement',))
+
+METRICS = (REQUEST_DURATION, REQUEST_QUERIES, QUERY_DURATION, QUERY_ROWS, SLOW_QUERIES)
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.db_seconds = 0.0
+        self.write_seconds = 0.0
+
+
+def _request_stats():
+    if has_request_context():
+        return g.get('query_stats')
+    return None
+
+
+class Capture:
+    # Records every statement run on any thread while active, as
+    # (sql, params); executemany() batches are recorded with params None.
+    # The query plan test drives each endpoint inside one.
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        with _captures_lock:
+            _captures.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _captures_lock:
+            _captures.remove(self)
+
+
+_captures = []
+_captures_lock = threading.Lock()
+
+
+def full_scans(conn, sql, params):
+    # The steps of a statement's plan that read a whole table: "SCAN <table>"
+    # without "USING ... INDEX". Joins by primary key show up as SEARCH and
+    # are fine, and so does "SCAN (subquery-N)", the pass over a window
+    # function's or a UNION ALL's input.
+    details = [row[3] for row in sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    return [d for d in details if d.startswith('SCAN') and 'INDEX' not in d and not d.startswith('SCAN (subquery')]
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+
+    _statement = None
+
+    def _finish(self, sql, params, elapsed, many=False):
+        if _captures:
+            with _captures_lock:
+                for capture in _captures:
+                    capture.statements.append((sql, params))
+        statement = normalize(sql)
+        self._statement = statement
+        QUERY_DURATION.observe((statement,), elapsed)
+        stats = _request_stats()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+        if elapsed >= self.connection.slow_query_seconds:
+            self._log_slow(statement, sql, params, elapsed, many)
+
+    def _log_slow(self, statement, sql, params, elapsed, many):
+        SLOW_QUERIES.inc((statement,))
+        plan = ''
+        if not many and sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            try:
+                rows = sqlite3.Cursor(self.connection).execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+                plan = '; '.join(row[3] for row in rows)
+            except sqlite3.Error:
+                plan = 'unavailable'
+        logger.warning('slow query %.1fms params=%s plan=[%s] sql=%s',
+                       elapsed * 1000, 'executemany' if many else _param_shape(params), plan, statement)
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._finish(sql, params, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._finish(sql, None, time.perf_counter() - started, many=True)
+
+    def _fetched(self, count, elapsed):
+        if self._statement is None:
+            return
+        QUERY_ROWS.inc((self._statement,), count)
+        stats = _request_stats()
+        if stats is not None:
+            stats.rows += count
+            stats.db_seconds += elapsed
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(0 if row is None else 1, time.perf_counter() - started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), time.perf_counter() - started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), time.perf_counter() - started)
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self._fetched(1, 0.0)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # sqlite3.Connection.execute() does not go through cursor(), so the
+    # shortcuts are redefined to use the instrumented cursor.
+
+    slow_query_seconds = SLOW_QUERY_SECONDS
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def configure(conn, config):
+    # Called by db.connect() with the owning app's config
+    conn.slow_query_seconds = config.get('SLOW_QUERY_MS', SLOW_QUERY_SECONDS * 1000) / 1000.0
+
+
+def record_write_wait(elapsed):
+    # Time a request spent waiting on the writer thread (see writer.run)
+    stats = _request_stats()
+    if stats is not None:
+        stats.write_seconds += elapsed
+
+
+def _before_request():
+    g.query_stats = RequestStats()
+
+
+def _after_request(response):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+    total = time.perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_DURATION.observe((endpoint, request.method, response.status_code), total)
+    REQUEST_QUERIES.observe((endpoint,), stats.db_seconds)
+
+    timings = ['db;dur=%.2f;desc="%d queries, %d rows"' % (stats.db_seconds * 1000, stats.queries, stats.rows)]
+    if stats.write_seconds:
+        timings.append('write;dur=%.2f' % (stats.write_seconds * 1000))
+    timings.append('total;dur=%.2f' % (total * 1000))
+    response.headers.add('Server-Timing', ', '.join(timings))
+    return response
+
+
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    supplied = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(supplied.encode(), ('Bearer ' + token).encode()):
+        return jsonify({'msg': 'Not found'}), 404
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.config.setdefault('SLOW_QUERY_MS', SLOW_QUERY_SECONDS * 1000)
+    app.config.setdefault('METRICS_TOKEN', None)  # e.g. FINTRACK_METRICS_TOKEN=...
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
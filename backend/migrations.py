@@ -0,0 +1,503 @@
+import os
+import sqlite3
+
+import click
+from flask import current_app, jsonify
+from flask.cli import AppGroup
+
+import db
+
+# Ordered schema steps. Each step runs exactly once per database file and is
+# recorded in schema_migrations; never edit a step that has shipped, append a
+# new one instead.
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+@migration(1, 'base schema')
+def _base_schema(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS accounts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        type TEXT NOT NULL,
+        balance REAL NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        profile_id INTEGER,
+        amount REAL NOT NULL,
+        type TEXT NOT NULL,
+        category TEXT NOT NULL,
+        description TEXT,
+        is_shared BOOLEAN DEFAULT 0,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (account_id) REFERENCES accounts (id),
+        FOREIGN KEY (profile_id) REFERENCES profiles (id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS budgets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        amount REAL NOT NULL,
+        period TEXT NOT NULL,
+        start_date TIMESTAMP,
+        end_date TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS profiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        type TEXT NOT NULL,  -- 'primary', 'spouse', 'child', etc.
+        photo_url TEXT,
+        is_active BOOLEAN DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+
+@migration(2, 'profile columns on legacy transactions')
+def _transaction_profile_columns(cursor):
+    # Databases created before household profiles existed have neither column.
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(transactions)")}
+    if 'profile_id' not in columns:
+        cursor.execute("ALTER TABLE transactions ADD COLUMN profile_id INTEGER REFERENCES profiles (id)")
+    if 'is_shared' not in columns:
+        cursor.execute("ALTER TABLE transactions ADD COLUMN is_shared BOOLEAN DEFAULT 0")
+
+
+@migration(3, 'hot path indexes')
+def _hot_path_indexes(cursor):
+    # Listing and recent transactions: WHERE user_id = ? ORDER BY date DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_date ON transactions (user_id, date)")
+    # Dashboard income/expense totals and breakdown, covering amount and category
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_type_date ON transactions (user_id, type, date, category, amount)")
+    # Budget spent: category + date window, covering type and amount
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_category_date ON transactions (user_id, category, date, type, amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_budgets_user_category ON budgets (user_id, category)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_accounts_user_type ON accounts (user_id, type, balance)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_profiles_user ON profiles (user_id)")
+
+
+@migration(4, 'monthly rollups')
+def _monthly_rollups(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS monthly_rollups (
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,  -- 'YYYY-MM'
+        type TEXT NOT NULL,
+        category TEXT NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        abs_amount REAL NOT NULL DEFAULT 0,
+        tx_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, month, type, category)
+    ) WITHOUT ROWID
+    ''')
+    # Backfill from the existing ledger
+    cursor.execute("""
+        INSERT INTO monthly_rollups (user_id, month, type, category, amount, abs_amount, tx_count)
+        SELECT user_id, substr(date, 1, 7), type, category, SUM(amount), SUM(ABS(amount)), COUNT(*)
+        FROM transactions
+        GROUP BY user_id, substr(date, 1, 7), type, category
+    """)
+
+
+@migration(5, 'per-user data versions')
+def _user_versions(cursor):
+    # Bumped by every write route; read endpoints key their cache on it
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_versions (
+        user_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+
+@migration(6, 'statement import dedupe key')
+def _import_hash(cursor):
+    # NULL for rows entered by hand; UNIQUE still allows any number of NULLs
+    cursor.execute("ALTER TABLE transactions ADD COLUMN import_hash TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_user_import_hash ON transactions (user_id, import_hash)")
+
+
+@migration(7, 'incremental budget spent')
+def _budget_spent(cursor):
+    cursor.execute("ALTER TABLE budgets ADD COLUMN spent REAL NOT NULL DEFAULT 0")
+    cursor.execute("""
+        UPDATE budgets SET spent = (
+            SELECT COALESCE(SUM(ABS(t.amount)), 0)
+            FROM transactions t
+            WHERE t.user_id = budgets.user_id AND t.category = budgets.category
+                AND t.type = 'expense' AND t.date BETWEEN budgets.start_date AND budgets.end_date
+        )
+    """)
+    # Write path: find the budgets whose window contains a transaction date
+    cursor.execute("DROP INDEX IF EXISTS idx_budgets_user_category")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_budgets_user_category_window ON budgets (user_id, category, start_date, end_date)")
+    # Read path: budgets still open on a given date
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_budgets_user_end_date ON budgets (user_id, end_date)")
+
+
+@migration(8, 'transaction search index')
+def _transaction_search(cursor):
+    # Contentless FTS5 index over description and category. The owner column
+    # holds 'u<user_id>' so a search intersects with one user's rows inside
+    # the index instead of matching every user and filtering afterwards.
+    # New rows are indexed by the write path in batches (search.index_after);
+    # a per-row insert trigger made bulk imports several times slower.
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+        owner, description, category,
+        content='',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    ''')
+    # A contentless table does not store what it indexed, so deletes must
+    # replay exactly the values that were inserted
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, owner, description, category)
+        VALUES ('delete', old.id, 'u' || old.user_id, COALESCE(old.description, ''), COALESCE(old.category, ''));
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF user_id, description, category ON transactions BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, owner, description, category)
+        VALUES ('delete', old.id, 'u' || old.user_id, COALESCE(old.description, ''), COALESCE(old.category, ''));
+        INSERT INTO transactions_fts (rowid, owner, description, category)
+        VALUES (new.id, 'u' || new.user_id, COALESCE(new.description, ''), COALESCE(new.category, ''));
+    END
+    ''')
+    cursor.execute("""
+        INSERT INTO transactions_fts (rowid, owner, description, category)
+        SELECT id, 'u' || user_id, COALESCE(description, ''), COALESCE(category, '') FROM transactions
+    """)
+
+
+@migration(9, 'balance history')
+def _balance_history(cursor):
+    # accounts.balance = opening_balance + every transaction on the account.
+    # Existing balances already include their transactions, so back them out.
+    cursor.execute("ALTER TABLE accounts ADD COLUMN opening_balance REAL NOT NULL DEFAULT 0")
+    cursor.execute("""
+        UPDATE accounts SET opening_balance = balance - (
+            SELECT COALESCE(SUM(t.amount), 0) FROM transactions t WHERE t.account_id = accounts.id
+        )
+    """)
+    # Net change per account and month, maintained by the write path like
+    # monthly_rollups; month-end balances are a running sum over it
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS balance_months (
+        account_id INTEGER NOT NULL,
+        month TEXT NOT NULL,  -- 'YYYY-MM'
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        tx_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (account_id, month)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_balance_months_user ON balance_months (user_id, account_id, month, amount)")
+    cursor.execute("""
+        INSERT INTO balance_months (account_id, month, user_id, amount, tx_count)
+        SELECT account_id, substr(date, 1, 7), user_id, SUM(amount), COUNT(*)
+        FROM transactions
+        GROUP BY account_id, substr(date, 1, 7)
+    """)
+    # Ledger balance of each account through transaction last_id, as of the
+    # last `flask balances reconcile`; the next one only sums newer rows
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS balance_checkpoints (
+        account_id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        last_id INTEGER NOT NULL,
+        balance REAL NOT NULL,
+        checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_account ON transactions (account_id)")
+
+
+@migration(10, 'change log')
+def _change_log(cursor):
+    # One row per changed entity row, holding the user's data version of its
+    # latest change; repeated updates overwrite instead of appending
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS changes (
+        user_id INTEGER NOT NULL,
+        entity TEXT NOT NULL,  -- 'transactions', 'accounts', 'profiles', 'budgets'
+        row_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, entity, row_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changes_version ON changes (user_id, version)")
+    # Sync tokens older than the floor were compacted away. Nothing before
+    # this migration was logged, so the floor starts at the current version.
+    cursor.execute("ALTER TABLE user_versions ADD COLUMN sync_floor INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("UPDATE user_versions SET sync_floor = version")
+
+
+@migration(11, 'webhook api keys')
+def _api_keys(cursor):
+    # Keys authenticate the UPI webhook, which has no JWT. Only a SHA-256 of
+    # the secret is stored; each key posts into one account.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS api_keys (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        key_hash TEXT NOT NULL UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (account_id) REFERENCES accounts (id)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_user ON api_keys (user_id)")
+
+
+@migration(12, 'scheduled jobs')
+def _scheduled_jobs(cursor):
+    # One row per job and database file; the lease columns make sure only
+    # one worker process runs a job at a time (see scheduler.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        name TEXT PRIMARY KEY,
+        next_run TIMESTAMP NOT NULL,
+        locked_by TEXT,
+        locked_until TIMESTAMP,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_started TIMESTAMP,
+        last_finished TIMESTAMP,
+        last_status TEXT,
+        last_result TEXT,
+        last_error TEXT
+    )
+    ''')
+    # Budgets roll into the next period when theirs ends; rolled ones are
+    # cleared so they are never rolled twice
+    cursor.execute("ALTER TABLE budgets ADD COLUMN recurring INTEGER NOT NULL DEFAULT 1")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_budgets_recurring_end_date ON budgets (end_date) WHERE recurring = 1")
+
+
+@migration(13, 'recurring series and forecast')
+def _forecast(cursor):
+    # Written by forecast.refresh() in batch; the ids change whenever a user
+    # is recomputed
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS recurring_series (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        category TEXT,
+        description TEXT,
+        pattern TEXT NOT NULL,
+        cadence TEXT NOT NULL,
+        interval_days REAL NOT NULL,
+        amount REAL NOT NULL,
+        occurrences INTEGER NOT NULL,
+        first_date TEXT NOT NULL,
+        last_date TEXT NOT NULL,
+        next_date TEXT,
+        confidence REAL NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_recurring_series_user ON recurring_series (user_id)")
+    # Projected occurrences of each series, read by date range
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS forecast_flows (
+        user_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        series_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        PRIMARY KEY (user_id, date, series_id)
+    ) WITHOUT ROWID
+    ''')
+    # The data version (user_versions) each user's forecast was computed at
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS forecast_state (
+        user_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL,
+        series INTEGER NOT NULL,
+        computed_at TIMESTAMP NOT NULL
+    )
+    ''')
+
+
+@migration(14, 'accounts index without balance')
+def _accounts_index(cursor):
+    # Every write updates accounts.balance, so keeping it in an index only
+    # added work; lookups by user_id (refdata, dashboard totals) still use it
+    cursor.execute("DROP INDEX IF EXISTS idx_accounts_user_type")
+    cursor.execute("CREATE INDEX idx_accounts_user_type ON accounts (user_id, type)")
+
+
+def _ensure_version_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+
+def current_version(conn):
+    _ensure_version_table(conn.cursor())
+    row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    return row[0] or 0
+
+
+def latest_version():
+    return max(version for version, _, _ in MIGRATIONS)
+
+
+def pending(conn):
+    applied = current_version(conn)
+    return [step for step in sorted(MIGRATIONS) if step[0] > applied]
+
+
+def upgrade(conn):
+    applied = []
+    for version, name, fn in pending(conn):
+        # Each step is one explicit transaction, DDL included (sqlite3 only
+        # opens one implicitly before DML), so a step that fails partway
+        # leaves nothing behind and the version table at the last step that
+        # fully applied.
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            fn(cursor)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        applied.append((version, name))
+    return applied
+
+
+def upgrade_all(config):
+    # The catalog and every shard, creating shard files as needed; returns
+    # [(path, applied steps)]
+    results = []
+    for path in db.database_paths(config):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = db.connect(path, config)
+        try:
+            results.append((path, upgrade(conn)))
+        finally:
+            conn.close()
+    return results
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def applied_version(conn):
+    # Read-only counterpart of current_version() for the startup check
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_migrations").fetchone()
+    except sqlite3.OperationalError:  # never migrated
+        return 0
+    return row[0] or 0
+
+
+def check_schema(conn):
+    # A newer schema than the code is fine during a rolling deploy: steps
+    # only ever add tables, columns and indexes.
+    version = applied_version(conn)
+    if version < latest_version():
+        raise SchemaOutOfDate("database schema is at version %d but the code needs %d; run 'flask db upgrade'"
+                              % (version, latest_version()))
+
+
+def _check_schema_once():
+    # First request per worker only; afterwards a dictionary lookup
+    app = current_app._get_current_object()
+    if app.extensions.get('schema_checked'):
+        return None
+    try:
+        for path in db.database_paths(app.config):
+            check_schema(db.thread_connection(path))
+    except SchemaOutOfDate as exc:
+        app.logger.error(str(exc))
+        return jsonify({"msg": "Service unavailable: database schema is out of date"}), 503
+    app.extensions['schema_checked'] = True
+    return None
+
+
+def init_app(app):
+    app.config.setdefault('SCHEMA_CHECK', True)
+    if app.config['SCHEMA_CHECK']:
+        app.before_request(_check_schema_once)
+
+
+cli = AppGroup('db', help='Schema migrations.')
+
+
+def _label(path):
+    # Prefix output with the file name once there is more than one database
+    return '%s: ' % os.path.basename(path) if current_app.config['SHARDS'] else ''
+
+
+@cli.command('upgrade')
+def upgrade_command():
+    for path, applied in upgrade_all(current_app.config):
+        for version, name in applied:
+            click.echo('%sapplied %d: %s' % (_label(path), version, name))
+        if not applied:
+            click.echo('%sschema is up to date' % _label(path))
+
+
+@cli.command('status')
+def status_command():
+    for path in db.database_paths(current_app.config):
+        if not os.path.exists(path):
+            click.echo("%snot created yet; run 'flask db upgrade'" % _label(path))
+            continue
+        conn = db.connect(path)
+        click.echo('%scurrent version: %d (latest %d)' % (_label(path), current_version(conn), latest_version()))
+        for version, name, _ in pending(conn):
+            click.echo('%spending %d: %s' % (_label(path), version, name))
+        conn.close()
@@ -0,0 +1,73 @@
+import base64
+import json
+
+from flask import Response, stream_with_context
+
+import encoding
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = 500
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(key, row_id):
+    raw = json.dumps([key, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, key_type=str):
+    # Cursors are opaque to clients: base64 of the (sort key, id) keyset
+    # position of the last row on the previous page. The sort key is the
+    # date for listings and the relevance rank for search.
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        key, row_id = json.loads(raw)
+        return key_type(key), int(row_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+
+
+def parse_limit(value, default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        return default
+    return max(1, min(limit, maximum))
+
+
+def _iter_rows(cursor, fill=None):
+    # fill: optional function applied to each batch of rows (refdata.filler)
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        if fill is not None:
+            rows = fill(rows)
+        for row in rows:
+            yield dict(zip(columns, row))
+
+
+def stream_ndjson(cursor, fill=None):
+    def generate():
+        for row in _iter_rows(cursor, fill):
+            yield encoding.dumps(row) + b'\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def stream_json_array(cursor, fill=None):
+    # Same body as jsonify(list) but written incrementally, one batch at a time
+    def generate():
+        yield b'['
+        first = True
+        for row in _iter_rows(cursor, fill):
+            yield (b'' if first else b',') + encoding.dumps(row)
+            first = False
+        yield b']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
@@ -0,0 +1,90 @@
+from flask import current_app
+
+import cache
+
+# Per-user reference data: accounts and profiles, held in memory per worker.
+#
+# Nearly every read needs them, either whole (the accounts and profiles
+# endpoints) or as names next to each transaction. An entry is keyed by the
+# user and tagged with the user's data version (cache.data_version), the row
+# every write transaction bumps, balance updates included. Checking it is one
+# primary-key lookup and sees writes made by any worker, so entries never need
+# to be invalidated explicitly; a stale one is simply reloaded.
+#
+# Listings select t.account_id AS account_name and t.profile_id AS
+# profile_name / profile_photo instead of joining accounts and profiles, and
+# fill() swaps the ids for the values here.
+
+ACCOUNT_COLUMNS = ['id', 'name', 'type', 'balance']
+PROFILE_COLUMNS = ['id', 'name', 'type', 'photo_url', 'is_active']
+DEFAULT_SIZE = 1024
+
+
+class Reference:
+
+    def __init__(self, version, accounts, profiles):
+        self.version = version
+        self.accounts = accounts  # id -> row in ACCOUNT_COLUMNS order
+        self.profiles = profiles  # id -> row in PROFILE_COLUMNS order
+
+    def account_name(self, account_id):
+        row = self.accounts.get(account_id)
+        return row[1] if row else None
+
+    def profile_name(self, profile_id):
+        row = self.profiles.get(profile_id)
+        return row[1] if row else None
+
+    def profile_photo(self, profile_id):
+        row = self.profiles.get(profile_id)
+        return row[3] if row else None
+
+
+def _read(conn, user_id, version):
+    accounts = conn.execute("SELECT id, name, type, balance FROM accounts WHERE user_id = ? ORDER BY id",
+                            (user_id,)).fetchall()
+    profiles = conn.execute("SELECT id, name, type, photo_url, is_active FROM profiles WHERE user_id = ? ORDER BY id",
+                            (user_id,)).fetchall()
+    return Reference(version, {row[0]: tuple(row) for row in accounts}, {row[0]: tuple(row) for row in profiles})
+
+
+def load(conn, user_id):
+    # The version is read before the rows: if a write lands in between, the
+    # entry holds newer rows than its tag and is reloaded once more, never the
+    # other way round.
+    version = cache.data_version(conn, user_id)
+    store = current_app.extensions.get('reference_cache')
+    if store is None:
+        return _read(conn, user_id, version)
+    key = int(user_id)
+    reference = store.get(key)
+    if reference is None or reference.version != version:
+        reference = _read(conn, user_id, version)
+        store.set(key, reference)
+    return reference
+
+
+_FILLERS = (('account_name', Reference.account_name), ('profile_name', Reference.profile_name),
+            ('profile_photo', Reference.profile_photo))
+
+
+def filler(reference, columns):
+    # fill(rows) for rows of a listing query with these columns; returns
+    # lists with the ids in the name columns replaced
+    fields = [(columns.index(name), method) for name, method in _FILLERS if name in columns]
+
+    def fill(rows):
+        filled = []
+        for row in rows:
+            row = list(row)
+            for index, method in fields:
+                row[index] = method(reference, row[index])
+            filled.append(row)
+        return filled
+    return fill
+
+
+def init_app(app):
+    app.config.setdefault('REFERENCE_CACHE_SIZE', DEFAULT_SIZE)  # users per worker; 0 turns it off
+    if app.config['REFERENCE_CACHE_SIZE']:
+        app.extensions['reference_cache'] = cache.MemoryStore(app.config['REFERENCE_CACHE_SIZE'])
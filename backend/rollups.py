@@ -0,0 +1,120 @@
+import sys
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import archive
+import db
+
+# monthly_rollups holds one row per (user, month, type, category) with the
+# signed and absolute sums of transactions.amount. Every write path that
+# touches transactions must call record() inside its own SQL transaction so
+# the dashboard can read O(months) rows instead of scanning the ledger.
+
+
+def month_of(date):
+    # Dates are stored as ISO strings ('YYYY-MM-DD' or with a time part);
+    # keep in sync with substr(date, 1, 7) used by rebuild().
+    return str(date)[:7]
+
+
+def record(cursor, user_id, transactions, sign=1):
+    # transactions: iterable of (date, type, category, amount). Pass sign=-1
+    # to back rows out again (deletes, or the old side of an update).
+    totals = defaultdict(lambda: [0.0, 0.0, 0])
+    for date, tx_type, category, amount in transactions:
+        bucket = totals[(month_of(date), tx_type, category)]
+        bucket[0] += sign * amount
+        bucket[1] += sign * abs(amount)
+        bucket[2] += sign
+
+    cursor.executemany("""
+        INSERT INTO monthly_rollups (user_id, month, type, category, amount, abs_amount, tx_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, month, type, category) DO UPDATE SET
+            amount = amount + excluded.amount,
+            abs_amount = abs_amount + excluded.abs_amount,
+            tx_count = tx_count + excluded.tx_count
+    """, [
+        (user_id, month, tx_type, category, amount, abs_amount, count)
+        for (month, tx_type, category), (amount, abs_amount, count) in totals.items()
+    ])
+
+
+_AGGREGATE = """
+    SELECT user_id, substr(date, 1, 7) as month, type, category,
+           SUM(amount) as amount, SUM(ABS(amount)) as abs_amount, COUNT(*) as tx_count
+    FROM {transactions}
+    {where}
+    GROUP BY user_id, month, type, category
+"""
+
+
+def rebuild(conn, user_id=None):
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM monthly_rollups " + where, params)
+    cursor.execute("""
+        INSERT INTO monthly_rollups (user_id, month, type, category, amount, abs_amount, tx_count)
+    """ + _AGGREGATE.format(transactions=archive.source(conn), where=where), params)
+    conn.commit()
+
+
+def verify(conn, user_id=None, tolerance=0.005):
+    # Returns (user_id, month, type, category, stored, expected) for every
+    # bucket where the rollup disagrees with the ledger.
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    expected = {
+        (row['user_id'], row['month'], row['type'], row['category']): (row['amount'], row['tx_count'])
+        for row in conn.execute(_AGGREGATE.format(transactions=archive.source(conn), where=where), params)
+    }
+    stored = {
+        (row['user_id'], row['month'], row['type'], row['category']): (row['amount'], row['tx_count'])
+        for row in conn.execute(
+            "SELECT user_id, month, type, category, amount, tx_count FROM monthly_rollups " + where, params)
+        if row['tx_count']
+    }
+
+    mismatches = []
+    for key in expected.keys() | stored.keys():
+        have, want = stored.get(key, (0, 0)), expected.get(key, (0, 0))
+        if have[1] != want[1] or abs(have[0] - want[0]) > tolerance:
+            mismatches.append(key + (have, want))
+    return sorted(mismatches)
+
+
+cli = AppGroup('rollups', help='Backfill and check dashboard rollups.')
+
+
+def _paths(user_id):
+    # The user's own database, or the catalog and every shard
+    if user_id is not None:
+        return [db.user_database(current_app.config, user_id)]
+    return db.database_paths(current_app.config)
+
+
+@cli.command('rebuild')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user.')
+def rebuild_command(user_id):
+    for path in _paths(user_id):
+        conn = db.connect(path)
+        rebuild(conn, user_id)
+        conn.close()
+    click.echo('rollups rebuilt')
+
+
+@cli.command('verify')
+@click.option('--user-id', type=int, default=None, help='Only verify this user.')
+def verify_command(user_id):
+    mismatches = []
+    for path in _paths(user_id):
+        conn = db.connect(path)
+        mismatches.extend(verify(conn, user_id))
+        conn.close()
+    for mismatch in mismatches:
+        click.echo('user %s %s %s/%s: stored %r expected %r' % mismatch, err=True)
+    if mismatches:
+        sys.exit(1)
+    click.echo('rollups match the ledger')
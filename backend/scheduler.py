@@ -0,0 +1,363 @@
+import datetime
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import balances
+import budgeting
+import cache
+import db
+import forecast
+import rollups
+import sync
+
+# Background jobs (migration 12).
+#
+# Work that used to wait for a request or an operator runs here instead:
+# - budgets.rollover (hourly): a recurring budget whose period has ended gets
+#   its successor for the current period, with spent seeded from the ledger,
+#   so the 1st of the month starts with every budget in place.
+# - ledger.check (nightly, off-peak): compares the dashboard rollups with the
+#   ledger and rebuilds the users that drifted, and moves the balance
+#   checkpoints forward so `flask balances reconcile` stays incremental.
+# - sync.compact (nightly, off-peak): drops change log entries older than
+#   SYNC_COMPACT_DAYS.
+# - forecast.refresh (every few minutes): re-detects the recurring series of
+#   users whose data changed since their forecast was computed.
+# - forecast.rebuild (nightly, off-peak): every user, as projections also
+#   move with the calendar (see forecast.py).
+#
+# Jobs run per database file and keep their state in its jobs table. A worker
+# claims a due job by taking its lease in one UPDATE, so with several gunicorn
+# workers (or a separate `flask jobs worker`) each run happens once; a lease
+# left by a crashed worker expires after LEASE seconds. A failed run is
+# retried with exponential backoff.
+#
+# Run the jobs in one separate process next to the web workers:
+#
+#     flask --app app jobs worker
+#
+# SCHEDULER = True instead runs the loop in a thread of every app process,
+# started by its first request; the leases keep that correct, but each web
+# worker then also polls and runs jobs. It is off by default.
+
+POLL_INTERVAL = 60   # seconds between checks for due jobs
+LEASE = 900          # seconds a claimed job stays locked
+RETRY_BACKOFF = 60   # seconds before the first retry, doubled on every failure
+MAX_BACKOFF = 3600
+OFF_PEAK = '03:00'
+COMPACT_DAYS = 90
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def rollover_budgets(conn, config, today=None):
+    today = today or datetime.date.today()
+    due = defaultdict(list)
+    for row in conn.execute("""
+        SELECT id, user_id, category, amount, period FROM budgets
+        WHERE recurring = 1 AND end_date < ?
+        ORDER BY user_id
+    """, (today.isoformat(),)):
+        due[row['user_id']].append(row)
+
+    created = 0
+    for user_id, budgets in due.items():
+        # One transaction per user keeps the write lock short
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            changed = []
+            for budget in budgets:
+                start_date, end_date = budgeting.period_window(budget['period'], today)
+                cursor.execute("""
+                    SELECT id FROM budgets
+                    WHERE user_id = ? AND category = ? AND period = ? AND start_date = ? AND end_date = ?
+                """, (user_id, budget['category'], budget['period'], start_date, end_date))
+                if cursor.fetchone() is None:
+                    cursor.execute("""
+                        INSERT INTO budgets (user_id, category, amount, period, start_date, end_date)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (user_id, budget['category'], budget['amount'], budget['period'], start_date, end_date))
+                    changed.append(cursor.lastrowid)
+                    budgeting.recompute(cursor, cursor.lastrowid)
+                    created += 1
+                cursor.execute("UPDATE budgets SET recurring = 0 WHERE id = ?", (budget['id'],))
+                changed.append(budget['id'])
+            cache.bump_version(cursor, user_id)
+            sync.record(cursor, user_id, 'budgets', changed)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return 'created %d budgets for %d users' % (created, len(due))
+
+
+def check_ledger(conn, config):
+    drifted = sorted({mismatch[0] for mismatch in rollups.verify(conn)})
+    for user_id in drifted:
+        rollups.rebuild(conn, user_id)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cache.bump_version(cursor, user_id)
+        conn.commit()
+    mismatches = balances.reconcile(conn)
+    for mismatch in mismatches:
+        current_app.logger.warning('user %s account %s (%s): balance %r, ledger %r' % mismatch)
+    return 'rebuilt rollups for %d users, %d balance mismatches' % (len(drifted), len(mismatches))
+
+
+def compact_changes(conn, config):
+    return 'removed %d change log entries' % sync.compact(conn, config['SYNC_COMPACT_DAYS'])
+
+
+def refresh_forecasts(conn, config):
+    users, series = forecast.refresh(conn, forecast.stale_users(conn))
+    return 'found %d recurring series for %d users' % (series, users)
+
+
+def rebuild_forecasts(conn, config):
+    users, series = forecast.refresh(conn)
+    return 'found %d recurring series for %d users' % (series, users)
+
+
+# name: (function(conn, config) -> summary, 'hourly', 'nightly' or minutes)
+JOBS = {
+    'budgets.rollover': (rollover_budgets, 'hourly'),
+    'ledger.check': (check_ledger, 'nightly'),
+    'sync.compact': (compact_changes, 'nightly'),
+    'forecast.refresh': (refresh_forecasts, 5),
+    'forecast.rebuild': (rebuild_forecasts, 'nightly'),
+}
+
+
+class JobError(ValueError):
+    pass
+
+
+def _format(moment):
+    return moment.strftime(TIME_FORMAT)
+
+
+def next_run(schedule, now, off_peak=OFF_PEAK):
+    # Local time: the top of the next hour, the next off-peak HH:MM, or a
+    # number of minutes from now
+    if isinstance(schedule, int):
+        return now + datetime.timedelta(minutes=schedule)
+    if schedule == 'hourly':
+        return now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    hour, minute = (int(part) for part in off_peak.split(':'))
+    run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return run if run > now else run + datetime.timedelta(days=1)
+
+
+def backoff(attempts):
+    return min(RETRY_BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+def _owner():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _ensure_jobs(conn, now):
+    # New jobs are due at once
+    conn.executemany("INSERT OR IGNORE INTO jobs (name, next_run) VALUES (?, ?)",
+                     [(name, _format(now)) for name in JOBS])
+    conn.commit()
+
+
+def _claim(conn, name, now, force=False):
+    cursor = conn.execute("""
+        UPDATE jobs SET locked_by = ?, locked_until = ?, last_started = ?
+        WHERE name = ? AND (? OR next_run <= ?) AND (locked_until IS NULL OR locked_until < ?)
+    """, (_owner(), _format(now + datetime.timedelta(seconds=LEASE)), _format(now),
+          name, force, _format(now), _format(now)))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def run_job(conn, name, config, force=False):
+    # Run `name` if it is due (or anyway with force) and nobody else holds
+    # it. Returns (status, summary), or None when it was not run.
+    if name not in JOBS:
+        raise JobError('unknown job %r' % name)
+    function, schedule = JOBS[name]
+    now = datetime.datetime.now()
+    _ensure_jobs(conn, now)
+    if not _claim(conn, name, now, force):
+        return None
+    try:
+        summary = function(conn, config)
+    except Exception as exc:
+        if conn.in_transaction:
+            conn.rollback()
+        finished = datetime.datetime.now()
+        attempts = conn.execute("SELECT attempts FROM jobs WHERE name = ?", (name,)).fetchone()[0] + 1
+        conn.execute("""
+            UPDATE jobs SET locked_by = NULL, locked_until = NULL, attempts = ?, last_finished = ?,
+                last_status = 'failed', last_error = ?, next_run = ?
+            WHERE name = ?
+        """, (attempts, _format(finished), '%s: %s' % (type(exc).__name__, exc),
+              _format(finished + datetime.timedelta(seconds=backoff(attempts))), name))
+        conn.commit()
+        current_app.logger.exception('job %s failed (attempt %d)', name, attempts)
+        return 'failed', str(exc)
+    finished = datetime.datetime.now()
+    conn.execute("""
+        UPDATE jobs SET locked_by = NULL, locked_until = NULL, attempts = 0, last_finished = ?,
+            last_status = 'ok', last_result = ?, last_error = NULL, next_run = ?
+        WHERE name = ?
+    """, (_format(finished), summary, _format(next_run(schedule, finished, config['SCHEDULER_OFF_PEAK'])), name))
+    conn.commit()
+    return 'ok', summary
+
+
+def run_due(config):
+    # One pass over every database file; returns [(path, name, status, summary)]
+    ran = []
+    for path in db.database_paths(config):
+        if not os.path.exists(path):
+            continue
+        conn = db.connect(path, config)
+        try:
+            for name in JOBS:
+                result = run_job(conn, name, config)
+                if result is not None:
+                    ran.append((path, name) + result)
+        finally:
+            conn.close()
+    return ran
+
+
+# What GET /api/jobs shows: jobs run over every user of a database, so
+# their results, errors and lease holders stay with operators (`flask jobs
+# status`)
+PUBLIC_FIELDS = ('name', 'schedule', 'running', 'next_run', 'last_finished', 'last_status')
+
+
+def status(conn):
+    now = _format(datetime.datetime.now())
+    jobs = []
+    for row in conn.execute("""
+        SELECT name, next_run, locked_by, locked_until, attempts, last_started, last_finished,
+               last_status, last_result, last_error
+        FROM jobs ORDER BY name
+    """):
+        job = dict(row)
+        job['schedule'] = JOBS[job['name']][1] if job['name'] in JOBS else None
+        job['running'] = bool(job['locked_until'] and job['locked_until'] >= now)
+        jobs.append(job)
+    return jobs
+
+
+class Scheduler:
+
+    def __init__(self, app, interval=POLL_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._stopping = None
+
+    def ensure_started(self):
+        # Same lazy, fork-aware start as writer.Writer
+        pid = os.getpid()
+        if self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != pid or not self._thread.is_alive():
+                self._stopping = threading.Event()
+                self._thread = threading.Thread(target=self._loop, args=(self._stopping,),
+                                                name='job-scheduler', daemon=True)
+                self._pid = pid
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._stopping.set()
+            self._thread.join(timeout)
+
+    def _loop(self, stopping):
+        while not stopping.is_set():
+            with self.app.app_context():
+                try:
+                    run_due(self.app.config)
+                except sqlite3.Error:
+                    self.app.logger.exception('job scheduler pass failed')
+            stopping.wait(self.interval)
+
+
+def _schedule_label(schedule):
+    return '%dmin' % schedule if isinstance(schedule, int) else schedule
+
+
+cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+
+@cli.command('status')
+def status_command():
+    for path in db.database_paths(current_app.config):
+        if not os.path.exists(path):
+            continue
+        conn = db.connect(path, current_app.config)
+        jobs = status(conn)
+        conn.close()
+        prefix = '%s: ' % os.path.basename(path) if current_app.config['SHARDS'] else ''
+        for job in jobs:
+            click.echo('%s%-18s %-8s next %s  last %s %s' % (
+                prefix, job['name'], 'running' if job['running'] else _schedule_label(job['schedule']), job['next_run'],
+                job['last_status'] or '-', job['last_error'] or job['last_result'] or ''))
+
+
+@cli.command('run')
+@click.argument('name', required=False)
+def run_command(name):
+    # Without a name: whatever is due. With one: that job now, due or not.
+    if name is not None and name not in JOBS:
+        raise click.ClickException('unknown job %r; one of %s' % (name, ', '.join(JOBS)))
+    if name is None:
+        ran = run_due(current_app.config)
+    else:
+        ran = []
+        for path in db.database_paths(current_app.config):
+            if not os.path.exists(path):
+                continue
+            conn = db.connect(path)
+            result = run_job(conn, name, current_app.config, force=True)
+            conn.close()
+            if result is not None:
+                ran.append((path, name) + result)
+    for path, job, result, summary in ran:
+        click.echo('%s %s: %s %s' % (os.path.basename(path), job, result, summary))
+    if not ran:
+        click.echo('nothing to run')
+
+
+@cli.command('worker')
+def worker_command():
+    # The jobs in a process of their own; the default way to run them
+    interval = current_app.config['SCHEDULER_INTERVAL']
+    while True:
+        try:
+            for path, job, result, summary in run_due(current_app.config):
+                click.echo('%s %s: %s %s' % (os.path.basename(path), job, result, summary))
+        except sqlite3.Error as exc:
+            click.echo('scheduler pass failed: %s' % exc, err=True)
+        time.sleep(interval)
+
+
+def init_app(app):
+    app.config.setdefault('SCHEDULER', False)
+    app.config.setdefault('SCHEDULER_INTERVAL', POLL_INTERVAL)
+    app.config.setdefault('SCHEDULER_OFF_PEAK', OFF_PEAK)
+    app.config.setdefault('SYNC_COMPACT_DAYS', COMPACT_DAYS)
+    if app.config['SCHEDULER']:
+        scheduler = app.extensions['scheduler'] = Scheduler(app, app.config['SCHEDULER_INTERVAL'])
+        app.before_request(scheduler.ensure_started)
@@ -0,0 +1,129 @@
+import re
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import archive
+import db
+
+# Transaction search over the transactions_fts index (migration 8).
+#
+# Like rollups and budget spent, the index is maintained by the write path:
+# anything that inserts transactions takes last_id() first and calls
+# index_after() in the same transaction, which indexes the new rows with one
+# INSERT ... SELECT. Updates and deletes are covered by triggers.
+#
+# User input never reaches FTS5 as query syntax: it is split into words,
+# each word is quoted, and the last word (or any word ending in '*') is a
+# prefix match so results update while the user is still typing.
+
+MAX_TERMS = 16
+
+# bm25 column weights: owner, description, category. Lower is better. Not
+# named "rank": that is a hidden column of every FTS5 table.
+RELEVANCE = "bm25(transactions_fts, 0.0, 2.0, 1.0)"
+
+_TERM = re.compile(r'(\w+)(\*?)')
+
+
+def last_id(cursor):
+    return cursor.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+
+
+def index_after(cursor, after_id):
+    # Index every transaction with id > after_id. Ids only grow, and writes
+    # are serialized, so these are exactly the rows this transaction added.
+    cursor.execute("""
+        INSERT INTO transactions_fts (rowid, owner, description, category)
+        SELECT id, 'u' || user_id, COALESCE(description, ''), COALESCE(category, '')
+        FROM transactions
+        WHERE id > ?
+    """, (after_id,))
+
+
+def rebuild(conn):
+    # Archived transactions stay searchable, so they are indexed too
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('delete-all')")
+    cursor.execute("""
+        INSERT INTO transactions_fts (rowid, owner, description, category)
+        SELECT id, 'u' || user_id, COALESCE(description, ''), COALESCE(category, '')
+        FROM %s
+    """ % archive.source(conn))
+    conn.commit()
+
+
+def match_expression(user_id, text):
+    terms = _TERM.findall((text or '').lower())[:MAX_TERMS]
+    if not terms:
+        return None
+    phrases = []
+    for index, (word, star) in enumerate(terms):
+        prefix = star or index == len(terms) - 1
+        phrases.append('"%s"%s' % (word, '*' if prefix else ''))
+    return 'owner:"u%s" AND {description category} : (%s)' % (int(user_id), ' '.join(phrases))
+
+
+def build_query(conn, user_id, match, filters, sort='rank', after=None, limit=50):
+    # filters: dict of optional start_date, end_date, min_amount, max_amount,
+    # account_id, profile_id, category, type. Amount bounds apply to the
+    # magnitude, since expenses are stored negative. The name columns hold
+    # ids for refdata.filler(), like the listing.
+    query = """
+        SELECT t.id, t.amount, t.type, t.category, t.description, t.date, t.is_shared,
+               t.account_id as account_name, t.profile_id as profile_name, t.profile_id as profile_photo,
+               %s AS relevance
+        FROM transactions_fts
+        JOIN {transactions} t ON t.id = transactions_fts.rowid
+        WHERE transactions_fts MATCH ? AND t.user_id = ?
+    """ % RELEVANCE
+    params = [match, user_id]
+
+    if filters.get('start_date'):
+        query += " AND t.date >= ?"
+        params.append(filters['start_date'])
+    if filters.get('end_date'):
+        query += " AND t.date < date(?, '+1 day')"
+        params.append(filters['end_date'])
+    if filters.get('min_amount') is not None:
+        query += " AND ABS(t.amount) >= ?"
+        params.append(filters['min_amount'])
+    if filters.get('max_amount') is not None:
+        query += " AND ABS(t.amount) <= ?"
+        params.append(filters['max_amount'])
+    for column in ('account_id', 'profile_id', 'category', 'type'):
+        if filters.get(column) is not None:
+            query += " AND t.%s = ?" % column
+            params.append(filters[column])
+
+    # Keyset pagination on (relevance, id) or (date, id), like the listing
+    if sort == 'date':
+        if after is not None:
+            query += " AND (t.date, t.id) < (?, ?)"
+            params.extend(after)
+        order = " ORDER BY t.date DESC, t.id DESC"
+    else:
+        if after is not None:
+            query += " AND (%s, t.id) > (?, ?)" % RELEVANCE
+            params.extend(after)
+        order = " ORDER BY relevance, t.id"
+
+    query, params = archive.union(conn, query, params, filters.get('start_date'))
+    query += order
+
+    query += " LIMIT ?"
+    params.append(limit)
+    return query, params
+
+
+cli = AppGroup('search', help='Maintain the transaction search index.')
+
+
+@cli.command('rebuild')
+def rebuild_command():
+    for path in db.database_paths(current_app.config):
+        conn = db.connect(path)
+        rebuild(conn)
+        conn.close()
+    click.echo('search index rebuilt')
@@ -0,0 +1,138 @@
+import click
+from flask import current_app
+
+import balances
+import budgeting
+import db
+import migrations
+import rollups
+import search
+import shards
+
+# Demo data for local development: the 'demo' user (password 'password')
+# with two household profiles, five accounts and a month of transactions and
+# budgets. Run with `flask db seed` after `flask db upgrade`.
+
+
+def seed_demo(conn):
+    # Returns False without touching anything when the demo user exists
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM users WHERE username = 'demo'")
+    if cursor.fetchone():
+        return False
+
+    cursor.execute(
+        "INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+        ('demo', 'demo@example.com', 'password')  # In production, hash the password!
+    )
+
+    # Get the user ID
+    user_id = cursor.lastrowid
+
+    # Insert demo profiles
+    profiles = [
+        (user_id, 'Dr. Ravi', 'primary', 'profile_ravi.jpg', 1),
+        (user_id, 'Mrs. Ravi', 'spouse', 'profile_spouse.jpg', 1)
+    ]
+    cursor.executemany(
+        "INSERT INTO profiles (user_id, name, type, photo_url, is_active) VALUES (?, ?, ?, ?, ?)",
+        profiles
+    )
+
+    # Get profile IDs
+    cursor.execute("SELECT id FROM profiles WHERE user_id = ? AND type = 'primary'", (user_id,))
+    primary_profile_id = cursor.fetchone()[0]
+    cursor.execute("SELECT id FROM profiles WHERE user_id = ? AND type = 'spouse'", (user_id,))
+    spouse_profile_id = cursor.fetchone()[0]
+
+    # Insert demo accounts
+    accounts = [
+        (user_id, 'HDFC Bank', 'Checking', 25000),
+        (user_id, 'ICICI Bank', 'Savings', 75000),
+        (user_id, 'Cash', 'Cash', 5000),
+        (user_id, 'Zerodha', 'Investment', 150000),
+        (user_id, 'Spouse Salary Account', 'Checking', 35000)
+    ]
+    cursor.executemany(
+        "INSERT INTO accounts (user_id, name, type, balance) VALUES (?, ?, ?, ?)",
+        accounts
+    )
+
+    # Insert demo transactions
+    transactions = [
+        # Primary profile transactions
+        (user_id, 1, primary_profile_id, -2500, 'expense', 'Food', 'Grocery shopping', 0, '2023-04-15'),
+        (user_id, 2, primary_profile_id, 45000, 'income', 'Salary', 'Monthly salary', 0, '2023-04-01'),
+        (user_id, 3, primary_profile_id, -1850, 'expense', 'Utilities', 'Electricity bill', 1, '2023-04-10'),
+
+        # Spouse profile transactions
+        (user_id, 5, spouse_profile_id, 35000, 'income', 'Salary', 'Monthly salary', 0, '2023-04-01'),
+        (user_id, 5, spouse_profile_id, -1200, 'expense', 'Shopping', 'Clothes shopping', 0, '2023-04-05'),
+
+        # Shared transactions
+        (user_id, 1, None, -3200, 'expense', 'Food', 'Restaurant dinner', 1, '2023-04-08'),
+        (user_id, 4, None, 12500, 'income', 'Investment', 'Dividend', 1, '2023-04-05'),
+        (user_id, 1, None, -999, 'expense', 'Utilities', 'Mobile bill', 1, '2023-04-12'),
+        (user_id, 2, primary_profile_id, 15000, 'income', 'Freelance', 'Website project', 0, '2023-04-07'),
+        (user_id, 1, None, -800, 'expense', 'Entertainment', 'Movie tickets', 1, '2023-04-09'),
+        (user_id, 3, None, -1499, 'expense', 'Utilities', 'Internet bill', 1, '2023-04-11'),
+        (user_id, 1, None, -18000, 'expense', 'Housing', 'Rent payment', 1, '2023-04-03')
+    ]
+    first_id = search.last_id(cursor)
+    cursor.executemany(
+        "INSERT INTO transactions (user_id, account_id, profile_id, amount, type, category, description, is_shared, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        transactions
+    )
+    search.index_after(cursor, first_id)
+    rollups.record(cursor, user_id, [(tx[8], tx[4], tx[5], tx[3]) for tx in transactions])
+    balances.record(cursor, user_id, [(tx[1], tx[8], tx[3]) for tx in transactions])
+    # The demo balances above are today's; the opening balances are what
+    # they were before the demo transactions
+    cursor.execute("""
+        UPDATE accounts SET opening_balance = balance - (
+            SELECT COALESCE(SUM(t.amount), 0) FROM transactions t WHERE t.account_id = accounts.id
+        )
+        WHERE user_id = ?
+    """, (user_id,))
+
+    # Insert demo budgets
+    budgets = [
+        (user_id, 'Food', 10000, 'monthly', '2023-04-01', '2023-04-30'),
+        (user_id, 'Utilities', 5000, 'monthly', '2023-04-01', '2023-04-30'),
+        (user_id, 'Housing', 20000, 'monthly', '2023-04-01', '2023-04-30'),
+        (user_id, 'Entertainment', 3000, 'monthly', '2023-04-01', '2023-04-30'),
+        (user_id, 'Transportation', 4000, 'monthly', '2023-04-01', '2023-04-30')
+    ]
+    cursor.executemany(
+        "INSERT INTO budgets (user_id, category, amount, period, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?)",
+        budgets
+    )
+    budgeting.recompute_user(cursor, user_id)
+
+    conn.commit()
+    return True
+
+
+def seed(config):
+    # Seeds the catalog; with sharding the new rows then move to their shard
+    conn = db.connect(config['DATABASE'], config)
+    try:
+        seeded = seed_demo(conn)
+    finally:
+        conn.close()
+    if seeded and config['SHARDS']:
+        shards.split(config)
+    return seeded
+
+
+@click.command('seed')
+def seed_command():
+    conn = db.connect(current_app.config['DATABASE'])
+    try:
+        stale = migrations.pending(conn)
+    finally:
+        conn.close()
+    if stale:
+        raise click.ClickException("schema is not up to date; run 'flask db upgrade' first")
+    seeded = seed(current_app.config)
+    click.echo('demo user created' if seeded else 'demo user already exists')
@@ -0,0 +1,164 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import db
+import migrations
+import search
+
+# Tooling for sharded storage (SHARDS = N, see db.py for the routing).
+#
+# `flask shards split` moves an existing single-file database into N shards:
+# users stay in the catalog, every row that belongs to a user is copied into
+# shard user_id % N with its id unchanged, and only then deleted from the
+# catalog. `flask shards query` runs one read-only statement on every shard
+# for admin reports that used to be a single SELECT.
+
+# Every table keyed by user_id, i.e. everything except users and the
+# bookkeeping tables. transactions_fts is rebuilt per shard instead of copied.
+DATA_TABLES = ('accounts', 'profiles', 'transactions', 'budgets', 'monthly_rollups', 'user_versions',
+               'balance_months', 'balance_checkpoints', 'changes', 'api_keys',
+               'recurring_series', 'forecast_flows', 'forecast_state')
+
+
+class ShardingError(RuntimeError):
+    pass
+
+
+def split(config):
+    # Safe to re-run after a failure: rows keep their ids, rows already in a
+    # shard are skipped, and the catalog copy is deleted only after every
+    # shard has committed. Returns the number of rows copied into each shard.
+    count = config['SHARDS']
+    if not count:
+        raise ShardingError('SHARDS is not set')
+    if os.path.exists(db.archive_path(config['DATABASE'])):
+        raise ShardingError('the catalog has an archive; split before archiving old transactions')
+    catalog = db.connect(config['DATABASE'], config)
+    try:
+        if migrations.pending(catalog):
+            raise ShardingError("schema is not up to date; run 'flask db upgrade' first")
+    finally:
+        catalog.close()
+
+    copied = []
+    for index in range(count):
+        path = db.shard_path(config, index)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = db.connect(path, config)
+        try:
+            migrations.upgrade(conn)
+            conn.execute("ATTACH DATABASE ? AS catalog", (config['DATABASE'],))
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            rows = 0
+            for table in DATA_TABLES:
+                # By name: on a legacy catalog migration 2 appended columns
+                # that a new shard has in the middle
+                columns = ', '.join(row['name'] for row in conn.execute("PRAGMA catalog.table_info(%s)" % table))
+                cursor.execute("INSERT OR IGNORE INTO main.{0} ({1}) SELECT {1} FROM catalog.{0} WHERE user_id % ? = ?"
+                               .format(table, columns), (count, index))
+                rows += cursor.rowcount
+            conn.commit()
+            conn.execute("DETACH DATABASE catalog")
+            if rows:
+                search.rebuild(conn)
+        finally:
+            conn.close()
+        copied.append(rows)
+
+    catalog = db.connect(config['DATABASE'], config)
+    try:
+        cursor = catalog.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        for table in DATA_TABLES:
+            cursor.execute("DELETE FROM %s" % table)
+        catalog.commit()
+    finally:
+        catalog.close()
+    return copied
+
+
+def _query_shard(path, sql, params, config):
+    conn = db.connect(path, config)
+    try:
+        conn.execute("PRAGMA query_only = 1")
+        cursor = db.tuple_cursor(conn)
+        cursor.execute(sql, params)
+        return [column[0] for column in cursor.description or ()], cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def query_all(config, sql, params=()):
+    # Run a read-only statement on every shard in parallel (SQLite releases
+    # the GIL while it works). Returns (column names, rows) with the shard
+    # index prepended to every row; aggregates are per shard.
+    count = config['SHARDS']
+    if not count:
+        raise ShardingError('SHARDS is not set')
+    paths = [db.shard_path(config, index) for index in range(count)]
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        results = list(pool.map(lambda path: _query_shard(path, sql, params, config), paths))
+    names = ['shard'] + results[0][0]
+    rows = [(index,) + tuple(row) for index, (_, shard_rows) in enumerate(results) for row in shard_rows]
+    return names, rows
+
+
+cli = AppGroup('shards', help='Split the database into shards and query across them.')
+
+
+@cli.command('split')
+def split_command():
+    try:
+        copied = split(current_app.config)
+    except ShardingError as exc:
+        raise click.ClickException(str(exc))
+    for index, rows in enumerate(copied):
+        click.echo('%s: %d rows' % (os.path.basename(db.shard_path(current_app.config, index)), rows))
+
+
+@cli.command('query')
+@click.argument('sql')
+@click.argument('params', nargs=-1)
+def query_command(sql, params):
+    try:
+        names, rows = query_all(current_app.config, sql, params)
+    except ShardingError as exc:
+        raise click.ClickException(str(exc))
+    click.echo('\t'.join(names))
+    for row in rows:
+        click.echo('\t'.join('' if value is None else str(value) for value in row))
+
+
+@cli.command('stats')
+def stats_command():
+    try:
+        names, rows = query_all(current_app.config, """
+            SELECT (SELECT COUNT(*) FROM accounts), (SELECT COUNT(DISTINCT user_id) FROM accounts),
+                   (SELECT COUNT(*) FROM transactions)
+        """)
+    except ShardingError as exc:
+        raise click.ClickException(str(exc))
+    click.echo('%-12s %8s %8s %12s %10s' % ('shard', 'accounts', 'users', 'transactions', 'MB'))
+    for index, accounts, users, transactions in rows:
+        path = db.shard_path(current_app.config, index)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        click.echo('%-12s %8d %8d %12d %10.1f' % (os.path.basename(path), accounts, users, transactions,
+                                                 size / 1048576.0))
+
+
+@cli.command('locate')
+@click.argument('username')
+def locate_command(username):
+    conn = db.connect(current_app.config['DATABASE'])
+    row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+    conn.close()
+    if row is None:
+        click.echo('no such user: %s' % username, err=True)
+        sys.exit(1)
+    click.echo('user %d: %s' % (row['id'], db.user_database(current_app.config, row['id'])))
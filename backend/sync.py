@@ -0,0 +1,193 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import archive
+import db
+
+# Delta sync (migration 10).
+#
+# Every write path logs the rows it touched in `changes` inside its own
+# transaction, after cache.bump_version(), so each entry carries the user's
+# new data version. That version is the sync token: GET /api/sync?since=<token>
+# returns every row whose latest change is newer than the token, read in one
+# snapshot, and the token to send next time. The table keeps one entry per
+# row, so it grows with the rows changed rather than with the writes.
+#
+# A client with no token, a token older than the user's sync_floor (entries
+# up to the floor were compacted away) or one from the future gets
+# {"reset": true} and the current token: it reloads the list endpoints once,
+# then syncs from that token. Rows changed during the reload come back on the
+# next sync and are applied again, which is harmless.
+
+ENTITIES = {
+    'transactions': """
+        SELECT t.id, t.amount, t.type, t.category, t.description, t.date, t.is_shared,
+               t.account_id, t.profile_id,
+               a.name as account_name, p.name as profile_name, p.photo_url as profile_photo
+        FROM {transactions} t
+        JOIN accounts a ON t.account_id = a.id
+        LEFT JOIN profiles p ON t.profile_id = p.id
+        WHERE t.user_id = ? AND t.id IN (%s)
+    """,
+    'accounts': "SELECT id, name, type, balance FROM accounts WHERE user_id = ? AND id IN (%s)",
+    'profiles': "SELECT id, name, type, photo_url, is_active FROM profiles WHERE user_id = ? AND id IN (%s)",
+    'budgets': """
+        SELECT id, category, amount, period, start_date, end_date, spent, recurring
+        FROM budgets WHERE user_id = ? AND id IN (%s)
+    """,
+}
+
+MAX_CHANGES = 5000
+_ID_CHUNK = 500
+
+
+class SyncError(ValueError):
+    pass
+
+
+def record(cursor, user_id, entity, row_ids, deleted=False):
+    # Call after cache.bump_version() in the same transaction
+    cursor.executemany("""
+        INSERT INTO changes (user_id, entity, row_id, version, deleted, changed_at)
+        VALUES (?, ?, ?, (SELECT version FROM user_versions WHERE user_id = ?), ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id, entity, row_id) DO UPDATE SET
+            version = excluded.version, deleted = excluded.deleted, changed_at = excluded.changed_at
+    """, [(user_id, entity, row_id, user_id, int(deleted)) for row_id in row_ids])
+
+
+def _record_select(cursor, user_id, entity, select, params):
+    cursor.execute("""
+        INSERT INTO changes (user_id, entity, row_id, version, deleted, changed_at)
+        SELECT ?, ?, row_id, (SELECT version FROM user_versions WHERE user_id = ?), 0, CURRENT_TIMESTAMP
+        FROM ({select}) WHERE true
+        ON CONFLICT (user_id, entity, row_id) DO UPDATE SET
+            version = excluded.version, deleted = 0, changed_at = excluded.changed_at
+    """.format(select=select), [user_id, entity, user_id] + list(params))
+
+
+def record_ledger(cursor, user_id, after_id):
+    # New transactions (id > after_id) plus what they changed: the balance of
+    # their accounts and the spent counter of budgets they fall into. One
+    # INSERT ... SELECT each, so a bulk import is logged in three statements.
+    _record_select(cursor, user_id, 'transactions', """
+        SELECT id AS row_id FROM transactions WHERE user_id = ? AND id > ?
+    """, (user_id, after_id))
+    _record_select(cursor, user_id, 'accounts', """
+        SELECT DISTINCT account_id AS row_id FROM transactions WHERE user_id = ? AND id > ?
+    """, (user_id, after_id))
+    _record_select(cursor, user_id, 'budgets', """
+        SELECT b.id AS row_id FROM budgets b
+        WHERE b.user_id = ? AND EXISTS (
+            SELECT 1 FROM transactions t
+            WHERE t.user_id = b.user_id AND t.id > ? AND t.type = 'expense'
+                AND t.category = b.category AND t.date BETWEEN b.start_date AND b.end_date
+        )
+    """, (user_id, after_id))
+
+
+def parse_token(value):
+    if value in (None, ''):
+        return None
+    try:
+        token = int(value)
+    except ValueError:
+        raise SyncError('Invalid sync token')
+    if token < 0:
+        raise SyncError('Invalid sync token')
+    return token
+
+
+def _rows(conn, user_id, entity, ids):
+    rows = []
+    for start in range(0, len(ids), _ID_CHUNK):
+        chunk = ids[start:start + _ID_CHUNK]
+        query = ENTITIES[entity].format(transactions=archive.source(conn)) % ','.join('?' * len(chunk))
+        rows.extend(dict(row) for row in conn.execute(query, [user_id] + chunk))
+    return rows
+
+
+def changes_since(conn, user_id, since, limit=MAX_CHANGES):
+    # since: parse_token() result. At most `limit` changes per call, cut at a
+    # version boundary; "more" asks the client to call again with the token.
+    started = not conn.in_transaction
+    if started:
+        conn.execute("BEGIN")  # one snapshot for the log and the rows
+    try:
+        state = conn.execute("SELECT version, sync_floor FROM user_versions WHERE user_id = ?",
+                             (user_id,)).fetchone()
+        version, floor = (state['version'], state['sync_floor']) if state else (0, 0)
+        if since is None or since < floor or since > version:
+            return {'token': str(version), 'reset': True, 'more': False, 'changes': {}}
+
+        entries = conn.execute("""
+            SELECT entity, row_id, version, deleted FROM changes
+            WHERE user_id = ? AND version > ?
+            ORDER BY version
+            LIMIT ?
+        """, (user_id, since, limit + 1)).fetchall()
+        more = len(entries) > limit
+        if more:
+            # Drop the version the limit cut through; a single version bigger
+            # than the limit (a large import) is returned whole
+            cut = entries[limit]['version']
+            entries = [entry for entry in entries if entry['version'] < cut]
+            if not entries:
+                entries = conn.execute("""
+                    SELECT entity, row_id, version, deleted FROM changes
+                    WHERE user_id = ? AND version > ? AND version <= ?
+                """, (user_id, since, cut)).fetchall()
+                more = conn.execute("SELECT 1 FROM changes WHERE user_id = ? AND version > ? LIMIT 1",
+                                    (user_id, cut)).fetchone() is not None
+            version = max(entry['version'] for entry in entries)
+
+        changes = {}
+        for entity in ENTITIES:
+            upserted = [entry['row_id'] for entry in entries if entry['entity'] == entity and not entry['deleted']]
+            deleted = [entry['row_id'] for entry in entries if entry['entity'] == entity and entry['deleted']]
+            if upserted or deleted:
+                changes[entity] = {'upserted': _rows(conn, user_id, entity, upserted), 'deleted': deleted}
+        return {'token': str(version), 'reset': False, 'more': more, 'changes': changes}
+    finally:
+        if started:
+            conn.rollback()
+
+
+def compact(conn, days, user_id=None):
+    # Forget entries older than `days`. Each user's floor moves up to the
+    # newest version forgotten; clients still behind it resync from scratch.
+    where, params = ("AND user_id = ?", [user_id]) if user_id is not None else ("", [])
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE user_versions SET sync_floor = MAX(sync_floor, (
+            SELECT MAX(c.version) FROM changes c
+            WHERE c.user_id = user_versions.user_id AND c.changed_at < datetime('now', ?)
+        ))
+        WHERE user_id IN (SELECT user_id FROM changes WHERE changed_at < datetime('now', ?) {where})
+    """.format(where=where), ['-%d days' % days, '-%d days' % days] + params)
+    cursor.execute("""
+        DELETE FROM changes
+        WHERE version <= (SELECT sync_floor FROM user_versions u WHERE u.user_id = changes.user_id) {where}
+    """.format(where=where), params)
+    removed = cursor.rowcount
+    conn.commit()
+    return removed
+
+
+cli = AppGroup('sync', help='Maintain the delta sync change log.')
+
+
+@cli.command('compact')
+@click.option('--days', type=int, default=90, show_default=True, help='Keep changes newer than this.')
+@click.option('--user-id', type=int, default=None, help='Only compact this user.')
+def compact_command(days, user_id):
+    if user_id is not None:
+        paths = [db.user_database(current_app.config, user_id)]
+    else:
+        paths = db.database_paths(current_app.config)
+    removed = 0
+    for path in paths:
+        conn = db.connect(path)
+        removed += compact(conn, days, user_id)
+        conn.close()
+    click.echo('removed %d change log entries' % removed)
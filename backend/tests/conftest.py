@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+# The backend is a flat set of modules run from its own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+import db  # noqa: E402
+import migrations  # noqa: E402
+import seed  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    # make_app(**config): an app on its own fresh, seeded database under tmp_path,
+    # without the response cache unless a test asks for it
+    apps = []
+
+    def make(**config):
+        settings = {
+            'TESTING': True,
+            'JWT_SECRET_KEY': 'test-secret-key-of-at-least-32-bytes',
+            'DATABASE': str(tmp_path / ('app%d' % len(apps)) / 'fintrack.db'),
+            'RESPONSE_CACHE_BACKEND': None,
+        }
+        settings.update(config)
+        app = app_module.create_app(settings)
+        migrations.upgrade_all(app.config)
+        seed.seed(app.config)
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        for name in ('upi', 'writer'):
+            extension = app.extensions.get(name)
+            if extension is not None:
+                extension.stop()
+    db.close_thread_connections()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth(client):
+    # Headers for the seeded demo user
+    response = client.post('/api/login', json={'username': 'demo', 'password': 'password'})
+    return {'Authorization': 'Bearer ' + response.get_json()['access_token']}
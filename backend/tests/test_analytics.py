@@ -0,0 +1,126 @@
+import datetime
+
+import pytest
+
+import analytics
+import cache
+import db
+
+
+def _login(client):
+    token = client.post('/api/login', json={'username': 'demo', 'password': 'password'}).get_json()['access_token']
+    return {'Authorization': 'Bearer ' + token}
+
+
+def test_apps_keep_their_own_column_cache(make_app):
+    # Same user id and, after one write each, the same data version in both
+    # databases; only the amounts differ
+    totals = []
+    clients = []
+    for amount in (100, 999):
+        client = make_app().test_client()
+        auth = _login(client)
+        client.get('/api/analytics', headers=auth)
+        account = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+        response = client.post('/api/transactions', headers=auth, json={
+            'account_id': account, 'amount': amount, 'type': 'expense', 'category': 'Other'})
+        assert response.status_code == 201
+        clients.append((client, auth))
+    for client, auth in clients:
+        totals.append(client.get('/api/analytics?group_by=category', headers=auth).get_json())
+    assert totals[0] != totals[1]
+
+
+def _columns(rows):
+    rows = [dict(zip(('date', 'amount', 'type', 'category', 'account_id', 'profile_id', 'description'), row))
+            for row in rows]
+    return analytics.Columns(rows, {1: 'Savings'}, {})
+
+
+ROWS = [
+    ('2024-01-07', -100.0, 'expense', 'Food', 1, None, 'Cafe'),    # Sunday
+    ('2024-01-08', -50.5, 'expense', 'Food', 1, None, 'Cafe'),     # Monday
+    ('2024-01-08', -30.0, 'expense', 'Travel', 1, None, 'Metro'),
+    ('2024-02-14 19:30:00', -20.0, 'expense', 'Food', 1, None, 'Cafe'),
+    ('2024-02-01', 5000.0, 'income', 'Salary', 1, None, 'ACME'),
+    ('2023-01-10', -40.0, 'expense', 'Food', 1, None, 'Cafe'),
+]
+
+
+def test_weeks_start_on_monday():
+    result = analytics.report(_columns(ROWS), datetime.date(2024, 1, 1), datetime.date(2024, 1, 14),
+                              granularity='week', group_by='none')
+    assert result['periods'] == ['2024-01-01', '2024-01-08']
+    assert result['series'] == [{'key': None, 'label': 'Total', 'values': [100.0, 80.5], 'total': 180.5}]
+
+
+def test_month_quarter_and_metrics():
+    columns = _columns(ROWS)
+    start, end = datetime.date(2024, 1, 1), datetime.date(2024, 3, 31)
+    months = analytics.report(columns, start, end)
+    assert months['periods'] == ['2024-01', '2024-02', '2024-03']
+    assert {item['key']: item['values'] for item in months['series']} == {
+        'Food': [150.5, 20.0, 0.0], 'Travel': [30.0, 0.0, 0.0]}
+
+    quarter = analytics.report(columns, start, end, granularity='quarter', metric='count', group_by='account')
+    assert quarter['periods'] == ['2024-Q1']
+    assert quarter['series'] == [{'key': 1, 'label': 'Savings', 'values': [4], 'total': 4}]
+
+    income = analytics.report(columns, start, end, tx_type='income', metric='avg', group_by='none')
+    assert income['series'][0]['values'] == [0.0, 5000.0, 0.0]
+
+
+def test_year_over_year_and_top_merchants():
+    result = analytics.report(_columns(ROWS), datetime.date(2024, 1, 1), datetime.date(2024, 1, 31),
+                              group_by='none', compare=True, top=1)
+    (series,) = result['series']
+    assert series['previous'] == [40.0]
+    assert series['yoy_delta'] == [140.5]
+    assert series['yoy_pct'] == [351.2]
+    assert result['top_merchants'] == [{'description': 'Cafe', 'amount': 150.5, 'count': 2}]
+
+
+def test_parse_args_rejects_bad_input():
+    today = datetime.date(2024, 6, 30)
+    assert analytics.parse_args({}, today)['start'] == datetime.date(2023, 7, 1)
+    for args in ({'start_date': '2024-13-01'}, {'top': '0'}, {'account_id': 'x'}):
+        with pytest.raises(analytics.AnalyticsError):
+            analytics.parse_args(args, today)
+    with pytest.raises(analytics.AnalyticsError):
+        analytics.report(_columns(ROWS), datetime.date(2024, 2, 1), datetime.date(2024, 1, 1))
+    with pytest.raises(analytics.AnalyticsError):
+        analytics.report(_columns(ROWS), datetime.date(2000, 1, 1), datetime.date(2024, 1, 1), granularity='day')
+
+
+def test_endpoint_matches_sql(app, client, auth):
+    result = client.get('/api/analytics?start_date=2000-01-01&granularity=year', headers=auth).get_json()
+    conn = db.connect(app.config['DATABASE'], app.config)
+    expected = {row[0]: round(-row[1], 2) for row in conn.execute(
+        "SELECT category, SUM(amount) FROM transactions WHERE user_id = 1 AND type = 'expense' GROUP BY category")}
+    conn.close()
+    assert {item['key']: item['total'] for item in result['series']} == expected
+
+
+def test_epoch_days_drops_unreadable_dates():
+    days, valid = analytics.epoch_days(['1970-01-02', '2024-02-14 19:30:00', '15/04/2024', None])
+    assert valid.tolist() == [True, True, False, False]
+    assert days[:2].tolist() == [1, 19767]
+
+
+def test_bad_dates_are_refused_and_legacy_ones_skipped(app, client, auth):
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    response = client.post('/api/transactions', headers=auth, json={
+        'account_id': account_id, 'amount': 10, 'type': 'expense', 'category': 'Food', 'date': '15/04/2024'})
+    assert response.status_code == 400
+    before = client.get('/api/analytics', headers=auth).get_json()
+
+    # Rows written before dates were checked
+    conn = db.connect(app.config['DATABASE'], app.config)
+    conn.executemany("INSERT INTO transactions (user_id, account_id, amount, type, category, date) "
+                     "VALUES (1, ?, -10, 'expense', 'Food', ?)", [(account_id, '15/04/2024'), (account_id, None)])
+    cache.bump_version(conn.cursor(), 1)
+    conn.commit()
+    conn.close()
+    response = client.get('/api/analytics', headers=auth)
+    assert response.status_code == 200
+    assert response.get_json() == before
@@ -0,0 +1,39 @@
+import datetime
+
+import archive
+import db
+import rollups
+
+from test_importers import HDFC_CSV, _import
+
+READS = ('/api/transactions', '/api/transactions?start_date=2024-01-01&end_date=2024-12-31',
+         '/api/transactions?category=Food', '/api/dashboard', '/api/networth',
+         '/api/analytics?start_date=2023-06-01&end_date=2026-01-01&granularity=month',
+         '/api/transactions/search?q=tea')
+
+
+def test_horizon():
+    assert archive.horizon(24, datetime.date(2026, 10, 17)) == '2024-10-01'
+    assert archive.horizon(10, datetime.date(2026, 10, 17)) == '2025-12-01'
+
+
+def test_reads_are_unchanged_by_archiving(app, client, auth):
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    assert _import(client, auth, account_id, HDFC_CSV).get_json()['imported'] == 4
+    responses = {path: client.get(path, headers=auth) for path in READS}
+    assert all(response.status_code == 200 for response in responses.values())
+    before = {path: response.get_json() for path, response in responses.items()}
+
+    result = app.test_cli_runner().invoke(args=['archive', 'run', '--months', '12'])
+    assert result.exit_code == 0, result.output
+    conn = db.connect(app.config['DATABASE'], app.config)
+    assert archive.status(conn)['archived_rows'] >= 4
+    assert rollups.verify(conn) == []
+    conn.close()
+
+    for path in READS:
+        assert client.get(path, headers=auth).get_json() == before[path], path
+
+    # Dedupe sees the archived rows
+    again = _import(client, auth, account_id, HDFC_CSV).get_json()
+    assert (again['imported'], again['duplicates']) == (0, 4)
@@ -0,0 +1,127 @@
+import asyncio
+import io
+import json
+
+import asgi
+
+
+def _scope(method, path, headers=(), query_string=b''):
+    return {
+        'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'root_path': '',
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000),
+    }
+
+
+def _call(application, method, path, body=b'', headers=(), chunks=1):
+    # Runs one request through the ASGI app, the body sent in `chunks`
+    # messages; returns (status, headers, body)
+    size = len(body) // chunks + 1
+    incoming = [{'type': 'http.request', 'body': body[i:i + size], 'more_body': i + size < len(body)}
+                for i in range(0, max(len(body), 1), size)]
+    response = {'status': None, 'headers': {}, 'body': b''}
+
+    async def run():
+        finished = asyncio.Event()
+
+        async def receive():
+            if incoming:
+                return incoming.pop(0)
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = {name.decode(): value.decode() for name, value in message['headers']}
+            else:
+                response['body'] += message.get('body', b'')
+
+        await application(_scope(method, path, headers), receive, send)
+        finished.set()
+
+    asyncio.run(run())
+    return response['status'], response['headers'], response['body']
+
+
+def test_repeated_headers_are_merged():
+    environ = asgi._environ(_scope('GET', '/', [
+        ('cookie', 'a=1'), ('cookie', 'b=2'),
+        ('accept', 'text/html'), ('accept', 'application/json'),
+        ('content-type', 'application/json'),
+    ]), io.BytesIO())
+    assert environ['HTTP_COOKIE'] == 'a=1; b=2'
+    assert environ['HTTP_ACCEPT'] == 'text/html,application/json'
+    assert environ['CONTENT_TYPE'] == 'application/json'
+    assert environ['wsgi.input_terminated']
+
+
+def test_requests_run_through_the_flask_app(app):
+    application = asgi.AsgiApp(app, threads=2)
+    try:
+        login = json.dumps({'username': 'demo', 'password': 'password'}).encode()
+        status, _, body = _call(application, 'POST', '/api/login', login,
+                                [('content-type', 'application/json')], chunks=3)
+        assert status == 200
+        headers = [('authorization', 'Bearer ' + json.loads(body)['access_token'])]
+
+        status, response_headers, body = _call(application, 'GET', '/api/accounts', headers=headers)
+        assert status == 200
+        assert response_headers['content-type'].startswith('application/json')
+        assert len(json.loads(body)) == 5
+    finally:
+        application.executor.shutdown()
+
+
+def test_sheds_load_past_max_pending(app):
+    application = asgi.AsgiApp(app, threads=1, max_pending=1)
+    application.in_flight = 1  # as if one request were already running
+    try:
+        status, headers, _ = _call(application, 'GET', '/api/accounts')
+        assert status == 503
+        assert headers['retry-after'] == '1'
+    finally:
+        application.executor.shutdown()
+
+
+def test_uploads_count_as_in_flight(app):
+    application = asgi.AsgiApp(app, threads=1, max_pending=1)
+    responses = []
+
+    async def run():
+        uploading = asyncio.Event()
+        rest = asyncio.Event()
+
+        async def slow_receive():
+            # First half of the body, then a stall
+            if not uploading.is_set():
+                uploading.set()
+                return {'type': 'http.request', 'body': b'{"username": ', 'more_body': True}
+            await rest.wait()
+            return {'type': 'http.disconnect'}
+
+        read = []
+
+        async def receive():
+            read.append(True)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                responses.append(message['status'])
+
+        slow = asyncio.create_task(application(_scope('POST', '/api/login'), slow_receive, send))
+        await uploading.wait()
+        assert application.in_flight == 1
+        await application(_scope('GET', '/api/accounts'), receive, send)
+        # Refused without reading its body
+        assert read == []
+        rest.set()
+        await slow
+        assert application.in_flight == 0
+
+    try:
+        asyncio.run(run())
+        assert responses == [503]
+    finally:
+        application.executor.shutdown()
@@ -0,0 +1,26 @@
+import jwt
+from flask_jwt_extended import decode_token
+
+
+def test_login_issues_a_string_subject(app, client):
+    response = client.post('/api/login', json={'username': 'demo', 'password': 'password'})
+    assert response.status_code == 200
+    with app.app_context():
+        claims = decode_token(response.get_json()['access_token'])
+    assert claims['sub'] == '1'
+
+
+def test_integer_subject_is_rejected(app, client, auth):
+    # Why login stringifies the id: PyJWT 2.10+ refuses a non-string "sub"
+    token = auth['Authorization'].split()[1]
+    with app.app_context():
+        claims = decode_token(token)
+    claims['sub'] = 1
+    forged = jwt.encode(claims, app.config['JWT_SECRET_KEY'], algorithm='HS256')
+    assert client.get('/api/accounts', headers={'Authorization': 'Bearer ' + forged}).status_code == 422
+    assert client.get('/api/accounts', headers=auth).status_code == 200
+
+
+def test_wrong_password(client):
+    response = client.post('/api/login', json={'username': 'demo', 'password': 'nope'})
+    assert response.status_code == 401
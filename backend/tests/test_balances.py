@@ -0,0 +1,101 @@
+import datetime
+
+import pytest
+
+import balances
+import db
+
+SPREAD = ((1, 700, 'expense', '2023-03-20'), (2, 1000, 'income', '2023-05-10'), (1, 250, 'expense', '2023-05-31'),
+          (3, 90, 'expense', '2023-06-02'), (2, 40, 'expense', '2023-07-15'))
+
+
+def _spread(client, auth):
+    for account_id, amount, kind, date in SPREAD:
+        response = client.post('/api/transactions', headers=auth, json={
+            'account_id': account_id, 'amount': amount, 'type': kind, 'category': 'Other', 'date': date})
+        assert response.status_code == 201
+
+
+def _ledger(conn, date):
+    # Every account's balance at the end of `date`, straight from the ledger
+    return {row[0]: round(row[1], 2) for row in conn.execute("""
+        SELECT a.id, a.opening_balance + COALESCE(SUM(t.amount), 0)
+        FROM accounts a LEFT JOIN transactions t ON t.account_id = a.id AND t.date < date(?, '+1 day')
+        WHERE a.user_id = 1
+        GROUP BY a.id
+    """, (date,))}
+
+
+def test_period_ends():
+    weeks = balances.period_ends(datetime.date(2023, 4, 5), datetime.date(2023, 4, 20), 'week')
+    assert weeks == [('2023-04-03', datetime.date(2023, 4, 9)), ('2023-04-10', datetime.date(2023, 4, 16)),
+                     ('2023-04-17', datetime.date(2023, 4, 20))]
+    quarters = balances.period_ends(datetime.date(2023, 2, 1), datetime.date(2023, 8, 1), 'quarter')
+    assert quarters == [('2023-Q1', datetime.date(2023, 3, 31)), ('2023-Q2', datetime.date(2023, 6, 30)),
+                        ('2023-Q3', datetime.date(2023, 8, 1))]
+    with pytest.raises(balances.BalanceError):
+        balances.period_ends(datetime.date(2000, 1, 1), datetime.date(2023, 1, 1), 'day')
+
+
+@pytest.mark.parametrize('granularity', balances.GRANULARITIES)
+def test_history_matches_the_ledger(app, client, auth, granularity):
+    _spread(client, auth)
+    conn = db.connect(app.config['DATABASE'], app.config)
+    result = balances.history(conn, 1, datetime.date(2023, 3, 10), datetime.date(2023, 7, 12), granularity)
+    assert len(result['dates']) == len(result['periods']) == len(result['net_worth'])
+    for index, date in enumerate(result['dates']):
+        expected = _ledger(conn, date)
+        assert {account['id']: account['balances'][index] for account in result['accounts']} == expected, date
+        assert result['net_worth'][index] == pytest.approx(sum(expected.values()))
+    conn.close()
+
+
+def test_networth_endpoint(client, auth):
+    _spread(client, auth)
+    today = client.get('/api/networth', headers=auth).get_json()
+    accounts = client.get('/api/accounts', headers=auth).get_json()
+    assert today['granularity'] == 'month' and len(today['periods']) == 13
+    assert today['net_worth'][-1] == pytest.approx(sum(account['balance'] for account in accounts))
+
+    one = client.get('/api/networth?start_date=2023-04-10&end_date=2023-04-10&account_id=2',
+                     headers=auth).get_json()
+    assert one['dates'] == ['2023-04-10'] and [account['id'] for account in one['accounts']] == [2]
+
+    for query in ('granularity=hour', 'start_date=2023-05-01&end_date=2023-04-01', 'end_date=April',
+                  'account_id=two'):
+        assert client.get('/api/networth?' + query, headers=auth).status_code == 400, query
+
+
+def test_reconcile(app, client, auth):
+    conn = db.connect(app.config['DATABASE'], app.config)
+    assert balances.reconcile(conn) == []
+    first = dict(conn.execute("SELECT last_id, balance FROM balance_checkpoints WHERE account_id = 1").fetchone())
+
+    # Only the rows after the checkpoint are summed from here on
+    _spread(client, auth)
+    assert balances.reconcile(conn) == []
+    moved = dict(conn.execute("SELECT last_id, balance FROM balance_checkpoints WHERE account_id = 1").fetchone())
+    assert moved['last_id'] > first['last_id'] and moved['balance'] == pytest.approx(first['balance'] - 950)
+
+    conn.execute("UPDATE accounts SET balance = balance + 5 WHERE id = 3")
+    conn.commit()
+    mismatches = balances.reconcile(conn)
+    assert [mismatch[:3] for mismatch in mismatches] == [(1, 3, 'Cash')]
+    assert mismatches[0][3] == pytest.approx(mismatches[0][4] + 5)
+    conn.close()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['balances', 'reconcile', '--full'])
+    assert result.exit_code == 1 and 'account 3 (Cash)' in result.output
+    assert runner.invoke(args=['balances', 'rebuild']).exit_code == 0
+
+
+def test_rebuild_restores_history(app, client, auth):
+    _spread(client, auth)
+    conn = db.connect(app.config['DATABASE'], app.config)
+    before = balances.history(conn, 1, datetime.date(2023, 1, 1), datetime.date(2023, 8, 1), 'month')
+    conn.execute("DELETE FROM balance_months")
+    conn.commit()
+    balances.rebuild(conn)
+    assert balances.history(conn, 1, datetime.date(2023, 1, 1), datetime.date(2023, 8, 1), 'month') == before
+    conn.close()
@@ -0,0 +1,35 @@
+import json
+
+import db
+
+
+def _batch(client, auth, requests):
+    response = client.post('/api/batch', headers=auth, json={'requests': requests})
+    assert response.status_code == 200
+    return json.loads(response.get_data())['responses']
+
+
+def test_batch_runs_each_request(client, auth):
+    accounts, missing, budgets = _batch(client, auth, ['/api/accounts', '/api/nope', {'path': '/api/budgets'}])
+    assert accounts['status'] == 200 and len(accounts['body']) == 5
+    assert missing['status'] == 404
+    assert budgets['status'] == 200 and budgets['body'] == client.get('/api/budgets', headers=auth).get_json()
+
+
+def test_batch_rejects_writes(client, auth):
+    response = client.post('/api/batch', headers=auth,
+                           json={'requests': [{'method': 'POST', 'path': '/api/transactions'}]})
+    assert response.status_code == 400
+
+
+def test_sub_requests_get_their_own_route_timeout(monkeypatch, make_app):
+    # Check the deadline on every SQLite instruction so a tiny timeout fires
+    monkeypatch.setattr(db, 'DEADLINE_CHECK_STEPS', 1)
+    app = make_app(QUERY_TIMEOUT=60, ROUTE_TIMEOUTS={'api.get_analytics': 1e-9})
+    client = app.test_client()
+    auth = {'Authorization': 'Bearer ' + client.post(
+        '/api/login', json={'username': 'demo', 'password': 'password'}).get_json()['access_token']}
+
+    analytics, accounts = _batch(client, auth, ['/api/analytics', '/api/accounts'])
+    assert analytics['status'] == 503
+    assert accounts['status'] == 200
@@ -0,0 +1,66 @@
+import pytest
+
+import cache
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def app(request, make_app):
+    return make_app(RESPONSE_CACHE_BACKEND=request.param)
+
+
+def test_etag_and_not_modified(client, auth):
+    first = client.get('/api/budgets', headers=auth)
+    assert first.status_code == 200 and first.headers['ETag']
+    again = client.get('/api/budgets', headers=dict(auth, **{'If-None-Match': first.headers['ETag']}))
+    assert again.status_code == 304
+    assert again.data == b''
+    assert again.headers['ETag'] == first.headers['ETag']
+
+
+def test_same_query_in_any_order_shares_an_entry(client, auth):
+    one = client.get('/api/transactions?category=Food&limit=5', headers=auth)
+    other = client.get('/api/transactions?limit=5&category=Food', headers=auth)
+    assert one.headers['ETag'] == other.headers['ETag']
+    assert one.data == other.data
+
+
+def test_a_write_invalidates(client, auth):
+    before = client.get('/api/accounts', headers=auth)
+    account = before.get_json()[0]
+    client.post('/api/transactions', headers=auth, json={
+        'account_id': account['id'], 'amount': 10, 'type': 'expense', 'category': 'Food'})
+    after = client.get('/api/accounts', headers=dict(auth, **{'If-None-Match': before.headers['ETag']}))
+    assert after.status_code == 200
+    assert after.headers['ETag'] != before.headers['ETag']
+    assert after.get_json()[0]['balance'] == pytest.approx(account['balance'] - 10)
+
+
+def test_memory_store_bounds_body_bytes():
+    store = cache.MemoryStore(max_entries=100, max_bytes=10, max_body=6)
+    store.set('a', (b'aaaa', 'text/plain', []))
+    store.set('b', (b'bbbb', 'text/plain', []))
+    store.set('huge', (b'x' * 7, 'text/plain', []))
+    assert store.get('huge') is None and store.get('a') is not None
+    # 'b' is now the least recently used
+    store.set('c', (b'cccc', 'text/plain', []))
+    assert store.get('b') is None and store.get('a') and store.get('c')
+    store.set('a', (b'a', 'text/plain', []))
+    store.set('d', (b'dddd', 'text/plain', []))
+    assert [store.get(key) is not None for key in 'acd'] == [True, True, True]
+
+
+def test_sqlite_store_touches_hits_lazily(tmp_path):
+    store = cache.SqliteStore(str(tmp_path / 'cache.db'), max_entries=2)
+    conn = store._conn()
+    store.set('a', (b'a', 'text/plain', [('X-Next', '1')]))
+    store.set('b', (b'b', 'text/plain', []))
+    used_at = conn.execute("SELECT used_at FROM response_cache WHERE key = 'a'").fetchone()[0]
+    assert store.get('a') == (b'a', 'text/plain', [('X-Next', '1')])
+    assert conn.execute("SELECT used_at FROM response_cache WHERE key = 'a'").fetchone()[0] == used_at
+
+    # Once older than touch_after a hit still counts for the LRU
+    conn.execute("UPDATE response_cache SET used_at = used_at - 1")
+    conn.commit()
+    assert store.get('a') is not None
+    store.set('c', (b'c', 'text/plain', []))
+    assert store.get('a') is not None and store.get('b') is None
@@ -0,0 +1,104 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import db
+import export
+
+
+def _download(client, auth, query):
+    response = client.get('/api/transactions/export?' + query, headers=auth)
+    assert response.status_code == 200, response.get_json()
+    assert response.is_streamed
+    return response
+
+
+def _seeded(app):
+    conn = db.connect(app.config['DATABASE'], app.config)
+    rows = [list(row) for row in db.tuple_cursor(conn).execute(
+        "SELECT id, date, amount FROM transactions WHERE user_id = 1 ORDER BY date, id")]
+    conn.close()
+    return rows
+
+
+def test_csv_and_jsonl(app, client, auth):
+    expected = _seeded(app)
+    response = _download(client, auth, 'format=csv')
+    assert response.mimetype == 'text/csv'
+    assert response.headers['Content-Disposition'].endswith('.csv"')
+    records = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    assert tuple(records[0]) == export.COLUMNS
+    assert [[int(r[0]), r[1], float(r[2])] for r in records[1:]] == expected
+
+    compressed = _download(client, auth, 'format=csv&compress=gzip')
+    assert compressed.mimetype == 'application/gzip'
+    assert gzip.decompress(compressed.data) == response.data
+
+    lines = _download(client, auth, 'format=jsonl').get_data(as_text=True).splitlines()
+    assert [[row['id'], row['date'], row['amount']] for row in map(json.loads, lines)] == expected
+    assert set(json.loads(lines[0])) == set(export.COLUMNS)
+
+    food = _download(client, auth, 'format=jsonl&category=Food&start_date=2023-04-10&end_date=2023-04-30')
+    assert [json.loads(line)['description'] for line in food.get_data(as_text=True).splitlines()] == [
+        'Grocery shopping']
+    empty = _download(client, auth, 'format=csv&start_date=2030-01-01')
+    assert empty.get_data(as_text=True).splitlines() == [','.join(export.COLUMNS)]
+
+
+def test_bad_formats(client, auth):
+    assert client.get('/api/transactions/export?format=xml', headers=auth).status_code == 400
+    response = client.get('/api/transactions/export?format=parquet&compress=gzip', headers=auth)
+    assert response.status_code == 400
+
+
+def test_parquet(app, client, auth):
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    response = _download(client, auth, 'format=parquet')
+    assert response.mimetype == export.MIMETYPES['parquet']
+    table = pyarrow_parquet.read_table(io.BytesIO(response.data))
+    assert tuple(table.column_names) == export.COLUMNS
+    assert [[row['id'], row['date'], row['amount']] for row in table.to_pylist()] == _seeded(app)
+    assert set(table.column('is_shared').to_pylist()) == {True, False}
+
+
+def test_streams_in_chunks(app, monkeypatch):
+    expected = _seeded(app)
+    conn = db.connect(app.config['DATABASE'], app.config)
+    chunks = list(export._chunks(conn, 1, {}, chunk_size=5))
+    assert [len(rows) for rows in chunks] == [5, 5, 2]
+    assert [[row[0], row[1], row[2]] for rows in chunks for row in rows] == expected
+
+    # One part per chunk, each complete lines
+    parts = list(export._csv(export._chunks(conn, 1, {}, chunk_size=5)))
+    assert len(parts) == 3 and all(part.endswith(b'\r\n') for part in parts)
+    parts = list(export._jsonl(export._chunks(conn, 1, {}, chunk_size=5)))
+    assert [part.count(b'\n') for part in parts] == [5, 5, 2]
+    assert len(gzip.decompress(b''.join(export._gzip(iter(parts))))) == sum(map(len, parts))
+
+    if export.pyarrow is not None:
+        monkeypatch.setattr(export, 'PARQUET_ROW_GROUP', 5)
+        data = b''.join(export._parquet(export._chunks(conn, 1, {}, chunk_size=5)))
+        parquet = export.pyarrow.parquet.ParquetFile(io.BytesIO(data))
+        assert parquet.metadata.num_row_groups == 3 and parquet.metadata.num_rows == 12
+    conn.close()
+
+
+def test_export_command(app, tmp_path):
+    output = tmp_path / 'out.jsonl.gz'
+    result = app.test_cli_runner().invoke(args=['export', '--user-id', '1', '--format', 'jsonl', '--gzip',
+                                                '-o', str(output)])
+    assert result.exit_code == 0, result.output
+    lines = gzip.decompress(output.read_bytes()).decode().splitlines()
+    assert [json.loads(line)['id'] for line in lines] == [row[0] for row in _seeded(app)]
+    result = app.test_cli_runner().invoke(args=['export', '--user-id', '1', '--format', 'parquet', '--gzip'])
+    assert result.exit_code != 0 and 'already compressed' in result.output
+
+
+def test_archived_rows_are_exported(app, client, auth):
+    before = _download(client, auth, 'format=csv').data
+    assert app.test_cli_runner().invoke(args=['archive', 'run', '--months', '12']).exit_code == 0
+    assert _seeded(app) == []
+    assert _download(client, auth, 'format=csv').data == before
@@ -0,0 +1,108 @@
+import datetime
+
+import pytest
+
+import db
+import forecast
+
+
+def test_pattern_ignores_references_and_months():
+    assert forecast.pattern('NEFT-12345-RENT APR', 'Housing', -25000) == 'neft rent'
+    assert forecast.pattern('NEFT-12377-RENT MAY', 'Housing', -25000) == 'neft rent'
+    assert forecast.pattern(None, 'Utilities', -1200) == forecast.pattern('', 'Utilities', -1250)
+    assert forecast.pattern(None, 'Utilities', -1200) != forecast.pattern(None, 'Utilities', -4000)
+
+
+def test_occurrences():
+    monthly = [name for name, *_ in forecast.CADENCES].index('monthly')
+    dates = forecast.occurrences(datetime.date(2024, 1, 31), monthly, datetime.date(2024, 2, 1),
+                                 datetime.date(2024, 4, 30))
+    assert dates == [datetime.date(2024, 2, 29), datetime.date(2024, 3, 31), datetime.date(2024, 4, 30)]
+    # A little overdue is still expected, today
+    assert forecast.occurrences(datetime.date(2024, 1, 1), monthly, datetime.date(2024, 2, 3),
+                                datetime.date(2024, 2, 10)) == [datetime.date(2024, 2, 3)]
+
+
+def _statement(today):
+    rows = []
+    for months in range(1, 7):
+        day = forecast._add_months(today, -months)
+        rows.append({'date': day.isoformat(), 'amount': -25000 - months, 'category': 'Housing',
+                     'description': 'NEFT-%05d-RENT %s' % (months, day.strftime('%b').upper())})
+    for weeks in range(1, 9):
+        rows.append({'date': (today - datetime.timedelta(weeks=weeks)).isoformat(), 'amount': -800,
+                     'category': 'Food', 'description': 'BIGBASKET ORDER %d' % weeks})
+    for days in (3, 40, 41, 95, 200):
+        rows.append({'date': (today - datetime.timedelta(days=days)).isoformat(), 'amount': -300,
+                     'category': 'Shopping', 'description': 'RANDOM SHOP'})
+    # Used to recur, stopped a year ago
+    for months in range(12, 18):
+        rows.append({'date': forecast._add_months(today, -months).isoformat(), 'amount': -499,
+                     'category': 'Entertainment', 'description': 'OLD STREAMING'})
+    return rows
+
+
+def test_refresh_finds_recurring_series(app, client, auth):
+    today = datetime.date.today()
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    response = client.post('/api/transactions/import?format=json&account_id=%d' % account_id, headers=auth,
+                           json=_statement(today))
+    assert response.status_code == 201
+
+    conn = db.connect(app.config['DATABASE'], app.config)
+    forecast.refresh(conn, [1], today)
+    series = {row['pattern']: dict(row) for row in conn.execute("SELECT * FROM recurring_series WHERE user_id = 1")}
+    conn.close()
+
+    assert series['neft rent']['cadence'] == 'monthly'
+    assert series['neft rent']['occurrences'] == 6
+    assert series['neft rent']['amount'] == -25002.0  # median of the last three
+    assert series['bigbasket order']['cadence'] == 'weekly'
+    assert 'random shop' not in series
+    assert 'old streaming' not in series
+
+    result = client.get('/api/forecast?days=40', headers=auth).get_json()
+    assert result['stale'] is False
+    rent = [flow for flow in result['upcoming'] if flow['category'] == 'Housing' and flow['cadence'] == 'monthly']
+    # The last rent was a month ago, so the next is due today
+    assert rent[0]['date'] == today.isoformat() and rent[0]['amount'] == -25002.0
+
+    client.post('/api/transactions', headers=auth, json={
+        'account_id': account_id, 'amount': 1, 'type': 'expense', 'category': 'Food'})
+    assert client.get('/api/forecast', headers=auth).get_json()['stale'] is True
+    assert client.get('/api/forecast?days=0', headers=auth).status_code == 400
+
+
+def test_one_user_cannot_fail_the_batch(app, client, auth, monkeypatch):
+    today = datetime.date.today()
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    client.post('/api/transactions/import?format=json&account_id=%d' % account_id, headers=auth,
+                json=_statement(today))
+
+    conn = db.connect(app.config['DATABASE'], app.config)
+    other = conn.execute("INSERT INTO users (username, email, password) VALUES ('other', 'o@x', 'pw')").lastrowid
+    other_account = conn.execute("INSERT INTO accounts (user_id, name, type, balance) VALUES (?, 'Bank', 'bank', 0)",
+                                 (other,)).lastrowid
+    conn.executemany("INSERT INTO transactions (user_id, account_id, amount, type, category, description, date) "
+                     "VALUES (?, ?, -10, 'expense', 'Food', ?, ?)",
+                     [(other, other_account, 'POISON', (today - datetime.timedelta(days=days)).isoformat())
+                      for days in (1, 2, 3)] + [(1, account_id, 'LEGACY', '15/04/2024')])
+    conn.commit()
+
+    real_pattern = forecast.pattern
+
+    def pattern(description, category, amount):
+        if description == 'POISON':
+            raise RuntimeError('bad row')
+        return real_pattern(description, category, amount)
+
+    monkeypatch.setattr(forecast, 'pattern', pattern)
+    assert forecast.refresh(conn, [1, other], today)[1] >= 2
+    computed = [row[0] for row in conn.execute("SELECT user_id FROM forecast_state")]
+    assert computed == [1]
+    assert forecast.stale_users(conn) == [other]
+
+    # Nobody left to store: the error is the job's
+    with pytest.raises(RuntimeError):
+        forecast.refresh(conn, [other], today)
+    conn.close()
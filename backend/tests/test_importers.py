@@ -0,0 +1,110 @@
+import io
+
+import pytest
+
+import db
+import importers
+import rollups
+
+HDFC_CSV = '''HDFC BANK Ltd.,,,,,,
+Account No :,50100012345678,,,,,
+,,,,,,
+Date,Narration,Chq./Ref.No.,Value Dt,Withdrawal Amt.,Deposit Amt.,Closing Balance
+05/01/24,UPI-SWIGGY,0000401234,05/01/24,"1,250.00",,"98,750.00"
+06/01/24,NEFT-SALARY ACME,N006240000,06/01/24,,"1,20,000.00","2,18,750.00"
+07/01/24,TEA STALL,,07/01/24,20.00,,"2,18,730.00"
+07/01/24,TEA STALL,,07/01/24,20.00,,"2,18,710.00"
+** End of statement **,,,,,,
+'''
+
+OFX = '''OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240105120000<TRNAMT>-450.50<FITID>F1<NAME>Grocer
+<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240106<TRNAMT>900<FITID>F2<MEMO>Refund
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+'''
+
+
+def _valid(rows):
+    return [row for row in rows if not isinstance(row, importers.StatementError)]
+
+
+def test_parse_csv_bank_statement():
+    rows = list(importers.parse_csv(io.StringIO(HDFC_CSV)))
+    errors = [row for row in rows if isinstance(row, importers.StatementError)]
+    rows = _valid(rows)
+    assert [(row['date'], row['amount'], row['type']) for row in rows] == [
+        ('2024-01-05', -1250.0, 'expense'),
+        ('2024-01-06', 120000.0, 'income'),
+        ('2024-01-07', -20.0, 'expense'),
+        ('2024-01-07', -20.0, 'expense'),
+    ]
+    assert rows[0]['reference'] == '0000401234' and rows[2]['reference'] is None
+    assert len(errors) == 1  # the footer line
+
+
+def test_parse_csv_without_a_header():
+    with pytest.raises(importers.StatementError):
+        list(importers.parse_csv(io.StringIO('just,some\ncells,here\n')))
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1,23,456.78', 123456.78), ('₹ 500', 500.0), ('250.00 Dr', -250.0), ('(75)', -75.0), ('', None),
+])
+def test_parse_amount(value, expected):
+    assert importers.parse_amount(value) == expected
+
+
+def test_parse_ofx():
+    rows = list(importers.parse_ofx(io.StringIO(OFX)))
+    assert [(row['date'], row['amount'], row['description'], row['reference']) for row in rows] == [
+        ('2024-01-05', -450.5, 'Grocer', 'F1'),
+        ('2024-01-06', 900.0, 'Refund', 'F2'),
+    ]
+
+
+def test_parse_json_across_chunks():
+    text = '[{"date": "2024-01-05", "amount": -10, "description": "a"},' \
+           ' {"date": "bad", "amount": 1}, {"date": "06/01/2024", "amount": 5}]'
+    rows = list(importers.parse_json(io.StringIO(text), chunk_size=8))
+    assert isinstance(rows[1], importers.StatementError)
+    assert [(row['date'], row['amount']) for row in _valid(rows)] == [('2024-01-05', -10.0), ('2024-01-06', 5.0)]
+    with pytest.raises(importers.StatementError):
+        list(importers.parse_json(io.StringIO('{"date": "2024-01-05"}')))
+
+
+@pytest.mark.parametrize('filename, mimetype, expected', [
+    ('hdfc.CSV', None, 'csv'), ('stmt.qfx', None, 'ofx'), (None, 'application/json', 'json'),
+    (None, 'text/plain', 'csv'), (None, 'application/octet-stream', None),
+])
+def test_detect_format(filename, mimetype, expected):
+    assert importers.detect_format(filename, mimetype) == expected
+
+
+def _import(client, auth, account_id, body):
+    return client.post('/api/transactions/import?format=csv&account_id=%d' % account_id, headers=auth,
+                       data=body, content_type='text/csv')
+
+
+def test_reimport_is_deduplicated(app, client, auth):
+    account = client.get('/api/accounts', headers=auth).get_json()[0]
+    response = _import(client, auth, account['id'], HDFC_CSV)
+    assert response.status_code == 201
+    result = response.get_json()
+    # Both teas are kept: identical rows in one statement are told apart
+    assert (result['imported'], result['duplicates'], result['errors']) == (4, 0, 1)
+
+    again = _import(client, auth, account['id'], HDFC_CSV).get_json()
+    assert (again['imported'], again['duplicates']) == (0, 4)
+
+    after = {row['id']: row for row in client.get('/api/accounts', headers=auth).get_json()}
+    assert after[account['id']]['balance'] == pytest.approx(account['balance'] - 1250 + 120000 - 40)
+
+    conn = db.connect(app.config['DATABASE'], app.config)
+    assert rollups.verify(conn) == []
+    conn.close()
+
+
+def test_import_into_someone_elses_account(client, auth):
+    assert _import(client, auth, 10 ** 6, HDFC_CSV).status_code == 404
+    assert _import(client, auth, 1, 'no header here\n').status_code == 400
@@ -0,0 +1,26 @@
+import db
+
+
+def test_metrics_is_off_without_a_token(client):
+    assert client.get('/metrics').status_code == 404
+
+
+def test_metrics_needs_the_token(make_app):
+    client = make_app(METRICS_TOKEN='scrape-me').test_client()
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-me'})
+    assert response.status_code == 200
+    assert b'# TYPE' in response.data
+
+
+def test_apps_keep_their_own_connection_settings(make_app):
+    slow = make_app(SLOW_QUERY_MS=0, SQLITE_PRAGMAS={'cache_size': -1000})
+    fast = make_app(SLOW_QUERY_MS=500)
+    for app, threshold, cache_size in ((slow, 0.0, -1000), (fast, 0.5, -20000)):
+        with app.app_context():
+            conn = db.connect(app.config['DATABASE'])
+        assert conn.slow_query_seconds == threshold
+        assert conn.execute("PRAGMA cache_size").fetchone()[0] == cache_size
+        conn.close()
+    assert db.PRAGMAS['cache_size'] == -20000
@@ -0,0 +1,39 @@
+import pytest
+
+import db
+import migrations
+
+
+def _columns(conn):
+    return [row['name'] for row in conn.execute("PRAGMA table_info(accounts)")]
+
+
+def test_a_failed_step_leaves_nothing_behind(app, monkeypatch):
+    conn = db.connect(app.config['DATABASE'], app.config)
+    latest = migrations.latest_version()
+    assert migrations.pending(conn) == []
+
+    def broken(cursor):
+        cursor.execute("ALTER TABLE accounts ADD COLUMN nickname TEXT")
+        raise RuntimeError('step failed halfway')
+
+    def fixed(cursor):
+        cursor.execute("ALTER TABLE accounts ADD COLUMN nickname TEXT")
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS + [(latest + 1, 'nickname', broken)])
+    with pytest.raises(RuntimeError):
+        migrations.upgrade(conn)
+    assert 'nickname' not in _columns(conn)
+    assert migrations.current_version(conn) == latest
+
+    monkeypatch.setattr(migrations, 'MIGRATIONS', migrations.MIGRATIONS[:-1] + [(latest + 1, 'nickname', fixed)])
+    assert migrations.upgrade(conn) == [(latest + 1, 'nickname')]
+    assert 'nickname' in _columns(conn)
+    assert migrations.upgrade(conn) == []
+    conn.close()
+
+
+def test_status_command(app):
+    result = app.test_cli_runner().invoke(args=['db', 'status'])
+    assert result.exit_code == 0, result.output
+    assert 'current version: %d (latest %d)' % ((migrations.latest_version(),) * 2) in result.output
@@ -0,0 +1,120 @@
+import datetime
+import io
+
+import pytest
+
+import cache
+import db
+import instrumentation
+
+# Every endpoint is driven once and the statements it actually ran (on the
+# request thread, the writer thread or inline) are explained against the
+# user's database with the archive attached, so the UNION ALL arms are
+# checked too. A full table scan fails the test.
+
+TODAY = datetime.date.today().isoformat()
+
+STATEMENT = """Date,Narration,Chq./Ref.No.,Value Dt,Withdrawal Amt.,Deposit Amt.,Closing Balance
+01/04/23,UPI-SWIGGY-123,0000312,01/04/23,450.00,,"1,24,550.00"
+02/04/23,SALARY APR,0000313,02/04/23,,"1,20,000.00","2,44,550.00"
+"""
+
+# Tables that only ever hold a row or two
+SMALL_TABLES = ('archive.archive_meta',)
+
+# (method, path, request kwargs or a function of the previous responses)
+REQUESTS = [
+    ('GET', '/api/dashboard', {}),
+    ('GET', '/api/analytics', {}),
+    ('GET', '/api/analytics?granularity=day&start_date=2023-01-01&compare=yoy&category=Food', {}),
+    ('GET', '/api/analytics?group_by=account&granularity=month', {}),
+    ('GET', '/api/forecast', {}),
+    ('GET', '/api/networth', {}),
+    ('GET', '/api/networth?start_date=2023-04-03&end_date=2023-04-17&granularity=day', {}),
+    ('GET', '/api/sync', {}),
+    ('GET', '/api/sync?since=1', {}),
+    ('GET', '/api/transactions', {}),
+    ('GET', '/api/transactions?limit=2', {}),
+    ('GET', '/api/transactions?category=Food&start_date=2023-01-01&end_date=%s' % TODAY, {}),
+    ('GET', '/api/transactions?start_date=%s' % TODAY, {}),
+    ('GET', '/api/transactions?profile_id=1&show_shared=false', {}),
+    ('GET', '/api/transactions?stream=ndjson', {}),
+    ('GET', '/api/transactions/export?format=csv', {}),
+    ('GET', '/api/transactions/search?q=bill', {}),
+    ('GET', '/api/transactions/search?q=bill&sort=rank&category=Utilities', {}),
+    ('POST', '/api/transactions', {'json': {'account_id': 1, 'amount': 10, 'type': 'expense', 'category': 'Food',
+                                            'date': TODAY}}),
+    ('POST', '/api/transactions/import?account_id=2',
+     lambda responses: {'data': {'file': (io.BytesIO(STATEMENT.encode()), 'statement.csv')},
+                        'content_type': 'multipart/form-data'}),
+    ('POST', '/api/api-keys', {'json': {'account_id': 1, 'name': 'UPI Sync'}}),
+    ('GET', '/api/api-keys', {}),
+    ('POST', '/api/upi-webhook', lambda responses: {'json': {
+        'apiKey': responses['POST', '/api/api-keys']['api_key'],
+        'transaction': {'transactionId': 'R1', 'amount': '120.50', 'type': 'sent', 'counterpartyName': 'Shop',
+                        'date': TODAY + 'T10:00:00Z'}}}),
+    ('DELETE', '/api/api-keys/1', {}),
+    ('GET', '/api/accounts', {}),
+    ('GET', '/api/profiles', {}),
+    ('GET', '/api/profiles/1', {}),
+    ('POST', '/api/profiles', {'json': {'name': 'Kid', 'type': 'child'}}),
+    ('PUT', '/api/profiles/1', {'json': {'name': 'Dr. Ravi', 'type': 'primary'}}),
+    ('GET', '/api/budgets', {}),
+    ('GET', '/api/budgets?date=2023-04-10', {}),
+    ('POST', '/api/budgets', {'json': {'category': 'Travel', 'amount': 10}}),
+    ('PUT', '/api/budgets/1', {'json': {'category': 'Food', 'amount': 20, 'period': 'weekly'}}),
+    ('DELETE', '/api/budgets/2', {}),
+    ('POST', '/api/batch', {'json': {'requests': [{'method': 'GET', 'path': '/api/accounts'},
+                                                  {'method': 'GET', 'path': '/api/analytics'}]}}),
+]
+
+
+@pytest.fixture(params=[{}, {'SHARDS': 2}], ids=['single', 'sharded'])
+def app(request, make_app):
+    app = make_app(UPI_QUEUE=False, **request.param)
+    # The demo data is from 2023: everything moves to the archive
+    result = app.test_cli_runner().invoke(args=['archive', 'run', '--months', '12'])
+    assert result.exit_code == 0, result.output
+    return app
+
+
+def test_endpoints_use_indexes(app, client, auth):
+    conn = db.connect(db.user_database(app.config, 1))
+    responses = {}
+    violations = {}
+    for method, path, kwargs in REQUESTS:
+        if callable(kwargs):
+            kwargs = kwargs(responses)
+        with instrumentation.Capture() as capture:
+            response = client.open(path, method=method, headers=auth, **kwargs)
+            response.get_data()  # streamed bodies run their queries here
+        assert response.status_code < 400, (method, path, response.get_data(as_text=True))
+        if response.is_json:
+            responses[method, path] = response.get_json()
+
+        for sql, params in capture.statements:
+            if params is None:  # executemany
+                continue
+            scans = [step for step in instrumentation.full_scans(conn, sql, params)
+                     if step.split()[1] not in SMALL_TABLES]
+            if scans:
+                violations['%s %s: %s' % (method, path, instrumentation.normalize(sql))] = scans
+    conn.close()
+    assert not violations
+
+
+def test_accounts_stay_in_id_order(make_app):
+    app = make_app()
+    client = app.test_client()
+    auth = {'Authorization': 'Bearer ' + client.post(
+        '/api/login', json={'username': 'demo', 'password': 'password'}).get_json()['access_token']}
+    conn = db.connect(app.config['DATABASE'], app.config)
+    conn.executemany("INSERT INTO accounts (user_id, name, type, balance) VALUES (1, ?, ?, 0)",
+                     [('Zeta', 'AAA'), ('Alpha', 'zzz')])
+    cache.bump_version(conn.cursor(), 1)
+    conn.commit()
+    names = [row['name'] for row in conn.execute("PRAGMA index_info(idx_accounts_user_type)")]
+    conn.close()
+    assert names == ['user_id', 'type']
+    ids = [account['id'] for account in client.get('/api/accounts', headers=auth).get_json()]
+    assert ids == sorted(ids)
@@ -0,0 +1,50 @@
+import cache
+import db
+import refdata
+
+
+def test_write_from_another_connection_invalidates(app, monkeypatch):
+    reads = []
+    real_read = refdata._read
+    monkeypatch.setattr(refdata, '_read', lambda *args: reads.append(args[1:]) or real_read(*args))
+
+    with app.app_context():
+        conn = db.get_db()
+        first = refdata.load(conn, 1)
+        assert refdata.load(conn, 1) is first and len(reads) == 1
+
+        # Another worker's write, on its own connection
+        other = db.connect(app.config['DATABASE'], app.config)
+        other.execute("UPDATE accounts SET name = 'HDFC Salary', balance = balance + 1 WHERE id = 1")
+        other.execute("UPDATE profiles SET name = 'Dr. Ravi' WHERE id = 1")
+        cache.bump_version(other.cursor(), 1)
+        other.commit()
+        other.close()
+
+        assert cache.data_version(conn, 1) == first.version + 1
+        reference = refdata.load(conn, 1)
+        assert len(reads) == 2 and reference.version == first.version + 1
+        assert reference.account_name(1) == 'HDFC Salary'
+        assert reference.accounts[1][3] == first.accounts[1][3] + 1
+        assert reference.profile_name(1) == 'Dr. Ravi'
+        assert refdata.load(conn, 1) is reference and len(reads) == 2
+
+
+def test_api_writes_show_up_in_other_workers(make_app):
+    # Two apps on one database stand in for two worker processes
+    app = make_app()
+    other = make_app(DATABASE=app.config['DATABASE'])
+    clients = [app.test_client(), other.test_client()]
+    auth = {'Authorization': 'Bearer ' + clients[0].post(
+        '/api/login', json={'username': 'demo', 'password': 'password'}).get_json()['access_token']}
+
+    before = [client.get('/api/accounts', headers=auth).get_json() for client in clients]
+    assert before[0] == before[1]
+    response = clients[0].put('/api/profiles/1', headers=auth, json={'name': 'Dr. Ravi', 'type': 'primary'})
+    assert response.status_code == 200
+    clients[0].post('/api/transactions', headers=auth, json={
+        'account_id': 1, 'amount': 10, 'type': 'expense', 'category': 'Food'})
+
+    for client in clients:
+        assert client.get('/api/accounts', headers=auth).get_json()[0]['balance'] == before[0][0]['balance'] - 10
+        assert client.get('/api/profiles', headers=auth).get_json()[0]['name'] == 'Dr. Ravi'
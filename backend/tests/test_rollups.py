@@ -0,0 +1,52 @@
+import db
+import rollups
+
+
+def test_record_buckets_by_month():
+    class Cursor:
+        def executemany(self, sql, rows):
+            self.rows = rows
+
+    cursor = Cursor()
+    rollups.record(cursor, 1, [('2024-01-05', 'expense', 'Food', -10.0), ('2024-01-31 18:00', 'expense', 'Food', -5.0),
+                               ('2024-02-01', 'expense', 'Food', -1.0)], sign=-1)
+    assert sorted(cursor.rows) == [(1, '2024-01', 'expense', 'Food', 15.0, -15.0, -2),
+                                   (1, '2024-02', 'expense', 'Food', 1.0, -1.0, -1)]
+
+
+def test_writes_keep_rollups_in_step(app, client, auth):
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    for amount, category, date in ((120, 'Food', '2024-03-02'), (80, 'Food', '2024-03-20'), (60, 'Travel', None)):
+        body = {'account_id': account_id, 'amount': amount, 'type': 'expense', 'category': category}
+        if date:
+            body['date'] = date
+        assert client.post('/api/transactions', headers=auth, json=body).status_code == 201
+
+    conn = db.connect(app.config['DATABASE'], app.config)
+    assert rollups.verify(conn) == []
+    march = conn.execute("""
+        SELECT amount, tx_count FROM monthly_rollups
+        WHERE user_id = 1 AND month = '2024-03' AND type = 'expense' AND category = 'Food'
+    """).fetchone()
+    assert tuple(march) == (-200.0, 2)
+    conn.close()
+
+
+def test_verify_reports_drift_and_rebuild_repairs_it(app, client, auth):
+    conn = db.connect(app.config['DATABASE'], app.config)
+    key = tuple(conn.execute("SELECT user_id, month, type, category FROM monthly_rollups LIMIT 1").fetchone())
+    conn.execute("UPDATE monthly_rollups SET amount = amount + 1 "
+                 "WHERE user_id = ? AND month = ? AND type = ? AND category = ?", key)
+    conn.execute("INSERT INTO monthly_rollups (user_id, month, type, category, amount, abs_amount, tx_count) "
+                 "VALUES (1, '1999-01', 'expense', 'Ghost', -5, 5, 1)")
+    conn.commit()
+    mismatches = rollups.verify(conn)
+    assert len(mismatches) == 2
+    assert (1, '1999-01', 'expense', 'Ghost', (-5.0, 1), (0, 0)) in mismatches
+
+    rollups.rebuild(conn)
+    assert rollups.verify(conn) == []
+    conn.close()
+
+    result = app.test_cli_runner().invoke(args=['rollups', 'verify'])
+    assert result.exit_code == 0
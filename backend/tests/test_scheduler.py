@@ -0,0 +1,45 @@
+import datetime
+
+import budgeting
+import db
+import scheduler
+
+
+def test_scheduler_thread_is_off_by_default(app):
+    assert app.config['SCHEDULER'] is False
+    assert 'scheduler' not in app.extensions
+
+
+def test_job_runs_once_and_rolls_budgets_over(app):
+    conn = db.connect(app.config['DATABASE'])
+    with app.app_context():
+        status, summary = scheduler.run_job(conn, 'budgets.rollover', app.config)
+        # Not due again until the next hour
+        assert scheduler.run_job(conn, 'budgets.rollover', app.config) is None
+    assert status == 'ok'
+    start, end = budgeting.period_window('monthly', datetime.date.today())
+    current = conn.execute("SELECT category FROM budgets WHERE start_date = ? AND end_date = ? AND recurring = 1",
+                           (start, end)).fetchall()
+    assert len(current) == 5
+    conn.close()
+
+
+def test_jobs_endpoint_hides_run_details(app, client, auth):
+    conn = db.connect(app.config['DATABASE'])
+    with app.app_context():
+        scheduler.run_job(conn, 'budgets.rollover', app.config)
+    conn.close()
+    jobs = {job['name']: job for job in client.get('/api/jobs', headers=auth).get_json()}
+    assert set(jobs['budgets.rollover']) == set(scheduler.PUBLIC_FIELDS)
+    assert jobs['budgets.rollover']['last_status'] == 'ok'
+
+
+def test_jobs_cli(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['jobs', 'run', 'budgets.rollover'])
+    assert result.exit_code == 0, result.output
+    assert 'budgets.rollover: ok' in result.output
+    result = runner.invoke(args=['jobs', 'status'])
+    assert result.exit_code == 0, result.output
+    assert set(scheduler.JOBS) == {line.split()[0] for line in result.output.splitlines()}
+    assert 'last ok' in result.output
@@ -0,0 +1,70 @@
+import sqlite3
+
+import db
+
+READS = ('/api/transactions', '/api/accounts', '/api/profiles', '/api/budgets', '/api/dashboard')
+
+
+def _login(client):
+    token = client.post('/api/login', json={'username': 'demo', 'password': 'password'}).get_json()['access_token']
+    return {'Authorization': 'Bearer ' + token}
+
+
+def _legacy_database(path):
+    # transactions as created before household profiles: migration 2 appends
+    # profile_id and is_shared at the end
+    path.parent.mkdir()
+    conn = sqlite3.connect(str(path))
+    conn.execute('''
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        type TEXT NOT NULL,
+        category TEXT NOT NULL,
+        description TEXT,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    conn.close()
+    return str(path)
+
+
+def test_split_keeps_every_row_and_routes_to_the_shard(tmp_path, make_app):
+    path = _legacy_database(tmp_path / 'legacy' / 'fintrack.db')
+    plain = make_app(DATABASE=path).test_client()
+    auth = _login(plain)
+    before = {url: plain.get(url, headers=auth).get_json() for url in READS}
+
+    conn = db.connect(path, {})
+    assert [row['name'] for row in conn.execute("PRAGMA table_info(transactions)")][-3:-1] == ['profile_id', 'is_shared']
+    conn.close()
+
+    app = make_app(DATABASE=path, SHARDS=2)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['shards', 'split'])
+    assert result.exit_code == 0, result.output
+    assert 'shard-00.db: 0 rows' in result.output
+
+    client = app.test_client()
+    auth = _login(client)
+    for url in READS:
+        assert client.get(url, headers=auth).get_json() == before[url], url
+
+    # The demo user (id 1) lives in shard 1; the catalog keeps only users
+    assert db.user_database(app.config, 1) == db.shard_path(app.config, 1)
+    assert 'shard-01.db' in runner.invoke(args=['shards', 'locate', 'demo']).output
+    account_id = before['/api/accounts'][0]['id']
+    assert client.post('/api/transactions', headers=auth, json={
+        'account_id': account_id, 'amount': 5, 'type': 'expense', 'category': 'Food'}).status_code == 201
+    counts = {}
+    for name in db.database_paths(app.config):
+        conn = db.connect(name, app.config)
+        counts[name] = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        conn.close()
+    assert counts[path] == 0 and counts[db.shard_path(app.config, 0)] == 0
+    assert counts[db.shard_path(app.config, 1)] == len(before['/api/transactions']) + 1
+
+    result = runner.invoke(args=['shards', 'query', 'SELECT COUNT(*) AS n FROM accounts'])
+    assert result.output.splitlines() == ['shard\tn', '0\t0', '1\t%d' % len(before['/api/accounts'])]
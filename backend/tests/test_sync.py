@@ -0,0 +1,69 @@
+import db
+import sync
+
+
+def _sync(client, auth, since=None):
+    url = '/api/sync' if since is None else '/api/sync?since=' + since
+    response = client.get(url, headers=auth)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_first_sync_resets(client, auth):
+    state = _sync(client, auth)
+    assert state['reset'] is True and state['changes'] == {}
+    assert _sync(client, auth, state['token']) == {'token': state['token'], 'reset': False, 'more': False,
+                                                    'changes': {}}
+
+
+def test_changes_since_token(client, auth):
+    token = _sync(client, auth)['token']
+    account = client.get('/api/accounts', headers=auth).get_json()[0]
+    added = client.post('/api/transactions', headers=auth, json={
+        'account_id': account['id'], 'amount': 42, 'type': 'expense', 'category': 'Food'}).get_json()['transaction']
+    budget_id = client.get('/api/budgets', headers=auth).get_json()[0]['id']
+    assert client.delete('/api/budgets/%d' % budget_id, headers=auth).status_code == 200
+
+    state = _sync(client, auth, token)
+    assert state['reset'] is False and int(state['token']) > int(token)
+    changes = state['changes']
+    assert [row['id'] for row in changes['transactions']['upserted']] == [added['id']]
+    assert [row['id'] for row in changes['accounts']['upserted']] == [account['id']]
+    assert changes['budgets'] == {'upserted': [], 'deleted': [budget_id]}
+    assert _sync(client, auth, state['token'])['changes'] == {}
+
+
+def test_limit_cuts_at_a_version(client, auth):
+    token = _sync(client, auth)['token']
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    for amount in (1, 2, 3):
+        client.post('/api/transactions', headers=auth, json={
+            'account_id': account_id, 'amount': amount, 'type': 'expense', 'category': 'Food'})
+
+    seen = []
+    while True:
+        # Each transaction is logged with its account, two changes per version
+        state = client.get('/api/sync?limit=3&since=' + token, headers=auth).get_json()
+        seen.extend(row['amount'] for row in state['changes']['transactions']['upserted'])
+        token = state['token']
+        if not state['more']:
+            break
+    assert seen == [-1, -2, -3]
+
+
+def test_bad_and_stale_tokens(app, client, auth):
+    assert client.get('/api/sync?since=abc', headers=auth).status_code == 400
+    assert client.get('/api/sync?since=-1', headers=auth).status_code == 400
+    token = _sync(client, auth)['token']
+    assert _sync(client, auth, str(int(token) + 1))['reset'] is True
+
+    # Compacting everything moves the floor past the old token
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    client.post('/api/transactions', headers=auth, json={
+        'account_id': account_id, 'amount': 5, 'type': 'expense', 'category': 'Food'})
+    conn = db.connect(app.config['DATABASE'], app.config)
+    conn.execute("UPDATE changes SET changed_at = datetime('now', '-2 days')")
+    conn.commit()
+    assert sync.compact(conn, 1) > 0
+    conn.close()
+    assert _sync(client, auth, token)['reset'] is True
@@ -0,0 +1,31 @@
+def _ids(rows):
+    return [row['id'] for row in rows]
+
+
+def test_list_returns_everything_without_limit(client, auth):
+    rows = client.get('/api/transactions', headers=auth).get_json()
+    assert len(rows) > 10
+    assert 'X-Next-Cursor' not in client.get('/api/transactions', headers=auth).headers
+    assert [(row['date'], row['id']) for row in rows] == sorted(((row['date'], row['id']) for row in rows),
+                                                                 reverse=True)
+
+
+def test_limit_pages_through_with_cursor(client, auth):
+    everything = _ids(client.get('/api/transactions', headers=auth).get_json())
+    paged = []
+    url = '/api/transactions?limit=4'
+    while True:
+        response = client.get(url, headers=auth)
+        page = response.get_json()
+        assert len(page) <= 4
+        paged.extend(_ids(page))
+        token = response.headers.get('X-Next-Cursor')
+        if token is None:
+            break
+        url = '/api/transactions?limit=4&cursor=' + token
+    assert paged == everything
+
+
+def test_invalid_cursor(client, auth):
+    response = client.get('/api/transactions?cursor=nonsense', headers=auth)
+    assert response.status_code == 400
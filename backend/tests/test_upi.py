@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+import db
+import importers
+import upi
+
+
+def _payment(reference, amount='120.50', kind='sent'):
+    return {'transactionId': reference, 'amount': amount, 'type': kind, 'counterpartyName': 'Chai Point',
+            'date': '2024-05-01T20:00:00Z'}
+
+
+def _key(client, auth, account_id, name='UPI Sync'):
+    response = client.post('/api/api-keys', headers=auth, json={'account_id': account_id, 'name': name})
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def _count(app, reference):
+    conn = db.connect(app.config['DATABASE'], app.config)
+    count = conn.execute("SELECT COUNT(*) FROM transactions WHERE import_hash = ?",
+                         (upi.reference_hash(reference),)).fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_parse():
+    row = upi.parse(_payment(' R1 '))
+    assert (row['date'], row['amount'], row['type'], row['description']) == ('2024-05-02', -120.5, 'expense',
+                                                                             'Chai Point')
+    assert row['import_hash'] == upi.reference_hash('R1')
+    assert upi.parse(_payment('R2', kind='received'))['amount'] == 120.5
+    assert upi.parse(_payment('R3', kind='failed')) is None
+    for bad in (None, _payment(''), _payment('R4', kind='refund'), _payment('R5', amount='-3'),
+                dict(_payment('R6'), date='yesterday')):
+        with pytest.raises(upi.UpiError):
+            upi.parse(bad)
+
+
+def test_api_keys(app, client, auth):
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    created = _key(client, auth, account_id)
+    assert upi.key_user(created['api_key']) == 1
+    assert upi.key_user('nope') is None and upi.key_user('1.') is None
+    assert client.post('/api/api-keys', headers=auth, json={'account_id': account_id}).status_code == 400
+    assert client.post('/api/api-keys', headers=auth, json={'account_id': 999, 'name': 'x'}).status_code == 404
+
+    listed = client.get('/api/api-keys', headers=auth).get_json()
+    assert [key['id'] for key in listed] == [created['id']] and 'api_key' not in listed[0]
+    conn = db.connect(app.config['DATABASE'], app.config)
+    stored = conn.execute("SELECT key_hash FROM api_keys").fetchone()[0]
+    conn.close()
+    assert stored == upi.hash_key(created['api_key'])
+
+    payload = {'apiKey': created['api_key'], 'transaction': _payment('R1')}
+    assert client.post('/api/upi-webhook', json=payload).status_code == 201
+    for key in (None, '1.wrong', created['api_key'] + 'x'):
+        assert client.post('/api/upi-webhook', json=dict(payload, apiKey=key)).status_code == 401
+    assert client.post('/api/upi-webhook', json={'transaction': _payment('R2')},
+                       headers={'X-API-Key': created['api_key']}).status_code == 201
+
+    assert client.delete('/api/api-keys/%d' % created['id'], headers=auth).status_code == 200
+    assert client.delete('/api/api-keys/%d' % created['id'], headers=auth).status_code == 404
+    assert client.post('/api/upi-webhook', json=dict(payload, transaction=_payment('R3'))).status_code == 401
+
+
+@pytest.mark.parametrize('queued', [True, False], ids=['queue', 'inline'])
+def test_webhook_records_once(make_app, queued):
+    app = make_app(UPI_QUEUE=queued)
+    client = app.test_client()
+    auth = {'Authorization': 'Bearer ' + client.post(
+        '/api/login', json={'username': 'demo', 'password': 'password'}).get_json()['access_token']}
+    accounts = client.get('/api/accounts', headers=auth).get_json()
+    first, second = _key(client, auth, accounts[0]['id']), _key(client, auth, accounts[1]['id'], 'Other')
+
+    response = client.post('/api/upi-webhook', json={'apiKey': first['api_key'], 'transaction': _payment('R1')})
+    # Answered only once written
+    assert response.status_code == 201 and _count(app, 'R1') == 1
+    balance = client.get('/api/accounts', headers=auth).get_json()[0]['balance']
+    assert balance == pytest.approx(accounts[0]['balance'] - 120.5)
+
+    # Zapier's retry, and the same payment seen through another key
+    for key in (first, second):
+        response = client.post('/api/upi-webhook', json={'apiKey': key['api_key'], 'transaction': _payment('R1')})
+        assert response.status_code == 200
+    assert _count(app, 'R1') == 1
+
+    response = client.post('/api/upi-webhook', json={'apiKey': first['api_key'],
+                                                     'transaction': _payment('R2', kind='failed')})
+    assert response.status_code == 200 and _count(app, 'R2') == 0
+    response = client.post('/api/upi-webhook', json={'apiKey': first['api_key'], 'transaction': {}})
+    assert response.status_code == 400
+
+
+def test_failed_write_is_not_acknowledged(app, client, auth, monkeypatch):
+    key = _key(client, auth, client.get('/api/accounts', headers=auth).get_json()[0]['id'])
+    payload = {'apiKey': key['api_key'], 'transaction': _payment('R1')}
+    real_import_rows = importers.import_rows
+
+    def import_rows(cursor, user_id, account_id, rows, *args):
+        raise RuntimeError('disk on fire')
+
+    monkeypatch.setattr(importers, 'import_rows', import_rows)
+    response = client.post('/api/upi-webhook', json=payload)
+    assert response.status_code == 503 and response.headers['Retry-After']
+    assert _count(app, 'R1') == 0
+
+    monkeypatch.setattr(importers, 'import_rows', real_import_rows)
+    assert client.post('/api/upi-webhook', json=payload).status_code == 201
+    assert _count(app, 'R1') == 1
+
+
+def test_concurrent_duplicates_share_one_write(app, client, auth, monkeypatch):
+    account_id = client.get('/api/accounts', headers=auth).get_json()[0]['id']
+    path = app.config['DATABASE']
+    ingestor = app.extensions['upi']
+    release = threading.Event()
+    real_import_rows = importers.import_rows
+    written = []
+
+    def import_rows(cursor, user_id, account_id, rows, *args):
+        release.wait(5)
+        written.extend(rows)
+        return real_import_rows(cursor, user_id, account_id, rows, *args)
+
+    monkeypatch.setattr(importers, 'import_rows', import_rows)
+    blocker = ingestor.submit(path, 1, account_id, upi.parse(_payment('R0')))
+    futures = [ingestor.submit(path, 1, account_id, upi.parse(_payment(reference)))
+               for reference in ('R1', 'R1', 'R2')]
+    assert futures[0] is futures[1]
+    release.set()
+    assert blocker.result(5) == 'created'
+    assert [future.result(5) for future in futures] == ['created', 'created', 'created']
+    assert sorted(row['reference'] for row in written) == ['R0', 'R1', 'R2']
+    assert ingestor.submit(path, 1, account_id, upi.parse(_payment('R1'))).result(5) == 'duplicate'
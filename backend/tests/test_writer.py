@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+import db
+import writer
+
+
+def _insert(name):
+    def fn(cursor):
+        cursor.execute("INSERT INTO profiles (user_id, name, type, is_active) VALUES (1, ?, 'secondary', 1)", (name,))
+        return cursor.lastrowid
+    return fn
+
+
+def _failing(cursor):
+    _insert('rolled back')(cursor)
+    raise ValueError('boom')
+
+
+def test_a_failing_write_does_not_sink_its_group(app):
+    # Hold the writer on a first operation so the next three are committed
+    # together as one group
+    path = app.config['DATABASE']
+    pool = app.extensions['writer']
+    release = threading.Event()
+    blocker = pool.get(path).submit(lambda cursor: release.wait(10))
+    futures = [pool.get(path).submit(fn) for fn in (_insert('first'), _failing, _insert('second'))]
+    release.set()
+
+    assert blocker.result(10) is True
+    first, failed, second = futures
+    assert isinstance(first.result(10), int)
+    with pytest.raises(ValueError):
+        failed.result(10)
+    assert isinstance(second.result(10), int)
+
+    conn = db.connect(path, app.config)
+    names = [row[0] for row in conn.execute("SELECT name FROM profiles WHERE user_id = 1")]
+    conn.close()
+    assert 'first' in names and 'second' in names
+    assert 'rolled back' not in names
+
+
+def test_run_raises_in_the_caller(app):
+    with app.test_request_context():
+        with pytest.raises(ValueError):
+            writer.run(_failing, app.config['DATABASE'])
+        assert isinstance(writer.run(_insert('direct'), app.config['DATABASE']), int)
+
+
+def test_run_without_the_queue(make_app):
+    app = make_app(WRITE_QUEUE=False)
+    assert 'writer' not in app.extensions
+    with app.test_request_context():
+        with pytest.raises(ValueError):
+            writer.run(_failing, app.config['DATABASE'])
+        writer.run(_insert('inline'), app.config['DATABASE'])
+    conn = db.connect(app.config['DATABASE'], app.config)
+    names = [row[0] for row in conn.execute("SELECT name FROM profiles WHERE user_id = 1")]
+    conn.close()
+    assert 'inline' in names and 'rolled back' not in names
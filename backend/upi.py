@@ -0,0 +1,282 @@
+import atexit
+import datetime
+import hashlib
+import logging
+import os
+import queue
+import secrets
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from flask import current_app
+
+import archive
+import importers
+import writer
+
+# UPI webhook ingestion (see README_UPI_SYNC.md).
+#
+# Zapier posts one webhook per Google Pay email and retries on any hiccup, so
+# month-end brings bursts with duplicates. POST /api/upi-webhook
+# authenticates, parses and deduplicates the payload and hands the row to the
+# Ingestor. The UPI reference number is the idempotency key: it alone becomes
+# the row's import_hash (reference_hash), so the same payment posted through
+# two keys or for two accounts is still one transaction, and the
+# (user_id, import_hash) unique index has the final word. A retry arriving
+# while the first copy is being written waits on the same write instead of
+# queueing it twice.
+#
+# The ingest thread drains whatever has queued up (up to UPI_BATCH_SIZE) and
+# writes it through writer.run() as one operation per database:
+# importers.import_rows() per (user, account), each in its own savepoint, with
+# a single balance update each. A burst of webhooks costs a handful of
+# commits, and interactive writes queued on the same writer are never stuck
+# behind hundreds of them.
+#
+# The webhook only answers once its batch has committed. If the write fails,
+# or takes longer than UPI_WAIT_SECONDS, it answers 503 and Zapier retries, so
+# a payment is never acknowledged and then lost with the queue.
+
+logger = logging.getLogger('fintrack.upi')
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+WAIT_SECONDS = 20
+IST = datetime.timezone(datetime.timedelta(hours=5, minutes=30))
+TYPES = {'sent': 'expense', 'debit': 'expense', 'received': 'income', 'credit': 'income'}
+
+
+class UpiError(ValueError):
+    pass
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class NotRecorded(RuntimeError):
+    pass
+
+
+# API keys have the form <user_id>.<secret>. The prefix says which database
+# holds the key, so the webhook never touches the catalog; only a SHA-256 of
+# the whole key is stored.
+
+def new_key(user_id):
+    return '%s.%s' % (user_id, secrets.token_urlsafe(32))
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def key_user(key):
+    user_id, _, secret = (key or '').partition('.')
+    if not user_id.isdigit() or not secret:
+        return None
+    return int(user_id)
+
+
+def reference_hash(reference):
+    return hashlib.sha1(('upi|%s' % reference).encode()).hexdigest()
+
+
+def parse(transaction):
+    # Webhook "transaction" object -> importers row, or None for a failed
+    # payment (nothing moved)
+    if not isinstance(transaction, dict):
+        raise UpiError('transaction must be an object')
+    reference = str(transaction.get('transactionId') or '').strip()
+    if not reference:
+        raise UpiError('transactionId is required')
+    kind = str(transaction.get('type') or '').strip().lower()
+    if kind == 'failed':
+        return None
+    if kind not in TYPES:
+        raise UpiError('type must be sent, received or failed')
+    try:
+        amount = importers.parse_amount(str(transaction.get('amount') or ''))
+    except importers.StatementError:
+        amount = None
+    if not amount or amount <= 0:
+        raise UpiError('amount must be a positive number')
+    description = (transaction.get('counterpartyName') or transaction.get('counterpartyUpiId') or
+                   transaction.get('description'))
+    row = importers._row(_date(transaction.get('date')), description, amount, reference, TYPES[kind])
+    row['import_hash'] = reference_hash(reference)
+    return row
+
+
+def _date(value):
+    # ISO timestamps (Zapier sends UTC with a Z) are dated in IST, the
+    # timezone of the emails; a missing date means now
+    if not value:
+        return datetime.datetime.now(IST).date().isoformat()
+    try:
+        moment = datetime.datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+    except ValueError:
+        raise UpiError('date must be an ISO 8601 timestamp')
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(IST)
+    return moment.date().isoformat()
+
+
+def recorded(conn, user_id, import_hash):
+    return conn.execute("SELECT 1 FROM %s WHERE user_id = ? AND import_hash = ?" % archive.source(conn),
+                        (user_id, import_hash)).fetchone() is not None
+
+
+class Ingestor:
+
+    def __init__(self, app, size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.app = app
+        self.size = size
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._pending = {}  # (path, user_id, import_hash) -> Future of the write
+
+    def _ensure_started(self):
+        # Same lazy, fork-aware start as writer.Writer; call with _lock held
+        pid = os.getpid()
+        if self._pid != pid or not self._thread.is_alive():
+            self._queue = queue.Queue(self.size)
+            self._pending = {}
+            self._thread = threading.Thread(target=self._loop, args=(self._queue,),
+                                            name='upi-ingest', daemon=True)
+            self._pid = pid
+            self._thread.start()
+
+    def submit(self, path, user_id, account_id, row):
+        # A Future resolving to 'created' or 'duplicate' once the row's batch
+        # has committed; the same key already waiting shares its Future
+        key = (path, user_id, row['import_hash'])
+        with self._lock:
+            self._ensure_started()
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            try:
+                self._queue.put_nowait((path, user_id, account_id, row, future))
+            except queue.Full:
+                raise QueueFull('ingest queue is full')
+            self._pending[key] = future
+        return future
+
+    def flush(self):
+        # Block until everything submitted so far has been written
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def stop(self, timeout=None):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _loop(self, entries):
+        stopping = False
+        while not stopping:
+            first = entries.get()
+            if first is None:
+                entries.task_done()
+                return
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    entry = entries.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    entries.task_done()
+                    stopping = True
+                    break
+                batch.append(entry)
+            try:
+                self._write(batch)
+            except Exception as exc:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+            finally:
+                with self._lock:
+                    for path, user_id, _, row, _ in batch:
+                        self._pending.pop((path, user_id, row['import_hash']), None)
+                for _ in batch:
+                    entries.task_done()
+
+    def _write(self, batch):
+        databases = defaultdict(lambda: defaultdict(list))
+        for path, user_id, account_id, row, future in batch:
+            databases[path][(user_id, account_id)].append((row, future))
+        with self.app.app_context():
+            for path, groups in databases.items():
+                try:
+                    outcomes = writer.run(lambda cursor: _write_groups(cursor, groups), path)
+                except Exception as exc:
+                    logger.exception('could not write %d UPI transactions to %s',
+                                     sum(len(entries) for entries in groups.values()), path)
+                    outcomes = {group: exc for group in groups}
+                for group, entries in groups.items():
+                    outcome = outcomes[group]
+                    for row, future in entries:
+                        if isinstance(outcome, Exception):
+                            future.set_exception(outcome)
+                        else:
+                            future.set_result('duplicate' if row['import_hash'] in outcome else 'created')
+
+
+def _write_groups(cursor, groups):
+    # Returns, per (user, account), the keys that were already recorded, or
+    # the exception that rolled that group back without sinking the others
+    outcomes = {}
+    for (user_id, account_id), entries in groups.items():
+        rows = [row for row, _ in entries]
+        cursor.execute("SAVEPOINT upi_group")
+        try:
+            placeholders = ','.join('?' * len(rows))
+            existing = {r[0] for r in cursor.execute(
+                "SELECT import_hash FROM %s WHERE user_id = ? AND import_hash IN (%s)"
+                % (archive.source(cursor), placeholders), [user_id] + [row['import_hash'] for row in rows])}
+            importers.import_rows(cursor, user_id, account_id, rows)
+        except Exception as exc:
+            cursor.execute("ROLLBACK TO upi_group")
+            cursor.execute("RELEASE upi_group")
+            logger.exception('could not write %d UPI transactions for user %s', len(rows), user_id)
+            outcomes[(user_id, account_id)] = exc
+        else:
+            cursor.execute("RELEASE upi_group")
+            outcomes[(user_id, account_id)] = existing
+    return outcomes
+
+
+def ingest(conn, path, user_id, account_id, row):
+    # Returns 'duplicate' (already written) or 'created' once the row is
+    # committed; raises NotRecorded if that did not happen in time
+    if recorded(conn, user_id, row['import_hash']):
+        return 'duplicate'
+    ingestor = current_app.extensions.get('upi')
+    if ingestor is None:
+        result = writer.run(lambda cursor: importers.import_rows(cursor, user_id, account_id, [row]), path)
+        return 'created' if result['imported'] else 'duplicate'
+    future = ingestor.submit(path, user_id, account_id, row)
+    try:
+        return future.result(current_app.config['UPI_WAIT_SECONDS'])
+    except FutureTimeout:
+        raise NotRecorded('transaction is still being written')
+    except Exception as exc:
+        raise NotRecorded('transaction could not be written') from exc
+
+
+def init_app(app):
+    app.config.setdefault('UPI_QUEUE', True)
+    app.config.setdefault('UPI_QUEUE_SIZE', QUEUE_SIZE)
+    app.config.setdefault('UPI_BATCH_SIZE', BATCH_SIZE)
+    app.config.setdefault('UPI_WAIT_SECONDS', WAIT_SECONDS)
+    if app.config['UPI_QUEUE']:
+        ingestor = app.extensions['upi'] = Ingestor(app, app.config['UPI_QUEUE_SIZE'],
+                                                    app.config['UPI_BATCH_SIZE'])
+        atexit.register(ingestor.stop)
@@ -0,0 +1,191 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+import db
+import instrumentation
+from db import get_db
+
+# Single-writer queue with group commit.
+#
+# Request handlers never write through their own connection. They hand a
+# function fn(cursor) to run() and block on its result. One writer thread per
+# process owns the only write connection: it drains whatever operations are
+# queued, runs them in one BEGIN IMMEDIATE transaction (each inside its own
+# savepoint so one failing request does not sink the others) and commits once.
+# Under load that turns N fsyncs and N lock acquisitions into one, and the
+# busy/backoff policy lives here instead of in every route.
+
+MAX_BATCH = 64
+LOCK_RETRIES = 6
+BACKOFF = 0.01       # seconds, doubled on every retry
+RESULT_TIMEOUT = 30  # seconds a request waits for its write
+
+
+def _is_locked(exc):
+    return isinstance(exc, sqlite3.OperationalError) and 'locked' in str(exc)
+
+
+class Writer:
+
+    def __init__(self, path, config=None, max_batch=MAX_BATCH, retries=LOCK_RETRIES, backoff=BACKOFF):
+        self.path = path
+        self.config = config
+        self.max_batch = max_batch
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # Started lazily, and again in each forked worker: a thread does not
+        # survive fork and the parent's queue would never be drained.
+        pid = os.getpid()
+        if self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != pid or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._loop, args=(self._queue,),
+                                                name='sqlite-writer', daemon=True)
+                self._pid = pid
+                self._thread.start()
+
+    def submit(self, fn):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((fn, future))
+        return future
+
+    def stop(self, timeout=None):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _loop(self, ops_queue):
+        conn = db.connect(self.path, self.config)
+        try:
+            while True:
+                first = ops_queue.get()
+                if first is None:
+                    return
+                ops = [first]
+                # Group commit: take everything that queued up while the last
+                # batch was committing, without waiting for more.
+                while len(ops) < self.max_batch:
+                    try:
+                        op = ops_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if op is None:
+                        ops_queue.put(None)
+                        break
+                    ops.append(op)
+                self._commit_group(conn, [op for op in ops if op[1].set_running_or_notify_cancel()])
+        finally:
+            conn.close()
+
+    def _commit_group(self, conn, ops):
+        if not ops:
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                results = self._apply(conn, ops)
+                conn.commit()
+            except sqlite3.Error as exc:
+                if conn.in_transaction:
+                    conn.rollback()
+                if _is_locked(exc) and attempt < self.retries:
+                    # Another process holds the write lock beyond busy_timeout
+                    time.sleep(self.backoff * (2 ** attempt))
+                    continue
+                for _, future in ops:
+                    future.set_exception(exc)
+                return
+            for (_, future), (ok, value) in zip(ops, results):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            return
+
+    def _apply(self, conn, ops):
+        db.attach_archive(conn, self.path)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        results = []
+        for fn, _ in ops:
+            cursor.execute("SAVEPOINT op")
+            try:
+                value = fn(cursor)
+            except Exception as exc:
+                if _is_locked(exc):
+                    raise
+                cursor.execute("ROLLBACK TO op")
+                cursor.execute("RELEASE op")
+                results.append((False, exc))
+            else:
+                cursor.execute("RELEASE op")
+                results.append((True, value))
+        return results
+
+
+class WriterPool:
+    # One Writer per database file, so with sharding each shard has its own
+    # queue and commits for different shards proceed in parallel.
+
+    def __init__(self, config=None):
+        self.config = config
+        self._writers = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        writer = self._writers.get(path)
+        if writer is None:
+            with self._lock:
+                writer = self._writers.setdefault(path, Writer(path, self.config))
+        return writer
+
+    def stop(self, timeout=None):
+        for writer in list(self._writers.values()):
+            writer.stop(timeout)
+
+
+def run(fn, path=None):
+    # Run fn(cursor) in a committed write transaction and return its result.
+    # Exceptions raised by fn are re-raised in the calling request. `path`
+    # picks the database for callers without a signed-in user (the UPI
+    # webhook and its ingest thread); it defaults to the request's.
+    writers = current_app.extensions.get('writer')
+    if writers is None:
+        conn = get_db() if path is None else db.thread_connection(path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            value = fn(cursor)
+            conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        return value
+    writer = writers.get(path or db.request_database())
+    started = time.perf_counter()
+    try:
+        return writer.submit(fn).result(current_app.config['WRITE_QUEUE_TIMEOUT'])
+    finally:
+        instrumentation.record_write_wait(time.perf_counter() - started)
+
+
+def init_app(app):
+    app.config.setdefault('WRITE_QUEUE', True)
+    app.config.setdefault('WRITE_QUEUE_TIMEOUT', RESULT_TIMEOUT)
+    if app.config['WRITE_QUEUE']:
+        app.extensions['writer'] = WriterPool(app.config)
@@ -17,7 +17,7 @@ call venv\Scripts\activate
 echo.
 echo Setting up the backend...
 cd backend
-pip install flask flask-cors flask-restful flask-jwt-extended
+pip install flask flask-cors flask-restful flask-jwt-extended numpy uvicorn pytest
 cd ..
 
 echo.
@@ -7,6 +7,9 @@ echo.
 echo Starting backend server...
 start cmd /k "call venv\Scripts\activate & cd backend & python app.py"
 
+echo Starting background jobs...
+start cmd /k "call venv\Scripts\activate & cd backend & flask --app app jobs worker"
+
 echo Waiting for backend to initialize...
 timeout /t 10 /nobreak > nul
 